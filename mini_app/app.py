@@ -4,248 +4,512 @@ import dash_bootstrap_components as dbc
 from dash.exceptions import PreventUpdate
 import pandas as pd
 import os
-import subprocess
-import dash_bio
-import numpy as np
+import functools
 
 from utils.pages.upload import upload_functions
 from utils.pages.differential_expression import de_functions
-from utils.helper_functions.main_functions import *
+from utils.helper_functions.export import register_export_route, available_formats, EXPORT_FORMATS
+from utils.helper_functions.chunked_upload import register_upload_routes
+from utils.helper_functions.metrics import register_metrics
+from utils.helper_functions.warmup import warmup, register_readiness_route
+from utils.helper_functions.count_table import COUNT_TABLE_EXTENSIONS
+from utils.helper_functions.pre_analysis import MIN_COUNT, MIN_SAMPLES
+from utils.helper_functions.de_pipeline import CONDITION_LEVELS
+from utils.helper_functions.heatmap import HEATMAP_SIZES, RANK_METRICS
+from utils.helper_functions.enrichment import PADJ_CUTOFFS, DIRECTIONS
+from utils.helper_functions.robustness import SWEEP_MODES, SWEEP_SUBSETS, MAX_SUBSETS, BASE_DESIGN
+from utils.helper_functions.main_functions import upload_card
 
 # By setting suppress_callback_exceptions=True, instruct Dash to ignore these mismatches during initialization, 
 # allowing for more flexibility in how components and callbacks are dynamically created and linked. 
 app = dash.Dash(__name__, suppress_callback_exceptions=True, external_stylesheets=[dbc.themes.SANDSTONE]) 
 
-# Define the logo with fixed width
-logo = html.Img( 
-    src='/assets/images/dna_2.png',  
-    style={'height': '85%', 'width': '100%'}  # Set a fixed width for the logo
-)
-
-# Logo container
-logo_container = html.Div(
-    logo,
-    style={'flex': '0 0 150px'},  # The logo will neither grow nor shrink
-    className="d-flex align-items-center"
-)
-
-default_note_string = 'This app takes input in the form of gene-counts table output generated as a result of aligning sequencing reads to a reference, and various data analysis processes. Outputs a gene counts table and volcano plot to visualise the data.'
-
-# To giver error alert
-error_alert = dbc.Alert(
-        id="upload-error-alert",
-        is_open=False,
-        dismissable=True,
-        color="danger",
-        style={'margin-top': '10px'}
+############################################################################################################################
+
+# Define the app layout. The components and the page are built on the first request (or by the warm-up)
+# rather than at import, and kept for the later requests
+@functools.cache
+def serve_layout():
+    # Define the logo with fixed width
+    logo = html.Img( 
+        src='/assets/images/dna_2.png',  
+        style={'height': '85%', 'width': '100%'}  # Set a fixed width for the logo
     )
 
-# Create an instance of the upload card
-file_upload = upload_card('Upload the gene count file (Required)', 'upload-data')
+    # Logo container
+    logo_container = html.Div(
+        logo,
+        style={'flex': '0 0 150px'},  # The logo will neither grow nor shrink
+        className="d-flex align-items-center"
+    )
 
-# Navbar with logo and title
-navbar = dbc.Navbar(
-            dbc.Container(
-                [
-                    logo_container,
-                    dbc.NavbarBrand("DESeq Analysis App", className="ms-2"),
-                ],
-                fluid=True,
-                style={'display': 'flex'}
-            ),
-            color="dark",
-            dark=True,
+    default_note_string = 'This app takes input in the form of gene-counts table output generated as a result of aligning sequencing reads to a reference, and various data analysis processes. Outputs a gene counts table and volcano plot to visualise the data.'
+
+    # To giver error alert
+    error_alert = dbc.Alert(
+            id="upload-error-alert",
+            is_open=False,
+            dismissable=True,
+            color="danger",
+            style={'margin-top': '10px'}
         )
 
-# Divider lines
-divider_line = html.Hr(className="mt-2 mb-4")
-
-# Differential Expression Header
-Diff_Exp_header = html.Div([
-    html.H4(("Differential Expression"), style={'textAlign': 'center'}),
-    divider_line,
-])
-
-# Differential expression selection dash table - selcting conditions
-diff_exp_table = html.Div([
-    dcc.Loading(
-        id="loading-diff-exp-table",
-        type="default",
-        children=dash_table.DataTable( 
-            id='table-dropdown',
-            columns=[
-                {'id': 'Samples', 'name': 'Samples'},
-                {'id': 'Conditions', 'name': 'Conditions', 'presentation': 'dropdown'},
-            ],
-            css=[ {"selector": ".Select-menu-outer", "rule": "display: block !important;"},
-                  {'selector': '.Select-menu-outer .Select-option', 'rule': 'color: black !important;'},
-            ],
-            editable=True,
-            dropdown={
-                'Conditions': {
-                    'options': [
-                        {'label': ' ', 'value': 'None'},
-                        {'label': 'Control', 'value': 'Control'},
-                        {'label': 'Treatment', 'value': 'Treatment'}
-                    ]
+    # Create an instance of the upload card
+    file_upload = upload_card('Upload the gene count file (Required)', 'upload-data')
+
+    # Chunked upload for large count tables, handled by assets/chunked_upload.js
+    chunked_upload = dbc.Col([
+        dbc.Label('Large count tables (.csv, .tsv, .gz, featureCounts or HTSeq output) can be uploaded in chunks:',
+                  style={'font-size': 'small'}),
+        html.Br(),
+        html.Button('Select a large file', id='chunked-upload-button', className='btn btn-secondary btn-sm',
+                    **{'data-accept': ','.join(COUNT_TABLE_EXTENSIONS)}),
+        html.Div(id='chunked-upload-status', style={'font-size': 'small'}),
+        dcc.Store(id='chunked-upload-result', storage_type='memory')
+    ])
+
+    # Navbar with logo and title
+    navbar = dbc.Navbar(
+                dbc.Container(
+                    [
+                        logo_container,
+                        dbc.NavbarBrand("DESeq Analysis App", className="ms-2"),
+                    ],
+                    fluid=True,
+                    style={'display': 'flex'}
+                ),
+                color="dark",
+                dark=True,
+            )
+
+    # Divider lines
+    divider_line = html.Hr(className="mt-2 mb-4")
+
+    # Differential Expression Header
+    Diff_Exp_header = html.Div([
+        html.H4(("Differential Expression"), style={'textAlign': 'center'}),
+        divider_line,
+    ])
+
+    # Differential expression selection dash table - selcting conditions
+    diff_exp_table = html.Div([
+        dcc.Loading(
+            id="loading-diff-exp-table",
+            type="default",
+            children=dash_table.DataTable( 
+                id='table-dropdown',
+                columns=[
+                    {'id': 'Samples', 'name': 'Samples'},
+                    {'id': 'Conditions', 'name': 'Conditions', 'presentation': 'dropdown'},
+                ],
+                css=[ {"selector": ".Select-menu-outer", "rule": "display: block !important;"},
+                      {'selector': '.Select-menu-outer .Select-option', 'rule': 'color: black !important;'},
+                ],
+                editable=True,
+                dropdown={
+                    'Conditions': {
+                        'options': [{'label': ' ', 'value': 'None'}] +
+                                   [{'label': level, 'value': level} for level in CONDITION_LEVELS]
+                    },
                 },
-            },
-            page_size=15,
+                page_size=15,
+            )
         )
+    ])
+    # Button component for starting alignment
+    start_ana_btn = dbc.Button("Start Analysis", id='start-analysis-btn', color="dark", className="mt-3 btn-block")
+    # Button for cancelling a queued or running analysis
+    cancel_ana_btn = dbc.Button("Cancel", id='cancel-analysis-btn', color="secondary", className="mt-3 ms-2 btn-block")
+    # Selecting the engine that runs the DE analysis
+    de_engine_select = dbc.RadioItems(
+        id='de-engine',
+        options=[
+            {'label': 'DESeq2 (R)', 'value': 'r'},
+            {'label': 'Built-in (NumPy/SciPy)', 'value': 'python'}
+        ],
+        value='r',
+        inline=True,
+        className="mt-3",
+        style={'font-size': 'small'}
     )
-])
-# Button component for starting alignment
-start_ana_btn = dbc.Button("Start Analysis", id='start-analysis-btn', color="dark", className="mt-3 btn-block")
-# conditions table variable
-conditions_table = dcc.Store(id='conditions_table')
-
-# Showing the deseq results
-deseq_results_table = html.Div([
-    dash_table.DataTable(
-        id='diff-exp-table',
-        columns=[],  
+    # Low count gene filter applied before the DE analysis
+    gene_filter_inputs = html.Div([
+        dbc.Label('Keep genes with at least', style={'font-size': 'small'}),
+        dbc.Input(id='filter-min-count', type='number', min=0, step=1, value=MIN_COUNT, size='sm',
+                  style={'width': '80px', 'display': 'inline-block', 'margin': '0 5px'}),
+        dbc.Label('reads in at least', style={'font-size': 'small'}),
+        dbc.Input(id='filter-min-samples', type='number', min=0, step=1, value=MIN_SAMPLES, size='sm',
+                  style={'width': '80px', 'display': 'inline-block', 'margin': '0 5px'}),
+        dbc.Label('samples', style={'font-size': 'small'}),
+    ], className='mt-3')
+    # User-defined condition levels, the first one is the reference of the design
+    condition_levels_input = html.Div([
+        dbc.Label('Condition levels (comma separated, the first is the reference)', style={'font-size': 'small'}),
+        dbc.Input(id='condition-levels', type='text', value=', '.join(CONDITION_LEVELS), debounce=True, size='sm'),
+    ], className='mt-3')
+    # Contrasts extracted from the fitted model
+    contrast_mode_select = dbc.RadioItems(
+        id='contrast-mode',
+        options=[
+            {'label': 'Each level vs the reference', 'value': 'reference'},
+            {'label': 'All pairs of levels', 'value': 'pairwise'}
+        ],
+        value='reference',
+        inline=True,
+        className="mt-3",
+        style={'font-size': 'small'}
+    )
+    # conditions table variable
+    conditions_table = dcc.Store(id='conditions_table')
+
+    # Showing the deseq results
+    deseq_results_table = html.Div([
+        dash_table.DataTable(
+            id='diff-exp-table',
+            columns=[],  
+            data=[],
+            # Paging, sorting and filtering are done on the server (update_diff_exp_table)
+            page_action="custom",
+            page_current=0,
+            page_size=20,
+            sort_action="custom",
+            sort_mode="single",
+            sort_by=[],
+            filter_action="custom",
+            filter_query='',
+            # Gene searches ignore case unless the filter cell's case toggle is switched on
+            filter_options={'case': 'insensitive'},
+        )
+    ])
+
+    # Gene search over the shown result, the selected genes are highlighted in the table and the volcano plot
+    gene_search_select = html.Div([
+        dcc.Dropdown(
+            id='gene-search',
+            options=[],
+            value=[],
+            multi=True,
+            placeholder='Search genes by ID...',
+            style={'font-size': 'small', 'width': '400px'}
+        ),
+        dcc.Store(id='gene-selection', storage_type='memory')
+    ])
+
+    # Contrast shown in the results table, the volcano plot and the download
+    contrast_view_select = dcc.Dropdown(
+        id='contrast-view',
+        options=[],
+        placeholder='Contrast',
+        clearable=False,
+        style={'font-size': 'small', 'width': '300px'}
+    )
+
+    # download button for the original results, pointed at the export route once results are available
+    download_deseq_results = dbc.Button("Download Original Results", id='results-download-btn', color="dark", className="mt-3 btn-block",
+                                        external_link=True, disabled=True)
+
+    # File format of the downloaded results
+    export_format_select = dbc.Select(
+        id='export-format',
+        options=[{'label': EXPORT_FORMATS[fmt]['label'], 'value': fmt} for fmt in available_formats()],
+        value='csv',
+        className="mt-3",
+        style={'font-size': 'small'}
+    )
+
+    # Volcano rendering mode, the WebGL plot updates the effect sizes in the browser
+    volcano_mode_select = dbc.RadioItems(
+        id='volcano-mode',
+        options=[
+            {'label': 'WebGL (fast)', 'value': 'webgl'},
+            {'label': 'Standard', 'value': 'standard'}
+        ],
+        value='webgl',
+        inline=True,
+        style={'font-size': 'small'}
+    )
+
+    # Thinning of dense non-significant points, significant genes are always drawn
+    volcano_thin_select = dbc.Checklist(
+        id='volcano-thin',
+        options=[{'label': 'Thin dense non-significant points', 'value': 'thin'}],
+        value=[],
+        inline=True,
+        style={'font-size': 'small'}
+    )
+
+    # Ranking and number of the genes shown in the heatmap
+    heatmap_metric_select = dbc.RadioItems(
+        id='heatmap-metric',
+        options=[{'label': f"Top by {spec['label']}", 'value': metric} for metric, spec in RANK_METRICS.items()],
+        value='padj',
+        inline=True,
+        style={'font-size': 'small'}
+    )
+
+    heatmap_size_select = dbc.Select(
+        id='heatmap-genes',
+        options=[{'label': f'{size} genes', 'value': str(size)} for size in HEATMAP_SIZES],
+        value='50',
+        size='sm',
+        style={'font-size': 'small', 'width': '120px'}
+    )
+
+    # Genes counted as significant in the gene set enrichment, beyond the effect size lines of the volcano plot
+    enrichment_direction_select = dbc.RadioItems(
+        id='enrichment-direction',
+        options=[{'label': label, 'value': direction} for direction, label in DIRECTIONS.items()],
+        value='both',
+        inline=True,
+        style={'font-size': 'small'}
+    )
+
+    enrichment_padj_select = dbc.Select(
+        id='enrichment-padj',
+        options=[{'label': f'padj < {cutoff}', 'value': str(cutoff)} for cutoff in PADJ_CUTOFFS],
+        value='0.05',
+        size='sm',
+        style={'font-size': 'small', 'width': '120px'}
+    )
+
+    # Gene sets over-represented among the significant genes, sorted by p-value
+    enrichment_table = dash_table.DataTable(
+        id='enrichment-table',
+        columns=[{'id': column, 'name': column} for column in
+                 ['Gene set', 'Source', 'Size', 'Overlap', 'Expected', 'pvalue', 'padj', 'Genes']],
+        data=[],
+        page_size=15,
+        sort_action='native',
+        style_cell={'font-size': 'small', 'textAlign': 'left', 'whiteSpace': 'normal', 'maxWidth': '400px'},
+    )
+
+    # Robustness sweep of the selected design, leaving out one sample at a time or on random subsets of the samples
+    sweep_mode_select = dbc.RadioItems(
+        id='sweep-mode',
+        options=[{'label': label, 'value': mode} for mode, label in SWEEP_MODES.items()],
+        value='leave_one_out',
+        inline=True,
+        style={'font-size': 'small'}
+    )
+
+    sweep_subsets_input = html.Div([
+        dbc.Label('Random subsets', style={'font-size': 'small'}),
+        dbc.Input(id='sweep-subsets', type='number', min=1, max=MAX_SUBSETS, step=1, value=SWEEP_SUBSETS, size='sm',
+                  style={'width': '80px', 'display': 'inline-block', 'margin': '0 5px'}),
+    ])
+
+    start_sweep_btn = dbc.Button("Start Sweep", id='start-sweep-btn', color="dark", className="btn-block")
+    cancel_sweep_btn = dbc.Button("Cancel", id='cancel-sweep-btn', color="secondary", className="ms-2 btn-block")
+
+    # Per-gene stability over the subset designs, least stable significant genes first
+    stability_table = dash_table.DataTable(
+        id='stability-table',
+        columns=[{'id': column, 'name': column} for column in
+                 ['GeneID', BASE_DESIGN, 'Significant in', 'Tested in', 'log2FC', 'log2FC mean', 'log2FC SD',
+                  'log2FC range', 'Sign changes']],
         data=[],
-        sort_action="native", 
-        filter_action="native",
         page_size=20,
+        sort_action='native',
+        style_cell={'font-size': 'small'},
     )
-])
 
-# download button for the original results
-download_deseq_results = dbc.Button("Download Original Results", id='results-download-btn', color="dark", className="mt-3 btn-block")
+    volcano_plot_component = html.Div([
+                    'Effect Sizes',
+                    html.Br(),
+                    dcc.RangeSlider(
+                        id = 'range-slider',
+                        min = -10,
+                        max = 10,
+                        step= 0.05,
+                        marks= {i: {'label': str(i)} for i in range(-10, 11)},
+                        value= [-1, 1]
+                    ),
+                    html.Br(),
+                    html.Div(
+                        dcc.Graph(
+                            id='de_volcano_plot',
+                            style={'height': '800px'}
+                        )
+                    )
+                ])
 
-# Store results for download
-download_deseq_results_component =  html.Div(
+    return html.Div(
+        className='container',
+        children=[
+            # Navigation bar
+            navbar,
+            html.Br(),
+            # Main heading
+            html.H4('Upload the count table and do the DESeq analysis', className='display-6', style={'textAlign': 'center', 'color': '#561fb6'}),
+            # h 
+            html.Div(default_note_string, style={'textAlign': 'center', 'font-size': 'small', 'white-space': 'pre-wrap'}),
+            html.Br(),
+            # Divider line
+            divider_line,
+            # Upload data area
+            dbc.Row(
                 [
-                    dcc.Loading(
-                        id='loading_deseq_download',
-                        type='default',
-                        children=[
-                            dcc.Download(id='deseq_download_component')
-                        ],
+                    file_upload,
+                    chunked_upload,
+                    error_alert,
+                    dbc.Col(
+                        dbc.Row([
+                            dbc.Col(
+                                html.Div(id='filename-display', style={'textAlign': 'center'}),
+                                width={"size": 12}
+                            )
+                        ]),
                     ),
                 ],
-                className='contain-spinner'
-            )
-
-volcano_plot_component = html.Div([
-                'Effect Sizes',
-                html.Br(),
-                dcc.RangeSlider(
-                    id = 'range-slider',
-                    min = -10,
-                    max = 10,
-                    step= 0.05,
-                    marks= {i: {'label': str(i)} for i in range(-10, 11)},
-                    value= [-1, 1]
-                ),
+                style={'marginTop': '20px'}
+            ),
+            html.Br(),
+            # Divider line
+            divider_line,        
+            # Storing uploaded data in dcc store to be accessed
+            dcc.Store(id='gc-filestorage', storage_type='memory'),
+            html.Br(),
+            dbc.Row([
+                dbc.Col(html.Div([
+                    dbc.Label('Upload the count table in the "Upload files" tab and select the samples for differential expression analysis by selecting their experimental conditions.', 
+                              className='mt-3', style={'font-size': 'small'}),
+                    condition_levels_input,
+                    html.Br(),
+                    diff_exp_table,
+                    html.Br(),
+                    # Library size QC of the samples
+                    html.Div(id='qc-summary')
+                ])),
+                dbc.Col(html.Div([
+                    dbc.Label('Click "Start Analysis" to start the DE analysis once the required samples and conditions are selected.', 
+                              className='mt-3', style={'font-size': 'small'}),
+                    dbc.Col([start_ana_btn, cancel_ana_btn], width={"size": 6, "offset": 4}),
+                    dbc.Col(de_engine_select, width={"size": 8, "offset": 3}),
+                    dbc.Col(gene_filter_inputs, width={"size": 10, "offset": 1}),
+                    dbc.Col(contrast_mode_select, width={"size": 8, "offset": 3}),
+                    html.Br(),
+                    html.Div(id='loading-output', style={'textAlign': 'center', 'font-size': 'small'}),
+                    # Job of the running analysis and the timer polling it
+                    dcc.Store(id='de-job', storage_type='memory'),
+                    dcc.Interval(id='de-job-poll', interval=1000, disabled=True)
+                ]))
+            ]),
+            html.Br(),
+            # PCA and distances of the selected samples (all samples until some are selected)
+            html.H5("Sample QC", style={'textAlign': 'center'}),
+            html.Hr(),
+            dbc.Row([
+                dbc.Col(dcc.Loading(dcc.Graph(id='sample-pca')), md=6),
+                dbc.Col(dcc.Loading(dcc.Graph(id='sample-distances')), md=6)
+            ]),
+            html.Br(),
+            html.Br(),
+            html.H5("Differential Expression Outputs", style={'textAlign': 'center'}),
+            html.Hr(),
+            html.Br(),
+            # Storing the differential expression output, every contrast of the run and the one shown
+            dcc.Store(id='de-results', storage_type='memory'),
+            dcc.Store(id='diff-exp-content', storage_type='memory'),
+            dbc.Row([
+                dbc.Col(contrast_view_select, width='auto'),
+                dbc.Col(gene_search_select, width='auto')
+            ], justify='center'),
+            html.Br(),
+            dbc.Row([
+                dbc.Col(deseq_results_table, md=12),
                 html.Br(),
-                html.Div(
+                dbc.Row([
+                    dbc.Col(download_deseq_results, width='auto'),
+                    dbc.Col(export_format_select, width='auto'),
+                ], justify='center'),
+                dbc.Col(conditions_table)
+            ]),
+            html.Br(),
+            html.Br(),
+            html.H5("Volcano Plot", style={'textAlign': 'center'}),
+            html.Hr(),  # Divider line
+            dbc.Row([
+                dbc.Col(volcano_mode_select, width='auto'),
+                dbc.Col(volcano_thin_select, width='auto')
+            ], justify='center'),
+            html.Br(),
+            dbc.Row([
+                dcc.Loading(html.Div([
+                    'Effect Sizes',
+                    html.Br(),
+                    dcc.RangeSlider(
+                        id='range-slider',
+                        min=-10,
+                        max=10,
+                        step=0.05,
+                        marks={i: {'label': str(i)} for i in range(-10, 11)},
+                        value=[-1, 1]
+                    ),
+                    html.Br(),
                     dcc.Graph(
                         id='de_volcano_plot',
                         style={'height': '800px'}
                     )
-                )
-            ])
-
-
-############################################################################################################################
-
-# Define the app layout
-app.layout = html.Div(
-    className='container',
-    children=[
-        # Navigation bar
-        navbar,
-        html.Br(),
-        # Main heading
-        html.H4('Upload the count table and do the DESeq analysis', className='display-6', style={'textAlign': 'center', 'color': '#561fb6'}),
-        # h 
-        html.Div(default_note_string, style={'textAlign': 'center', 'font-size': 'small', 'white-space': 'pre-wrap'}),
-        html.Br(),
-        # Divider line
-        divider_line,
-        # Upload data area
-        dbc.Row(
-            [
-                file_upload,
-                error_alert,
-                dbc.Col(
-                    dbc.Row([
-                        dbc.Col(
-                            html.Div(id='filename-display', style={'textAlign': 'center'}),
-                            width={"size": 12}
-                        )
-                    ]),
-                ),
-            ],
-            style={'marginTop': '20px'}
-        ),
-        html.Br(),
-        # Divider line
-        divider_line,        
-        # Storing uploaded data in dcc store to be accessed
-        dcc.Store(id='gc-filestorage', storage_type='memory'),
-        html.Br(),
-        dbc.Row([
-            dbc.Col(html.Div([
-                dbc.Label('Upload the count table in the "Upload files" tab and select the samples for differential expression analysis by selecting their experimental conditions.', 
-                          className='mt-3', style={'font-size': 'small'}),
-                html.Br(),
-                diff_exp_table              
-            ])),
-            dbc.Col(html.Div([
-                dbc.Label('Click "Start Analysis" to start the DE analysis once the required samples and conditions are selected.', 
-                          className='mt-3', style={'font-size': 'small'}),
-                dbc.Col(start_ana_btn, width={"size": 6, "offset": 4}),
-                html.Br(),
-                html.Div(id='loading-output')
-            ]))
-        ]),
-        html.Br(),
-        html.Br(),
-        html.H5("Differential Expression Outputs", style={'textAlign': 'center'}),
-        html.Hr(),
-        html.Br(),
-        # Storing the differential expression output
-        dcc.Store(id='diff-exp-content', storage_type='memory'),
-        html.Br(),
-        dbc.Row([
-            dbc.Col(deseq_results_table, md=12),
+                ]))
+            ]),
+            html.Br(),
             html.Br(),
+            html.H5("Heatmap", style={'textAlign': 'center'}),
+            html.Hr(),  # Divider line
             dbc.Row([
-                dbc.Col(download_deseq_results),
-            ], style={'textAlign': 'center'}),
-            # download_deseq_results,
-            download_deseq_results_component,            
-            dbc.Col(conditions_table)
-        ]),
-        html.Br(),
-        html.Br(),
-        html.H5("Volcano Plot", style={'textAlign': 'center'}),
-        html.Hr(),  # Divider line
-        dbc.Row([
-            dcc.Loading(html.Div([
-                'Effect Sizes',
-                html.Br(),
-                dcc.RangeSlider(
-                    id='range-slider',
-                    min=-10,
-                    max=10,
-                    step=0.05,
-                    marks={i: {'label': str(i)} for i in range(-10, 11)},
-                    value=[-1, 1]
-                ),
-                html.Br(),
-                dcc.Graph(
-                    id='de_volcano_plot',
-                    style={'height': '800px'}
-                )
-            ]))
-        ]),
-    ],
-    style={'margin': 0},
-)
+                dbc.Col(heatmap_metric_select, width='auto'),
+                dbc.Col(heatmap_size_select, width='auto')
+            ], justify='center', align='center'),
+            html.Br(),
+            dbc.Row([
+                # Variance stabilised counts of the top genes, clustered by gene and by sample
+                dcc.Loading(dcc.Graph(id='de_heatmap'))
+            ]),
+            html.Br(),
+            html.Br(),
+            html.H5("Gene Set Enrichment", style={'textAlign': 'center'}),
+            html.Hr(),  # Divider line
+            dbc.Row([
+                dbc.Col(enrichment_direction_select, width='auto'),
+                dbc.Col(enrichment_padj_select, width='auto')
+            ], justify='center', align='center'),
+            html.Div(id='enrichment-summary', style={'textAlign': 'center', 'font-size': 'small'}),
+            html.Br(),
+            dbc.Row([
+                # Over-representation of the GMT gene sets among the genes beyond the volcano effect size lines
+                enrichment_table
+            ]),
+            html.Br(),
+            html.Br(),
+            html.H5("Robustness", style={'textAlign': 'center'}),
+            html.Hr(),  # Divider line
+            html.Div('Runs the selected design again without each sample, or on random subsets of the samples of every condition, '
+                     'with the engine and filter above. Genes count as significant beyond the volcano effect size lines.',
+                     style={'textAlign': 'center', 'font-size': 'small'}),
+            html.Br(),
+            dbc.Row([
+                dbc.Col(sweep_mode_select, width='auto'),
+                dbc.Col(sweep_subsets_input, width='auto'),
+                dbc.Col([start_sweep_btn, cancel_sweep_btn], width='auto')
+            ], justify='center', align='center'),
+            html.Div(id='sweep-output', style={'textAlign': 'center', 'font-size': 'small', 'marginTop': '10px'}),
+            # Job of the running sweep, the timer polling it and the stored results of every contrast
+            dcc.Store(id='sweep-job', storage_type='memory'),
+            dcc.Interval(id='sweep-poll', interval=1000, disabled=True),
+            dcc.Store(id='sweep-results', storage_type='memory'),
+            html.Div(id='stability-summary', style={'textAlign': 'center', 'font-size': 'small'}),
+            html.Br(),
+            dbc.Row([
+                # Genes significant with all samples or in any subset, for the contrast shown above
+                stability_table
+            ]),
+        ],
+        style={'margin': 0},
+    )
+
+
+app.layout = serve_layout
+warmup.add('layout', serve_layout)
 
 
 ############################################################################################################################
@@ -253,7 +517,18 @@ app.layout = html.Div(
 # Calling the callback functions from /utils/pages
 upload_functions()
 
-de_functions()    
+de_functions()
+
+# Routes streaming the exported DE results and receiving chunked uploads
+register_export_route(app.server)
+register_upload_routes(app.server)
+# Callback and DE engine metrics on /metrics
+register_metrics(app)
+# Readiness of the background warm-up on /ready
+register_readiness_route(app.server)
+
+# WSGI entry point for running several server processes, e.g. `gunicorn -c gunicorn.conf.py app:server`
+server = app.server
 
 ###################################################################################
 
@@ -262,4 +537,7 @@ de_functions()
 
 
 if __name__ == "__main__":
+    # Warm-up of the process serving the app, not of the debug reloader watching the files
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        warmup.start()
     app.run_server(debug=True, host='127.0.0.1', port=6688)
\ No newline at end of file
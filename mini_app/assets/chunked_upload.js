@@ -0,0 +1,103 @@
+// Chunked, resumable upload of large count tables (see utils/helper_functions/chunked_upload.py).
+// The file picked through #chunked-upload-button is sent in CHUNK_SIZE pieces. A failed chunk is retried
+// from the offset the server reports, and an interrupted upload of the same file resumes after a reload.
+// The result is handed to Dash through the chunked-upload-result store.
+(function () {
+    const UPLOAD_ROUTE = '/upload/chunked';
+    const CHUNK_SIZE = 4 * 1024 * 1024;
+    const MAX_RETRIES = 5;
+
+    function setProps(id, props) {
+        window.dash_clientside.set_props(id, props);
+    }
+
+    function resumeKey(file) {
+        return `chunked-upload:${file.name}:${file.size}:${file.lastModified}`;
+    }
+
+    async function requestJson(url, options) {
+        const response = await fetch(url, options);
+        const reply = await response.json();
+        if (!response.ok && response.status !== 409) {
+            // Validation errors are final, retrying would not help
+            const error = new Error(reply.error || `Upload failed (${response.status})`);
+            error.final = true;
+            throw error;
+        }
+        return reply;
+    }
+
+    async function startOrResume(file) {
+        const uploadId = window.localStorage.getItem(resumeKey(file));
+        if (uploadId) {
+            try {
+                const status = await requestJson(`${UPLOAD_ROUTE}/${uploadId}`);
+                return {uploadId: uploadId, received: status.received};
+            } catch (e) {
+                window.localStorage.removeItem(resumeKey(file));
+            }
+        }
+        const reply = await requestJson(UPLOAD_ROUTE, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({filename: file.name, size: file.size})
+        });
+        window.localStorage.setItem(resumeKey(file), reply.upload_id);
+        return {uploadId: reply.upload_id, received: 0};
+    }
+
+    async function uploadFile(file) {
+        try {
+            let {uploadId, received} = await startOrResume(file);
+            let retries = 0;
+            while (received < file.size) {
+                setProps('chunked-upload-status', {children: `Uploading ${file.name}: ${Math.floor(100 * received / file.size)}%`});
+                try {
+                    const reply = await requestJson(`${UPLOAD_ROUTE}/${uploadId}?offset=${received}`, {
+                        method: 'PUT',
+                        body: file.slice(received, received + CHUNK_SIZE)
+                    });
+                    received = reply.received;
+                    retries = 0;
+                } catch (e) {
+                    if (e.final || ++retries > MAX_RETRIES) {
+                        throw e;
+                    }
+                    await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+                    received = (await requestJson(`${UPLOAD_ROUTE}/${uploadId}`)).received;
+                }
+            }
+            setProps('chunked-upload-status', {children: `Reading ${file.name}...`});
+            const result = await requestJson(`${UPLOAD_ROUTE}/${uploadId}/complete`, {method: 'POST'});
+            window.localStorage.removeItem(resumeKey(file));
+            if (result.error) {
+                throw new Error(result.error);
+            }
+            setProps('chunked-upload-status', {children: ''});
+            setProps('chunked-upload-result', {data: {key: result.key, filename: result.filename}});
+        } catch (e) {
+            if (e.final) {
+                window.localStorage.removeItem(resumeKey(file));
+            }
+            setProps('chunked-upload-status', {children: ''});
+            setProps('chunked-upload-result', {data: {error: e.message, filename: file.name}});
+        }
+    }
+
+    // The Dash button only opens a file picker, the file never goes through a callback
+    document.addEventListener('click', function (event) {
+        const button = event.target.closest && event.target.closest('#chunked-upload-button');
+        if (!button) {
+            return;
+        }
+        const input = document.createElement('input');
+        input.type = 'file';
+        input.accept = button.dataset.accept || '';
+        input.addEventListener('change', function () {
+            if (input.files.length) {
+                uploadFile(input.files[0]);
+            }
+        });
+        input.click();
+    });
+})();
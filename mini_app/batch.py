@@ -0,0 +1,211 @@
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from utils.helper_functions.count_table import read_count_file
+from utils.helper_functions.pre_analysis import filter_count_matrix, MIN_COUNT, MIN_SAMPLES
+from utils.helper_functions.de_pipeline import (design_contrasts, parse_contrast, contrast_label,
+                                                python_engine_results, run_r_engine, CONTRAST_MODES)
+from utils.helper_functions.export import write_export, EXPORT_FORMATS
+from utils.helper_functions.r_worker_pool import RWorkerPool
+
+# Headless batch runs of the DE pipeline, without the Dash app.
+# Every row of the manifest is one dataset, run through the same count table validation,
+# low count filter and DE engines as the app, with the datasets spread over worker processes.
+#
+#   python batch.py manifest.tsv --output batch_results --workers 8
+#
+# Manifest columns (tab separated, or comma separated for .csv files):
+#   count_file       count table in any format the app accepts
+#   conditions_file  sample sheet with 'Samples' and 'Conditions' columns
+#   contrast         optional: 'A vs B' contrasts separated by ';', or 'reference' / 'pairwise'
+#                    over the levels in the order they first appear in the sample sheet (default 'reference')
+#   name             optional: name of the output directory, defaults to the count file name
+# Relative paths are read relative to the manifest. Each dataset's results go to <output>/<name>/
+# and <output>/summary.tsv lists every dataset with its status, outputs and per-step timings.
+
+SUMMARY_FILE = 'summary.tsv'
+SUMMARY_COLUMNS = ['name', 'status', 'error', 'count_file', 'conditions_file', 'contrasts', 'samples',
+                   'genes', 'genes_tested', 'outputs', 'read_s', 'filter_s', 'de_s', 'write_s', 'total_s']
+
+# R workers of this process, started on the first R job
+_r_worker_pool = None
+
+
+def _table_separator(path):
+    return ',' if path.lower().endswith('.csv') else '\t'
+
+
+def read_manifest(path):
+    """
+    Reads the manifest into a list of job dicts with absolute paths and unique names.
+    """
+    manifest = pd.read_csv(path, sep=_table_separator(path), dtype=str, keep_default_na=False)
+    missing = {'count_file', 'conditions_file'} - set(manifest.columns)
+    if missing:
+        raise ValueError(f"The manifest is missing the column(s) {', '.join(sorted(missing))}.")
+
+    base = os.path.dirname(os.path.abspath(path))
+    jobs, names = [], set()
+    for row in manifest.to_dict('records'):
+        name = row.get('name') or os.path.basename(row['count_file']).split('.')[0]
+        name = re.sub(r'[^\w.-]+', '_', name)
+        unique_name, n = name, 1
+        while unique_name in names:
+            n += 1
+            unique_name = f'{name}_{n}'
+        names.add(unique_name)
+        jobs.append({
+            'name': unique_name,
+            'count_file': os.path.join(base, row['count_file']),
+            'conditions_file': os.path.join(base, row['conditions_file']),
+            'contrast': row.get('contrast', '').strip(),
+        })
+    return jobs
+
+
+def read_conditions(path):
+    """
+    Sample sheet with 'Samples' and 'Conditions' columns, samples without a condition are left out.
+    """
+    conditions = pd.read_csv(path, sep=_table_separator(path), dtype=str, keep_default_na=False)
+    if not {'Samples', 'Conditions'} <= set(conditions.columns):
+        raise ValueError(f"{os.path.basename(path)} needs 'Samples' and 'Conditions' columns.")
+    conditions = conditions[['Samples', 'Conditions']].apply(lambda column: column.str.strip())
+    conditions = conditions[~conditions['Conditions'].isin(['', 'None'])].reset_index(drop=True)
+    if conditions['Samples'].duplicated().any():
+        raise ValueError(f'{os.path.basename(path)} lists a sample more than once.')
+    return conditions
+
+
+def job_contrasts(contrast, conditions):
+    """
+    (numerator, denominator) contrasts of a manifest row, checked against the sample sheet.
+    """
+    levels = list(dict.fromkeys(conditions['Conditions']))
+    if contrast in ('',) + CONTRAST_MODES:
+        contrasts = design_contrasts(levels, contrast or 'reference')
+    else:
+        contrasts = [parse_contrast(label) for label in contrast.split(';') if label.strip()]
+    if not contrasts:
+        raise ValueError('The sample sheet needs samples of at least two conditions.')
+    for level in {level for pair in contrasts for level in pair}:
+        if level not in levels:
+            raise ValueError(f'No samples of condition {level} in the sample sheet.')
+    return contrasts
+
+
+def _r_pool():
+    global _r_worker_pool
+    if _r_worker_pool is None:
+        # One warm worker per batch process, it quits when the process closes its pipes
+        _r_worker_pool = RWorkerPool(size=1)
+        _r_worker_pool.start()
+    return _r_worker_pool
+
+
+def run_job(job, output_dir, engine='python', min_count=MIN_COUNT, min_samples=MIN_SAMPLES, fmt='csv'):
+    """
+    Runs one manifest row and returns its summary row. Errors are reported in the row, not raised.
+    """
+    summary = {'name': job['name'], 'count_file': job['count_file'], 'conditions_file': job['conditions_file'],
+               'status': 'failed', 'error': ''}
+    start_time = step_time = time.perf_counter()
+
+    def _lap(step):
+        nonlocal step_time
+        now = time.perf_counter()
+        summary[f'{step}_s'] = round(now - step_time, 3)
+        step_time = now
+
+    try:
+        count_matrix = read_count_file(job['count_file'])
+        conditions_table = read_conditions(job['conditions_file'])
+        contrasts = job_contrasts(job['contrast'], conditions_table)
+        summary['contrasts'] = ';'.join(contrast_label(contrast) for contrast in contrasts)
+        summary['samples'] = len(conditions_table)
+        summary['genes'] = count_matrix.shape[0]
+        _lap('read')
+
+        filtered = filter_count_matrix(count_matrix, conditions_table['Samples'], min_count, min_samples)
+        summary['genes_tested'] = filtered.shape[0]
+        _lap('filter')
+
+        if engine == 'python':
+            # Datasets already run in parallel, so the contrasts of one dataset are not spread over threads
+            de_dfs = python_engine_results(filtered, conditions_table, contrasts, max_workers=1)
+        else:
+            with tempfile.TemporaryDirectory(prefix='de-batch-') as workdir:
+                de_dfs = run_r_engine(filtered, conditions_table, contrasts, workdir, _r_pool())
+        _lap('de')
+
+        job_dir = os.path.join(output_dir, job['name'])
+        os.makedirs(job_dir, exist_ok=True)
+        outputs = []
+        for contrast, de_df in zip(contrasts, de_dfs):
+            filename = re.sub(r'[^\w.-]+', '_', contrast_label(contrast)) + '.' + EXPORT_FORMATS[fmt]['extension']
+            write_export(de_df, fmt, os.path.join(job_dir, filename))
+            outputs.append(os.path.join(job['name'], filename))
+        summary['outputs'] = ';'.join(outputs)
+        _lap('write')
+        summary['status'] = 'ok'
+    except Exception as e:
+        summary['error'] = str(e) or type(e).__name__
+    summary['total_s'] = round(time.perf_counter() - start_time, 3)
+    return summary
+
+
+def run_batch(jobs, output_dir, workers=os.cpu_count(), **options):
+    """
+    Runs all jobs over `workers` processes, writes the summary manifest and returns its rows.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    summaries = [None] * len(jobs)
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(jobs) or 1))) as executor:
+        futures = {executor.submit(run_job, job, output_dir, **options): i for i, job in enumerate(jobs)}
+        for done, future in enumerate(as_completed(futures), 1):
+            summary = future.result()
+            summaries[futures[future]] = summary
+            status = summary['status'] if summary['status'] == 'ok' else f"failed: {summary['error']}"
+            print(f"[{done}/{len(jobs)}] {summary['name']} {status} ({summary['total_s']:.1f} s)", flush=True)
+
+    summary_df = pd.DataFrame(summaries).reindex(columns=SUMMARY_COLUMNS)
+    # Failed datasets leave the counts empty, keep the others as integers
+    summary_df[['samples', 'genes', 'genes_tested']] = summary_df[['samples', 'genes', 'genes_tested']].astype('Int64')
+    summary_df.to_csv(os.path.join(output_dir, SUMMARY_FILE), sep='\t', index=False)
+    return summaries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the DE pipeline over every dataset of a manifest.')
+    parser.add_argument('manifest', help='TSV/CSV with count_file, conditions_file and optional contrast, name columns')
+    parser.add_argument('-o', '--output', default='batch_results', help='output directory (default: batch_results)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='worker processes (default: all cores)')
+    parser.add_argument('--engine', choices=['python', 'r'], default='python', help='DE engine (default: python)')
+    parser.add_argument('--min-count', type=int, default=MIN_COUNT, help=f'low count filter (default: {MIN_COUNT})')
+    parser.add_argument('--min-samples', type=int, default=MIN_SAMPLES, help=f'low count filter (default: {MIN_SAMPLES})')
+    parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='csv', help='result file format (default: csv)')
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = read_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    start_time = time.perf_counter()
+    summaries = run_batch(jobs, args.output, args.workers, engine=args.engine, min_count=args.min_count,
+                          min_samples=args.min_samples, fmt=args.format)
+    failed = sum(summary['status'] != 'ok' for summary in summaries)
+    print(f'{len(summaries) - failed} of {len(summaries)} datasets done in {time.perf_counter() - start_time:.1f} s, '
+          f'summary in {os.path.join(args.output, SUMMARY_FILE)}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
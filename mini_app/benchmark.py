@@ -0,0 +1,297 @@
+import argparse
+import base64
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Results and caches of a benchmark run go to a scratch directory, not to the app's cache
+SCRATCH_DIR = tempfile.mkdtemp(prefix='de-benchmark-')
+os.environ.setdefault('DATASET_CACHE_DIR', os.path.join(SCRATCH_DIR, 'datasets'))
+os.environ.setdefault('APP_REGISTRY_PATH', os.path.join(SCRATCH_DIR, 'registry.sqlite3'))
+os.environ.setdefault('METRICS_DIR', os.path.join(SCRATCH_DIR, 'metrics'))
+os.environ.setdefault('DATASET_CACHE_MEMORY_MB', '4096')
+
+import numpy as np
+import pandas as pd
+from plotly.utils import PlotlyJSONEncoder
+
+from utils.helper_functions.count_table import CountTableValidator, parse_count_table
+from utils.helper_functions.dataset_store import DatasetStore, dataset_store
+from utils.helper_functions.pre_analysis import filter_count_matrix
+from utils.helper_functions.de_pipeline import python_engine_results
+from utils.helper_functions.table_backend import result_table
+from utils.helper_functions.gene_index import gene_index
+from utils.helper_functions.export import write_export
+from utils.helper_functions.volcano import volcano_arrays, webgl_volcano_figure
+from utils.helper_functions.synthetic_counts import synthetic_counts
+
+# Benchmarks of the hot paths of the app on seeded synthetic count tables.
+# Every step is timed on its own (best of --repeat runs), then run once more under tracemalloc
+# for its peak memory. Results are written to a JSON file, and a saved run can be given as a
+# baseline to fail on steps that became slower or use more memory.
+# The startup of a fresh server process is timed as well: until app.py is imported (the server
+# could listen) and until its background warm-up finished (/ready answers 200).
+#
+#   python benchmark.py --output benchmark_results.json
+#   python benchmark.py --full --baseline benchmark_baseline.json
+
+DEFAULT_SIZES = [(1000, 4), (20000, 12), (60000, 24)]
+FULL_SIZES = [(genes, samples) for genes in (1000, 20000, 60000) for samples in (4, 50, 500)]
+TOLERANCE = 0.2
+# Differences below these are noise, whatever the relative change
+MIN_TIME_DELTA = 0.02
+MIN_MEMORY_DELTA_MB = 5
+# Low count filter of the filter step, the app runs without it unless it is set
+FILTER_MIN_COUNT = 10
+FILTER_MIN_SAMPLES = 2
+# Run in a fresh interpreter, prints the times at which the app was imported and warmed up
+STARTUP_SCRIPT = '''
+import time
+import app
+from utils.helper_functions.warmup import warmup
+imported = time.time()
+warmup.start()
+warmup.wait()
+print(imported, time.time())
+'''
+
+
+class BenchmarkCase:
+    """
+    One synthetic dataset and the steps of the app run on it, in pipeline order.
+    Steps only read what earlier steps produced, so each of them can be repeated.
+    """
+    STEPS = ['upload_parse', 'validate', 'store_roundtrip', 'filter', 'de_run', 'results_table', 'gene_search',
+             'csv_export', 'volcano']
+
+    def __init__(self, n_genes, n_samples, seed=0):
+        self.n_genes = n_genes
+        self.n_samples = n_samples
+        df, self.conditions_table = synthetic_counts(n_genes, n_samples, seed)
+        self.csv_bytes = df.to_csv(index=False).encode()
+        # What dcc.Upload hands to update_output
+        self.upload_contents = 'data:text/csv;base64,' + base64.b64encode(self.csv_bytes).decode()
+        self.count_matrix = None
+        self.filtered = None
+        self.result_key = None
+
+    def upload_parse(self):
+        # Decoding and parsing as in update_output
+        content_string = self.upload_contents.split(',')[1]
+        self.count_matrix = parse_count_table(base64.b64decode(content_string), 'counts.csv')
+
+    def validate(self):
+        validator = CountTableValidator('counts.csv')
+        validator.feed(self.csv_bytes)
+        validator.finish()
+
+    def store_roundtrip(self):
+        # Writing the matrix to a store and loading it back in a fresh store, as another worker would
+        root = tempfile.mkdtemp(dir=SCRATCH_DIR)
+        try:
+            key = DatasetStore(root=root).put(self.count_matrix)
+            DatasetStore(root=root).get(key).array().sum()
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+    def filter(self):
+        self.filtered = filter_count_matrix(self.count_matrix, self.conditions_table['Samples'],
+                                            FILTER_MIN_COUNT, FILTER_MIN_SAMPLES)
+
+    def de_run(self):
+        # Built-in engine run and stored like de_job does
+        de_df = python_engine_results(self.filtered, self.conditions_table, [('Control', 'Treatment')])[0]
+        self.result_key = dataset_store.put(de_df)
+
+    def results_table(self):
+        # First page of the results sorted by padj, built without the result_table cache
+        table = result_table.__wrapped__(self.result_key)
+        table.page(0, 20, [{'column_id': 'padj', 'direction': 'asc'}], '')
+
+    def gene_search(self):
+        # Building the gene index and typing a gene ID into the search, one lookup per keystroke
+        gene_index.cache_clear()
+        index = gene_index(self.result_key)
+        gene = f'GENE{self.n_genes // 2:06d}'
+        for n in range(1, len(gene) + 1):
+            index.search(gene[:n])
+
+    def csv_export(self):
+        path = os.path.join(SCRATCH_DIR, 'export.csv')
+        write_export(dataset_store.get(self.result_key), 'csv', path)
+        os.remove(path)
+
+    def volcano(self):
+        # WebGL figure and its JSON encoding as sent to the browser
+        volcano_arrays.cache_clear()
+        json.dumps(webgl_volcano_figure(self.result_key, [-1, 1]), cls=PlotlyJSONEncoder)
+
+
+def measure(fn, repeat=1, memory=True):
+    """
+    Returns (best wall time in seconds, peak traced memory in MB or None) of fn().
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start_time = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start_time)
+    peak = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            fn()
+            peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        finally:
+            tracemalloc.stop()
+    return min(times), peak
+
+
+def measure_startup(repeat=1):
+    """
+    Best times in seconds from launching a server process until app.py is imported and until
+    the warm-up finished, as (import_s, ready_s).
+    """
+    import_times, ready_times = [], []
+    for _ in range(repeat):
+        start_time = time.time()
+        process = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], capture_output=True, text=True, check=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+        imported, ready = map(float, process.stdout.split()[-2:])
+        import_times.append(imported - start_time)
+        ready_times.append(ready - start_time)
+    return min(import_times), min(ready_times)
+
+
+def run_benchmarks(sizes, steps=BenchmarkCase.STEPS, repeat=1, memory=True, seed=0):
+    """
+    Runs the steps on a synthetic dataset of every (genes, samples) size and returns one record per step.
+    """
+    records = []
+    for n_genes, n_samples in sizes:
+        case = BenchmarkCase(n_genes, n_samples, seed)
+        for step in BenchmarkCase.STEPS:
+            run = getattr(case, step)
+            if step not in steps:
+                # Later steps still need its output
+                run()
+                continue
+            wall, peak = measure(run, repeat, memory)
+            records.append({'genes': n_genes, 'samples': n_samples, 'step': step, 'wall_s': round(wall, 4),
+                            'peak_mb': None if peak is None else round(peak, 1)})
+            peak_text = '' if peak is None else f', peak {peak:.1f} MB'
+            print(f'{n_genes:>6} genes x {n_samples:>3} samples  {step:<16} {wall:8.3f} s{peak_text}', flush=True)
+    return records
+
+
+def startup_records(repeat=1):
+    """
+    The startup times of measure_startup() as records without a dataset size.
+    """
+    import_s, ready_s = measure_startup(repeat)
+    records = []
+    for step, wall in (('startup_import', import_s), ('startup_ready', ready_s)):
+        records.append({'genes': None, 'samples': None, 'step': step, 'wall_s': round(wall, 4), 'peak_mb': None})
+        print(f'{"server process":>27}  {step:<16} {wall:8.3f} s', flush=True)
+    return records
+
+
+def compare(records, baseline, tolerance=TOLERANCE):
+    """
+    Regressions of records against the records of a baseline run, as readable lines.
+    """
+    previous = {(r['genes'], r['samples'], r['step']): r for r in baseline['results']}
+    regressions = []
+    for record in records:
+        base = previous.get((record['genes'], record['samples'], record['step']))
+        if base is None:
+            continue
+        name = record['step']
+        if record['genes'] is not None:
+            name = f"{name} ({record['genes']} genes x {record['samples']} samples)"
+        if (record['wall_s'] > base['wall_s'] * (1 + tolerance)
+                and record['wall_s'] - base['wall_s'] > MIN_TIME_DELTA):
+            regressions.append(f"{name}: {base['wall_s']:.3f} s -> {record['wall_s']:.3f} s")
+        if (record['peak_mb'] is not None and base.get('peak_mb') is not None
+                and record['peak_mb'] > base['peak_mb'] * (1 + tolerance)
+                and record['peak_mb'] - base['peak_mb'] > MIN_MEMORY_DELTA_MB):
+            regressions.append(f"{name}: peak {base['peak_mb']:.1f} MB -> {record['peak_mb']:.1f} MB")
+    return regressions
+
+
+def _parse_sizes(text):
+    sizes = []
+    for size in text.split(','):
+        genes, _, samples = size.strip().lower().partition('x')
+        sizes.append((int(genes), int(samples)))
+    return sizes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of the app on synthetic count tables.')
+    parser.add_argument('--sizes', type=_parse_sizes, default=DEFAULT_SIZES,
+                        help='comma separated GENESxSAMPLES sizes (default: 1000x4,20000x12,60000x24)')
+    parser.add_argument('--full', action='store_true', help='1k, 20k and 60k genes x 4, 50 and 500 samples')
+    parser.add_argument('--steps', default=','.join(BenchmarkCase.STEPS), help='comma separated steps to time')
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs per step, the best is kept (default: 1)')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory measurement')
+    parser.add_argument('--no-startup', action='store_true', help='skip timing the startup of a server process')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='results file')
+    parser.add_argument('--baseline', help='results file of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help=f'allowed relative slowdown or memory growth (default: {TOLERANCE})')
+    args = parser.parse_args(argv)
+
+    steps = [step.strip() for step in args.steps.split(',') if step.strip()]
+    unknown = set(steps) - set(BenchmarkCase.STEPS)
+    if unknown:
+        parser.error(f"Unknown step(s) {', '.join(sorted(unknown))}, choose from {', '.join(BenchmarkCase.STEPS)}")
+
+    try:
+        records = [] if args.no_startup else startup_records(max(args.repeat, 1))
+        records += run_benchmarks(FULL_SIZES if args.full else args.sizes, steps, max(args.repeat, 1),
+                                 not args.no_memory, args.seed)
+    finally:
+        shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+
+    results = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeat': max(args.repeat, 1),
+            'seed': args.seed,
+        },
+        'results': records,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(records, json.load(f), args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} regression(s) against {args.baseline}:')
+            for regression in regressions:
+                print(f'  {regression}')
+            return 1
+        print(f'No regressions against {args.baseline}.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,22 @@
+import os
+
+# Gunicorn settings for serving the app with several processes (see README, "Production serving"):
+#   gunicorn -c gunicorn.conf.py app:server
+# Every worker process has its own R worker pool and DE job threads, they share the jobs,
+# the result index and the uploaded datasets through the files under utils/outputs/cache.
+
+bind = os.environ.get('APP_BIND', '127.0.0.1:6688')
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+# Threads let a worker answer progress polls while it handles an upload or a large response
+worker_class = 'gthread'
+threads = int(os.environ.get('APP_THREADS', 4))
+# Long DE runs happen in job threads, not in requests, so requests only wait for uploads and exports
+timeout = int(os.environ.get('APP_REQUEST_TIMEOUT', 120))
+# The app is imported in each worker, so R pools and job threads are not started before the fork
+preload_app = False
+
+
+# Warm-up of each worker once the app is loaded, its state is reported on /ready
+def post_worker_init(worker):
+    from utils.helper_functions.warmup import warmup
+    warmup.start()
@@ -0,0 +1,42 @@
+import os
+import time
+
+import pytest
+
+from utils.helper_functions import chunked_upload
+from utils.helper_functions.chunked_upload import ChunkedUploadManager, STALE_UPLOAD_AGE
+
+CHUNK = b'GeneID,S1,S2\ng1,1,2\n'
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setattr(chunked_upload, 'UPLOAD_DIR', str(tmp_path))
+    return ChunkedUploadManager()
+
+
+def _age(path, seconds):
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def test_upload_with_recent_data_is_kept(manager):
+    upload = manager.start('counts.csv', 2 * len(CHUNK))
+    # Metadata written when the upload started long ago, data appended just now
+    _age(upload.meta_path, STALE_UPLOAD_AGE + 60)
+    with upload.locked():
+        upload.append(0, CHUNK)
+    manager._remove_stale()
+    assert os.path.exists(upload.path) and os.path.exists(upload.meta_path)
+    assert manager.get(upload.upload_id) is upload
+
+
+def test_stale_upload_is_removed_with_its_metadata(manager):
+    upload = manager.start('counts.csv', 2 * len(CHUNK))
+    with upload.locked():
+        upload.append(0, CHUNK)
+    _age(upload.path, STALE_UPLOAD_AGE + 60)
+    manager._remove_stale()
+    assert not os.path.exists(upload.path) and not os.path.exists(upload.meta_path)
+    with pytest.raises(chunked_upload.UploadError):
+        manager.get(upload.upload_id)
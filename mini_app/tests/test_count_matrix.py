@@ -0,0 +1,24 @@
+import pandas as pd
+import pytest
+
+from utils.helper_functions.count_matrix import CountMatrix, CountMatrixError
+
+
+def test_from_frame():
+    matrix = CountMatrix.from_frame(pd.DataFrame({'GeneID': ['g1', 'g2'], 'S1': [1, 2], 'S2': [3.0, 4.0]}))
+    assert matrix.shape == (2, 2)
+    assert list(matrix.genes) == ['g1', 'g2']
+    assert matrix.samples == ['S1', 'S2']
+
+
+def test_from_frame_rejects_duplicate_genes():
+    df = pd.DataFrame({'GeneID': ['g1', 'g2', 'g1', 'g3', 'g2', 'g1'], 'S1': range(6)})
+    with pytest.raises(CountMatrixError, match='duplicated: g1, g2.$'):
+        CountMatrix.from_frame(df)
+
+
+def test_from_frame_rejects_invalid_counts():
+    with pytest.raises(CountMatrixError):
+        CountMatrix.from_frame(pd.DataFrame({'GeneID': ['g1', 'g2'], 'S1': [1, -2]}))
+    with pytest.raises(CountMatrixError):
+        CountMatrix.from_frame(pd.DataFrame({'GeneID': ['g1', 'g2'], 'S1': [1, 2.5]}))
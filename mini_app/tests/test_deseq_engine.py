@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.helper_functions.count_matrix import CountMatrix
+from utils.helper_functions.deseq_engine import run_deseq, RESULT_COLUMNS
+from utils.helper_functions.synthetic_counts import synthetic_counts
+
+# The built-in engine against the DESeq2 results checked in with the app (DGE_deseq2.r on df_de.csv).
+# The tolerances are a few times the differences seen when the engine was written, tight enough to
+# catch a changed estimation step.
+
+DESEQ_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'utils', 'outputs', 'DESEQ')
+# (rtol, atol) per result column
+TOLERANCES = {
+    'baseMean': (1e-9, 0),
+    'log2FoldChange': (1e-4, 1e-4),
+    'lfcSE': (1e-3, 0),
+    'stat': (1e-3, 1e-3),
+    'pvalue': (1e-3, 5e-4),
+    'padj': (1e-5, 1e-5),
+}
+
+
+@pytest.fixture(scope='module')
+def deseq_results():
+    counts = pd.read_csv(os.path.join(DESEQ_DIR, 'df_de.csv'))
+    conditions_table = pd.read_csv(os.path.join(DESEQ_DIR, 'conditions_table.tsv'), sep='\t')
+    expected = pd.read_csv(os.path.join(DESEQ_DIR, 'de_out.csv'), index_col=0)
+    result = run_deseq(CountMatrix.from_frame(counts), conditions_table, 'Control', [('Control', 'Treatment')])[0]
+    return result, expected
+
+
+def test_same_genes_as_deseq2(deseq_results):
+    result, expected = deseq_results
+    assert list(result.index) == list(expected.index)
+    assert list(result.columns) == RESULT_COLUMNS
+
+
+@pytest.mark.parametrize('column', RESULT_COLUMNS)
+def test_matches_deseq2(deseq_results, column):
+    result, expected = deseq_results
+    rtol, atol = TOLERANCES[column]
+    np.testing.assert_allclose(result[column].to_numpy(dtype=float), expected[column].to_numpy(dtype=float),
+                               rtol=rtol, atol=atol, equal_nan=True)
+
+
+def test_missing_values_match_deseq2(deseq_results):
+    # Genes without counts have no test, as in DESeq2
+    result, expected = deseq_results
+    for column in RESULT_COLUMNS:
+        np.testing.assert_array_equal(result[column].isna().to_numpy(), expected[column].isna().to_numpy())
+
+
+def test_independent_filtering_removes_low_means():
+    # Many DE genes and many low count null genes, so the filter picks a mean cutoff.
+    # The genes below it keep their p-value but get no padj, as in DESeq2's results()
+    df, conditions_table = synthetic_counts(2000, 6, de_fraction=0.2, fold_change=4.0)
+    low = pd.DataFrame(np.random.default_rng(0).poisson(1.0, (3000, 6)).astype(np.uint32), columns=df.columns[1:])
+    low.insert(0, 'GeneID', [f'LOW{i + 1:06d}' for i in range(3000)])
+    df = pd.concat([df, low], ignore_index=True)
+    result = run_deseq(CountMatrix.from_frame(df), conditions_table, 'Control', [('Control', 'Treatment')])[0]
+    filtered = result['pvalue'].notna() & result['padj'].isna()
+    kept = result['padj'].notna()
+    assert filtered.sum() > 1000
+    assert result.loc[filtered, 'baseMean'].max() <= result.loc[kept, 'baseMean'].min()
+
+
+def test_cooks_outlier_has_no_pvalue():
+    # One extreme count among three replicates flags the gene, its p-value and padj are removed
+    df, conditions_table = synthetic_counts(1000, 6)
+    gene = int(np.argmax(df.iloc[:, 1:].median(axis=1) > 50))
+    df.iloc[gene, 1] = df.iloc[gene, 1:].max() * 100
+    result = run_deseq(CountMatrix.from_frame(df), conditions_table, 'Control', [('Control', 'Treatment')])[0]
+    assert np.isnan(result['pvalue'].iloc[gene]) and np.isnan(result['padj'].iloc[gene])
+    assert not np.isnan(result['log2FoldChange'].iloc[gene])
+    assert result['pvalue'].notna().sum() > 900
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.helper_functions.table_backend import ResultTable, parse_filter_query
+
+# Server-side filtering of the DE result table, on the query strings DataTable emits with filter_action="custom".
+# DataTable prefixes the operators with 's' or 'i' following the case toggle of the filter cell.
+
+
+@pytest.fixture
+def table():
+    return ResultTable(pd.DataFrame({
+        'GeneID': ['ENSG01', 'ensg02', 'ENSG03', 'Xist'],
+        'log2FoldChange': [2.5, -1.5, 0.2, 3.0],
+        'padj': [0.001, 0.04, 0.5, np.nan],
+    }))
+
+
+def _genes(table, filter_query):
+    records, _ = table.page(page_size=10, filter_query=filter_query)
+    return sorted(record['GeneID'] for record in records)
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('{GeneID} scontains ENSG', [('GeneID', 'contains', 'ENSG', True)]),
+    ('{GeneID} icontains ensg', [('GeneID', 'contains', 'ensg', False)]),
+    ('{GeneID} contains ENSG', [('GeneID', 'contains', 'ENSG', True)]),
+    ('{padj} s< 0.05', [('padj', '<', '0.05', True)]),
+    ('{padj} i<= 0.05', [('padj', '<=', '0.05', False)]),
+    ('{log2FoldChange} s> 1', [('log2FoldChange', '>', '1', True)]),
+    ('{GeneID} seq "Xist"', [('GeneID', '=', 'Xist', True)]),
+    ('{GeneID} ine xist', [('GeneID', '!=', 'xist', False)]),
+    ('{GeneID} s= Xist', [('GeneID', '=', 'Xist', True)]),
+    ('{padj} is blank', [('padj', 'blank', None, True)]),
+    ('{padj} s< 0.05 && {GeneID} icontains ensg',
+     [('padj', '<', '0.05', True), ('GeneID', 'contains', 'ensg', False)]),
+])
+def test_parse_filter_query(query, expected):
+    assert parse_filter_query(query) == expected
+
+
+def test_unsupported_filter():
+    with pytest.raises(ValueError):
+        parse_filter_query('{GeneID} matches ENSG')
+
+
+def test_contains_follows_case(table):
+    assert _genes(table, '{GeneID} scontains ENSG') == ['ENSG01', 'ENSG03']
+    assert _genes(table, '{GeneID} icontains ENSG') == ['ENSG01', 'ENSG03', 'ensg02']
+
+
+def test_equality_follows_case(table):
+    assert _genes(table, '{GeneID} seq xist') == []
+    assert _genes(table, '{GeneID} ieq xist') == ['Xist']
+    assert _genes(table, '{GeneID} i= XIST') == ['Xist']
+    assert _genes(table, '{GeneID} ine XIST') == ['ENSG01', 'ENSG03', 'ensg02']
+
+
+def test_numeric_and_combined_filters(table):
+    assert _genes(table, '{padj} s< 0.05') == ['ENSG01', 'ensg02']
+    assert _genes(table, '{log2FoldChange} i> 1') == ['ENSG01', 'Xist']
+    assert _genes(table, '{padj} is blank') == ['Xist']
+    assert _genes(table, '{padj} s< 0.05 && {GeneID} icontains ENSG02') == ['ensg02']
@@ -1,4 +1,8 @@
 
+# Standalone DESeq2 run of one contrast, the original analysis of the app.
+# The app runs deseq_worker.r on its pool of warm R workers instead. This script is kept to regenerate
+# the reference results in utils/outputs/DESEQ/de_out.csv that the built-in engine is tested against.
+
 library("DESeq2")
 
 argument = commandArgs(trailingOnly =TRUE)
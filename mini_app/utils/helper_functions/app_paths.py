@@ -0,0 +1,11 @@
+import os
+
+# Directory of app.py (mini_app). The default paths of the app's files are relative to it, so the app,
+# batch.py and benchmark.py use the same files whichever directory they are started from.
+# Paths set through the environment are used as given.
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def app_path(path):
+    return os.path.join(APP_DIR, path)
@@ -0,0 +1,252 @@
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import jsonify, request
+
+from utils.helper_functions.app_paths import app_path
+from utils.helper_functions.count_table import (CountTableError, CountTableValidator, COUNT_TABLE_EXTENSIONS,
+                                                read_count_table)
+from utils.helper_functions.dataset_store import dataset_store
+
+# Chunked, resumable upload of count tables, used by assets/chunked_upload.js.
+# Chunks are appended straight to a file on disk and validated as they arrive, the finished
+# file is parsed with pandas' streaming reader and put in the dataset store.
+# The chunks of one upload may reach different server processes, the files on disk are the shared state.
+#
+#   POST /upload/chunked                      {"filename": ..., "size": ...} -> {"upload_id": ...}
+#   GET  /upload/chunked/<upload_id>          -> {"received": bytes on disk}
+#   PUT  /upload/chunked/<upload_id>?offset=N chunk bytes -> {"received": ...}
+#   POST /upload/chunked/<upload_id>/complete -> {"key": dataset key, "filename": ...}
+
+UPLOAD_DIR = os.environ.get('CHUNKED_UPLOAD_DIR', app_path('utils/outputs/cache/uploads'))
+MAX_UPLOAD_SIZE = int(float(os.environ.get('CHUNKED_UPLOAD_MAX_MB', 4096)) * 1024 ** 2)
+STALE_UPLOAD_AGE = 24 * 3600
+UPLOAD_ROUTE = '/upload/chunked'
+UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadError(RuntimeError):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class ChunkedUpload:
+    """
+    One upload in progress, its bytes in <id>.part and its metadata in <id>.json.
+    """
+    def __init__(self, upload_id, filename, size):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size
+        self.lock = threading.Lock()
+        self.validator = CountTableValidator(filename)
+        self.received = 0
+
+    @property
+    def path(self):
+        return os.path.join(UPLOAD_DIR, f'{self.upload_id}.part')
+
+    @property
+    def meta_path(self):
+        return os.path.join(UPLOAD_DIR, f'{self.upload_id}.json')
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds the upload for this thread and process, bringing it up to date with chunks
+        another server process may have written in the meantime.
+        """
+        with self.lock:
+            try:
+                meta = open(self.meta_path)
+            except FileNotFoundError:
+                raise UploadError('Unknown upload.', status=404)
+            with meta:
+                fcntl.flock(meta, fcntl.LOCK_EX)
+                try:
+                    size = os.path.getsize(self.path)
+                except FileNotFoundError:
+                    # Completed or discarded by another process while waiting for the lock
+                    raise UploadError('Unknown upload.', status=404)
+                if size != self.received:
+                    self.validator = CountTableValidator(self.filename)
+                    self.received = 0
+                    self.resume()
+                yield
+
+    def resume(self):
+        # After a restart the validator state is rebuilt from the bytes already on disk
+        with open(self.path, 'rb') as f:
+            while True:
+                data = f.read(4 * 1024 ** 2)
+                if not data:
+                    break
+                self.validator.feed(data)
+                self.received += len(data)
+
+    def append(self, offset, data):
+        if offset != self.received:
+            if offset + len(data) <= self.received:
+                # Chunk sent again after a lost reply, it is already on disk
+                return
+            raise UploadError(f'Expected offset {self.received}, got {offset}.', status=409)
+        if self.received + len(data) > self.size:
+            raise UploadError('More data than announced for this upload.')
+        # Validated before writing, a bad chunk is never stored
+        self.validator.feed(data)
+        with open(self.path, 'ab') as f:
+            f.write(data)
+        self.received += len(data)
+
+    def complete(self):
+        if self.received != self.size:
+            raise UploadError(f'Upload incomplete: {self.received} of {self.size} bytes received.', status=409)
+        self.validator.finish()
+        return dataset_store.put(read_count_table(self.path, self.validator))
+
+    def remove(self):
+        for path in (self.path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class ChunkedUploadManager:
+    def __init__(self):
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def start(self, filename, size):
+        if not filename.lower().endswith(COUNT_TABLE_EXTENSIONS):
+            raise UploadError(f"Wrong format: {filename}. Please upload a {', '.join(COUNT_TABLE_EXTENSIONS)} file.")
+        if size <= 0 or size > MAX_UPLOAD_SIZE:
+            raise UploadError(f'The file must be between 1 byte and {MAX_UPLOAD_SIZE // 1024 ** 2} MB.')
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        self._remove_stale()
+        upload = ChunkedUpload(uuid.uuid4().hex, filename, size)
+        open(upload.path, 'wb').close()
+        with open(os.path.join(UPLOAD_DIR, f'{upload.upload_id}.json'), 'w') as f:
+            json.dump({'filename': filename, 'size': size}, f)
+        with self._lock:
+            self._uploads[upload.upload_id] = upload
+        return upload
+
+    def get(self, upload_id):
+        if not UPLOAD_ID.match(upload_id):
+            raise UploadError('Unknown upload.', status=404)
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+            if upload is not None:
+                return upload
+            # Uploads started before a restart, or by another server process
+            meta_path = os.path.join(UPLOAD_DIR, f'{upload_id}.json')
+            if not os.path.exists(meta_path):
+                raise UploadError('Unknown upload.', status=404)
+            with open(meta_path) as f:
+                meta = json.load(f)
+            upload = ChunkedUpload(upload_id, meta['filename'], meta['size'])
+            try:
+                upload.resume()
+            except CountTableError as e:
+                upload.remove()
+                raise UploadError(str(e), status=422)
+            self._uploads[upload_id] = upload
+            return upload
+
+    def discard(self, upload):
+        with self._lock:
+            self._uploads.pop(upload.upload_id, None)
+        upload.remove()
+
+    def _remove_stale(self):
+        # An upload is stale when its data was last written STALE_UPLOAD_AGE ago. Its age is taken from the
+        # .part file, appends do not touch the .json metadata. Both files of a stale upload are removed together
+        now = time.time()
+        for entry in os.scandir(UPLOAD_DIR):
+            upload_id, ext = os.path.splitext(entry.name)
+            if not entry.is_file() or ext not in ('.part', '.json'):
+                continue
+            try:
+                if ext == '.json' and os.path.exists(os.path.join(UPLOAD_DIR, f'{upload_id}.part')):
+                    continue
+                if now - entry.stat().st_mtime <= STALE_UPLOAD_AGE:
+                    continue
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                self._uploads.pop(upload_id, None)
+            for path in (entry.path, os.path.join(UPLOAD_DIR, f'{upload_id}.json')):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+chunked_uploads = ChunkedUploadManager()
+
+
+def register_upload_routes(server):
+    """
+    Adds the chunked upload routes to the Flask server of the app.
+    """
+    def _error(e):
+        return jsonify({'error': str(e)}), getattr(e, 'status', 400)
+
+    @server.route(UPLOAD_ROUTE, methods=['POST'])
+    def start_chunked_upload():
+        meta = request.get_json(silent=True) or {}
+        try:
+            upload = chunked_uploads.start(str(meta.get('filename', '')), int(meta.get('size', 0)))
+        except (UploadError, ValueError) as e:
+            return _error(e)
+        return jsonify({'upload_id': upload.upload_id, 'received': 0})
+
+    @server.route(f'{UPLOAD_ROUTE}/<upload_id>', methods=['GET'])
+    def chunked_upload_status(upload_id):
+        try:
+            upload = chunked_uploads.get(upload_id)
+            with upload.locked():
+                received = upload.received
+        except (UploadError, ValueError) as e:
+            return _error(e)
+        return jsonify({'upload_id': upload_id, 'received': received})
+
+    @server.route(f'{UPLOAD_ROUTE}/<upload_id>', methods=['PUT'])
+    def upload_chunk(upload_id):
+        try:
+            offset = int(request.args.get('offset', -1))
+            upload = chunked_uploads.get(upload_id)
+            with upload.locked():
+                try:
+                    upload.append(offset, request.get_data())
+                except CountTableError as e:
+                    # Malformed file, the upload is dropped without waiting for the rest of it
+                    chunked_uploads.discard(upload)
+                    return _error(UploadError(str(e), status=422))
+                except UploadError as e:
+                    # The client resumes from the offset it is told here
+                    return jsonify({'error': str(e), 'received': upload.received}), e.status
+                return jsonify({'upload_id': upload_id, 'received': upload.received})
+        except (UploadError, ValueError) as e:
+            return _error(e)
+
+    @server.route(f'{UPLOAD_ROUTE}/<upload_id>/complete', methods=['POST'])
+    def complete_chunked_upload(upload_id):
+        try:
+            upload = chunked_uploads.get(upload_id)
+            with upload.locked():
+                try:
+                    key = upload.complete()
+                except CountTableError as e:
+                    chunked_uploads.discard(upload)
+                    return _error(UploadError(str(e), status=422))
+                chunked_uploads.discard(upload)
+        except UploadError as e:
+            return _error(e)
+        return jsonify({'key': key, 'filename': upload.filename})
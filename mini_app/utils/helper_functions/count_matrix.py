@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Compact gene x sample count matrix shared by the upload, DE and QC code.
+# Counts are one uint32 array in column-major order, so every sample is a contiguous block,
+# and stored matrices are memory-mapped from the dataset store instead of being copied per callback.
+# Gene IDs and sample names are kept next to the array as separate indexes.
+
+COUNT_DTYPE = np.uint32
+COUNT_MAX = np.iinfo(COUNT_DTYPE).max
+MATRIX_FILE = 'count_matrix.json'
+
+
+class CountMatrixError(ValueError):
+    pass
+
+
+class CountMatrix:
+    """
+    Gene x sample counts: `counts` (genes x samples, uint32, Fortran order), the gene ID index `genes`
+    and the sample index `samples`. select() returns views sharing the same counts array.
+    """
+    def __init__(self, counts, genes, samples, gene_column='GeneID', columns=None):
+        self._counts = counts
+        self.genes = genes
+        self._all_samples = list(samples)
+        self.gene_column = gene_column
+        # Positions of the selected samples in the counts array, None for all of them
+        self._columns = columns
+        self._sample_index = None
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        Builds a matrix from a frame with gene IDs in the first column and one column per sample,
+        validating the counts in a single pass over the values.
+        """
+        if df.shape[0] == 0 or df.shape[1] < 2:
+            raise CountMatrixError('The count table needs gene IDs in the first column and at least one sample column.')
+        if df.iloc[:, 0].dtype != object:
+            raise CountMatrixError('The first column of the count table should contain gene IDs.')
+        if not all(dtype.kind in 'iuf' for dtype in df.dtypes.iloc[1:]):
+            raise CountMatrixError('All sample columns of the count table should contain counts.')
+
+        values = df.iloc[:, 1:].to_numpy()
+        if values.dtype != COUNT_DTYPE:
+            # One pass computing all checks at once: integers between 0 and COUNT_MAX
+            if values.dtype.kind == 'f':
+                invalid = ~((values >= 0) & (values <= COUNT_MAX) & (values == np.floor(values)))
+            else:
+                invalid = (values < 0) | (values > COUNT_MAX)
+            if invalid.any():
+                raise CountMatrixError('Gene counts should be non-negative integers.')
+        counts = np.asfortranarray(values, dtype=COUNT_DTYPE)
+        genes = df.iloc[:, 0].astype(str).to_numpy().astype(str)
+        # Gene IDs key the results, the gene search and the exports, so they have to be unique
+        duplicated = pd.unique(genes[pd.Series(genes).duplicated().to_numpy()])
+        if len(duplicated):
+            more = ' and more' if len(duplicated) > 5 else ''
+            raise CountMatrixError(f"Gene IDs should be unique, duplicated: {', '.join(duplicated[:5])}{more}.")
+        return cls(counts, genes, [str(col) for col in df.columns[1:]], gene_column=str(df.columns[0]))
+
+    @property
+    def samples(self):
+        if self._columns is None:
+            return self._all_samples
+        return [self._all_samples[i] for i in self._columns]
+
+    @property
+    def shape(self):
+        return len(self.genes), len(self.samples)
+
+    def _positions(self):
+        if self._columns is None:
+            return np.arange(len(self._all_samples))
+        return self._columns
+
+    def sample_position(self, sample):
+        if self._sample_index is None:
+            self._sample_index = {name: i for i, name in enumerate(self._all_samples)}
+        return self._sample_index[sample]
+
+    def select(self, samples):
+        """
+        Zero-copy view of a subset of the samples, in the given order.
+        """
+        try:
+            columns = np.array([self.sample_position(sample) for sample in samples], dtype=np.intp)
+        except KeyError as e:
+            raise CountMatrixError(f'Unknown sample {e.args[0]}')
+        return CountMatrix(self._counts, self.genes, self._all_samples, self.gene_column, columns)
+
+    def column(self, sample):
+        # Contiguous view of one sample's counts
+        return self._counts[:, self.sample_position(sample)]
+
+    def array(self):
+        """
+        Counts of the selected samples as one array. A view when the selection is a regular slice
+        of the stored samples, otherwise only the selected columns are copied.
+        """
+        if self._columns is None:
+            return self._counts
+        columns = self._columns
+        if len(columns) == 0:
+            return self._counts[:, :0]
+        step = columns[1] - columns[0] if len(columns) > 1 else 1
+        if step > 0 and np.array_equal(columns, columns[0] + step * np.arange(len(columns))):
+            return self._counts[:, columns[0]:columns[-1] + 1:step]
+        return np.asfortranarray(self._counts[:, columns])
+
+    def take_genes(self, mask):
+        """
+        Matrix of the selected samples restricted to the genes in mask (boolean), copying only those rows.
+        """
+        counts = np.empty((int(np.count_nonzero(mask)), len(self.samples)), dtype=COUNT_DTYPE, order='F')
+        for i, position in enumerate(self._positions()):
+            counts[:, i] = self._counts[:, position][mask]
+        return CountMatrix(counts, self.genes[mask], self.samples, self.gene_column)
+
+    def to_frame(self):
+        data = {self.gene_column: self.genes}
+        for sample, position in zip(self.samples, self._positions()):
+            data[sample] = self._counts[:, position]
+        return pd.DataFrame(data)
+
+    def key(self):
+        """
+        Content hash over gene IDs, sample names and the counts of the selected samples.
+        """
+        digest = hashlib.sha1(b'count_matrix')
+        digest.update(json.dumps([self.gene_column] + self.samples).encode())
+        digest.update(np.ascontiguousarray(self.genes).tobytes())
+        for position in self._positions():
+            digest.update(self._counts[:, position].tobytes())
+        return digest.hexdigest()
+
+    def memory_nbytes(self):
+        # Memory-mapped counts do not count towards the memory used by the matrix
+        counts = 0 if isinstance(self._counts, np.memmap) else self._counts.nbytes
+        return counts + self.genes.nbytes
+
+    def save(self, directory):
+        """
+        Writes the selected samples to directory (counts.npy, genes.npy and count_matrix.json).
+        """
+        np.save(os.path.join(directory, 'counts.npy'), self.array(), allow_pickle=False)
+        np.save(os.path.join(directory, 'genes.npy'), self.genes, allow_pickle=False)
+        with open(os.path.join(directory, MATRIX_FILE), 'w') as f:
+            json.dump({'gene_column': self.gene_column, 'samples': self.samples}, f)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        with open(os.path.join(directory, MATRIX_FILE)) as f:
+            meta = json.load(f)
+        counts = np.load(os.path.join(directory, 'counts.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+        genes = np.load(os.path.join(directory, 'genes.npy'), allow_pickle=False)
+        return cls(counts, genes, meta['samples'], gene_column=meta['gene_column'])
@@ -0,0 +1,186 @@
+import codecs
+import io
+import os
+import re
+import zlib
+
+import pandas as pd
+
+from utils.helper_functions.count_matrix import CountMatrix, CountMatrixError, COUNT_DTYPE
+
+# Streaming validation and parsing of gene count tables.
+# Accepts gene x sample tables (.csv/.tsv, optionally gzipped), featureCounts output and
+# HTSeq-count output. CountTableValidator checks the table incrementally, chunk by chunk,
+# so a malformed upload is rejected as soon as the bad line arrives.
+
+COUNT_TABLE_EXTENSIONS = ('.csv', '.tsv', '.txt', '.tab', '.counts', '.gz')
+FEATURECOUNTS_COLUMNS = ['geneid', 'chr', 'start', 'end', 'strand', 'length']
+INTEGER = re.compile(r'^\d+$')
+
+
+class CountTableError(ValueError):
+    pass
+
+
+def _strip_quotes(field):
+    field = field.strip()
+    if len(field) >= 2 and field[0] == field[-1] == '"':
+        return field[1:-1]
+    return field
+
+
+class CountTableValidator:
+    """
+    Incremental validator of a count table, fed with the raw (possibly gzipped) bytes in chunks.
+    Detects the layout from the first line and checks that every row has the header's
+    number of fields and non-negative integer counts. Raises CountTableError on the first bad line.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.compressed = filename.lower().endswith('.gz')
+        self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32) if self.compressed else None
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._remainder = ''
+        self._pattern = None
+        self.line_number = 0
+        self.skip_lines = 0
+        self.layout = None
+        self.delimiter = None
+        self.header = None
+        self.rows = 0
+
+    def feed(self, data):
+        if self._decompressor is not None:
+            try:
+                data = self._decompressor.decompress(data)
+            except zlib.error:
+                raise CountTableError('The file is not a valid gzip file.')
+        lines = (self._remainder + self._decoder.decode(data)).split('\n')
+        # The last piece may be an incomplete line, it is checked once the rest arrives
+        self._remainder = lines.pop()
+        for line in lines:
+            self._check_line(line.rstrip('\r'))
+
+    def finish(self):
+        if self._decompressor is not None:
+            if not self._decompressor.eof:
+                raise CountTableError('The gzip file is incomplete.')
+            self._remainder += self._decoder.decode(self._decompressor.flush())
+        self._remainder += self._decoder.decode(b'', final=True)
+        if self._remainder.strip():
+            self._check_line(self._remainder.rstrip('\r'))
+        self._remainder = ''
+        if self.layout is None or self.rows == 0:
+            raise CountTableError('The file does not contain any gene counts.')
+
+    def _detect(self, line):
+        self.delimiter = '\t' if '\t' in line else ','
+        fields = [_strip_quotes(field) for field in line.split(self.delimiter)]
+        if len(fields) < 2:
+            raise CountTableError('The count table needs a gene ID column and at least one sample column.')
+
+        if [field.lower() for field in fields[:6]] == FEATURECOUNTS_COLUMNS:
+            self.layout = 'featurecounts'
+            annotation = 5
+        elif len(fields) == 2 and INTEGER.match(fields[1]):
+            # HTSeq-count output has no header, the sample is named after the file
+            self.layout = 'htseq'
+            annotation = 0
+        else:
+            self.layout = 'table'
+            annotation = 0
+        self.header = fields
+
+        if self.delimiter == ',':
+            field, count = r'(?:"[^"]*"|[^,"]*)', r'"?\d+"?'
+        else:
+            field, count = r'[^\t]*', r'\d+'
+        delimiter = re.escape(self.delimiter)
+        n_counts = len(fields) - 1 - annotation
+        self._pattern = re.compile(
+            field + (delimiter + field) * annotation + (delimiter + count) * n_counts + r'\s*'
+        )
+
+    def _check_line(self, line):
+        self.line_number += 1
+        if self.layout is None:
+            # featureCounts starts with a '# Program:...' comment line
+            if line.startswith('#') or not line.strip():
+                self.skip_lines += 1
+                return
+            self._detect(line)
+            if self.layout != 'htseq':
+                return
+        if not line.strip():
+            return
+        if self.layout == 'htseq' and line.startswith('__'):
+            return
+        if not self._pattern.fullmatch(line):
+            raise CountTableError(
+                f'Line {self.line_number} does not match the header ({len(self.header)} columns) '
+                'or contains counts that are not non-negative integers.'
+            )
+        self.rows += 1
+
+
+def read_count_table(source, validator):
+    """
+    Parses a validated count table (path or binary buffer) into a CountMatrix.
+    """
+    n_columns = len(validator.header)
+    if validator.layout == 'featurecounts':
+        usecols = [0] + list(range(6, n_columns))
+    else:
+        usecols = list(range(n_columns))
+    dtype = {i: (str if i == 0 else COUNT_DTYPE) for i in usecols}
+
+    try:
+        df = pd.read_csv(
+            source,
+            sep=validator.delimiter,
+            skiprows=validator.skip_lines,
+            header=None if validator.layout == 'htseq' else 0,
+            usecols=usecols,
+            dtype=dtype,
+            na_filter=False,
+            compression='gzip' if validator.compressed else None,
+            encoding_errors='replace'
+        )
+    except (ValueError, OverflowError) as e:
+        raise CountTableError(f'The count table could not be read: {e}')
+
+    if validator.layout == 'htseq':
+        df.columns = ['GeneID', os.path.basename(validator.filename).split('.')[0]]
+        df = df[~df['GeneID'].str.startswith('__')].reset_index(drop=True)
+    elif validator.layout == 'featurecounts':
+        # featureCounts names the samples after the BAM paths
+        df.columns = [df.columns[0]] + [os.path.basename(col).removesuffix('.bam') for col in df.columns[1:]]
+    try:
+        return CountMatrix.from_frame(df)
+    except CountMatrixError as e:
+        raise CountTableError(str(e))
+
+
+def parse_count_table(data, filename):
+    """
+    Validates and parses a count table held in memory (bytes), as uploaded through dcc.Upload.
+    """
+    validator = CountTableValidator(filename)
+    validator.feed(data)
+    validator.finish()
+    return read_count_table(io.BytesIO(data), validator)
+
+
+def read_count_file(path, chunk_size=4 * 1024 ** 2):
+    """
+    Validates and parses a count table on disk, streaming it through the validator first.
+    """
+    validator = CountTableValidator(os.path.basename(path))
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            validator.feed(data)
+    validator.finish()
+    return read_count_table(path, validator)
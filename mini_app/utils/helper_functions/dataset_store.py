@@ -0,0 +1,206 @@
+import functools
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from utils.helper_functions.app_paths import app_path
+from utils.helper_functions.count_matrix import CountMatrix, MATRIX_FILE
+
+# Server-side store for the data frames and count matrices passed between callbacks.
+# Entries are keyed by a hash of their content, so the dcc.Store components only carry the key.
+# Each frame is written once to disk as one .npy file per column and memory-mapped on load,
+# with a size-bounded LRU of loaded entries in front of it. Count matrices are stored as one
+# counts array (see count_matrix.py).
+
+CACHE_DIR = os.environ.get('DATASET_CACHE_DIR', app_path('utils/outputs/cache/datasets'))
+MEMORY_LIMIT = int(float(os.environ.get('DATASET_CACHE_MEMORY_MB', 512)) * 1024 ** 2)
+DISK_LIMIT = int(float(os.environ.get('DATASET_CACHE_DISK_MB', 4096)) * 1024 ** 2)
+
+
+class _Missing(Exception):
+    pass
+
+
+def stored_cache(maxsize=16):
+    """
+    functools.lru_cache for functions built on stored datasets, which return None when a dataset
+    is not (or no longer, or not yet) in the store. None is not cached, so the dataset is looked up
+    again on the next call instead of staying missing for the life of the process.
+    """
+    def decorator(func):
+        @functools.lru_cache(maxsize=maxsize)
+        def cached(*args, **kwargs):
+            result = func(*args, **kwargs)
+            if result is None:
+                # lru_cache keeps results only, not exceptions
+                raise _Missing()
+            return result
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return cached(*args, **kwargs)
+            except _Missing:
+                return None
+        wrapper.cache_clear = cached.cache_clear
+        wrapper.cache_info = cached.cache_info
+        return wrapper
+    return decorator
+
+
+# Content hash of a data frame, covering the column names, dtypes and values
+def frame_key(df):
+    digest = hashlib.sha1()
+    digest.update(json.dumps([[str(col), str(dtype)] for col, dtype in df.dtypes.items()]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _frame_nbytes(df):
+    if isinstance(df, CountMatrix):
+        return df.memory_nbytes()
+    return int(df.memory_usage(index=False, deep=True).sum())
+
+
+def _directory_nbytes(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+class DatasetStore:
+    """
+    Content-addressed frame store with an in-memory LRU layer and a disk layer,
+    each evicting least recently used frames once it grows past its size limit.
+    """
+    def __init__(self, root=CACHE_DIR, memory_limit=MEMORY_LIMIT, disk_limit=DISK_LIMIT):
+        self.root = root
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self._memory = OrderedDict()
+        self._memory_nbytes = 0
+        self._lock = threading.RLock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def put(self, df):
+        """
+        Stores the frame (or CountMatrix) and returns its key. Storing the same content again is a no-op.
+        """
+        key = df.key() if isinstance(df, CountMatrix) else frame_key(df)
+        with self._lock:
+            if not os.path.isdir(self._path(key)):
+                self._write(key, df)
+                self._evict_disk(keep=key)
+            if isinstance(df, CountMatrix) and key not in self._memory:
+                # Keep the memory-mapped copy, so the counts are not held in memory
+                df = self._read(self._path(key))
+            self._remember(key, df)
+        return key
+
+    def get(self, key):
+        """
+        Returns the frame (or CountMatrix) stored under key, or None if the key is unknown or has been evicted.
+        The returned frame is shared between callbacks and must not be modified in place.
+        """
+        if not key:
+            return None
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key][0]
+            path = self._path(key)
+            if not os.path.isdir(path):
+                return None
+            df = self._read(path)
+            # Touch the entry so disk eviction sees it as recently used
+            os.utime(path)
+            self._remember(key, df)
+            return df
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._memory or os.path.isdir(self._path(key))
+
+    def directory(self, key):
+        """
+        Returns the on-disk directory of a stored frame, or None if the key is unknown.
+        Files derived from the frame (e.g. exports) can be kept there and are evicted with it.
+        """
+        with self._lock:
+            path = self._path(key)
+            return path if key and os.path.isdir(path) else None
+
+    def _write(self, key, df):
+        tmp_dir = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+        if isinstance(df, CountMatrix):
+            df.save(tmp_dir)
+            self._commit(tmp_dir, key)
+            return
+        columns = []
+        for i, (name, column) in enumerate(df.items()):
+            values = column.to_numpy()
+            if values.dtype == object:
+                # Strings are stored as fixed width unicode so they can be memory-mapped as well
+                values = column.astype(str).to_numpy().astype(str)
+            np.save(os.path.join(tmp_dir, f'{i}.npy'), values, allow_pickle=False)
+            columns.append({'name': name, 'dtype': str(column.dtype)})
+        with open(os.path.join(tmp_dir, 'columns.json'), 'w') as f:
+            json.dump(columns, f)
+        self._commit(tmp_dir, key)
+
+    def _commit(self, tmp_dir, key):
+        try:
+            os.rename(tmp_dir, self._path(key))
+        except OSError:
+            # Another worker already stored the same content
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _read(self, path):
+        if os.path.exists(os.path.join(path, MATRIX_FILE)):
+            return CountMatrix.load(path)
+        with open(os.path.join(path, 'columns.json')) as f:
+            columns = json.load(f)
+        data = {}
+        for i, column in enumerate(columns):
+            values = np.load(os.path.join(path, f'{i}.npy'), mmap_mode='r', allow_pickle=False)
+            if column['dtype'] == 'object':
+                values = values.astype(object)
+            data[column['name']] = values
+        return pd.DataFrame(data, copy=False)
+
+    def _remember(self, key, df):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        nbytes = _frame_nbytes(df)
+        self._memory[key] = (df, nbytes)
+        self._memory_nbytes += nbytes
+        while self._memory_nbytes > self.memory_limit and len(self._memory) > 1:
+            _, (_, evicted_nbytes) = self._memory.popitem(last=False)
+            self._memory_nbytes -= evicted_nbytes
+
+    def _evict_disk(self, keep=None):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and not entry.name.startswith('.'):
+                entries.append((entry.stat().st_mtime, entry.name, _directory_nbytes(entry.path)))
+        total = sum(nbytes for _, _, nbytes in entries)
+        for _, key, nbytes in sorted(entries):
+            if total <= self.disk_limit:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            total -= nbytes
+
+
+# Store shared by all callbacks of the app
+dataset_store = DatasetStore()
@@ -0,0 +1,145 @@
+import contextlib
+import multiprocessing
+import os
+
+import pandas as pd
+
+from utils.helper_functions.count_matrix import CountMatrix
+from utils.helper_functions.job_queue import JobCancelled
+from utils.helper_functions.metrics import phase_timer
+from utils.helper_functions.r_exchange import encode_request, read_results, result_path
+
+# Runs one DE analysis with either engine inside a working directory of its own.
+# Both engines return the result with the gene IDs in a 'GeneID' column followed by the DESeq2 result columns.
+# The input write, engine run and result read phases of each run are timed in metrics.py.
+# The built-in engine (and SciPy with it) is imported on its first run or by warm_up_python_engine(),
+# not when the app starts.
+
+# Condition levels offered by default, the first level is the reference of the design
+CONDITION_LEVELS = ['Control', 'Treatment']
+# 'reference' compares every level with the reference, 'pairwise' compares all pairs of levels
+CONTRAST_MODES = ('reference', 'pairwise')
+
+
+def parse_levels(text):
+    """
+    Condition levels from a comma separated list, in order and without duplicates.
+    """
+    levels = []
+    for level in str(text or '').split(','):
+        level = level.strip()
+        if level and level != 'None' and level not in levels:
+            levels.append(level)
+    return levels
+
+
+def design_contrasts(levels, mode='reference'):
+    """
+    (numerator, denominator) contrasts between the given levels. As in DGE_deseq2.r the
+    reference level is the numerator, so two levels always give the single contrast used so far.
+    """
+    if mode == 'pairwise':
+        return [(a, b) for i, a in enumerate(levels) for b in levels[i + 1:]]
+    return [(levels[0], level) for level in levels[1:]]
+
+
+def contrast_label(contrast):
+    return f'{contrast[0]} vs {contrast[1]}'
+
+
+def parse_contrast(label):
+    """
+    (numerator, denominator) from a 'numerator vs denominator' label.
+    """
+    numerator, separator, denominator = str(label).partition(' vs ')
+    if not separator or not numerator.strip() or not denominator.strip():
+        raise ValueError(f"Contrasts are written as 'numerator vs denominator', got '{label}'.")
+    return numerator.strip(), denominator.strip()
+
+
+def python_engine_results(count_data, conditions_table, contrasts, max_workers=None):
+    """
+    Runs the built-in engine in the calling process and returns one result frame per contrast.
+    max_workers defaults to DE_CONTRAST_WORKERS threads.
+    """
+    from utils.helper_functions.deseq_engine import fit_deseq, contrast_results, CONTRAST_WORKERS
+    fit = fit_deseq(count_data, conditions_table, contrasts[0][0])
+    de_dfs = contrast_results(fit, contrasts, max_workers or CONTRAST_WORKERS)
+    return [de_df.rename_axis('GeneID').reset_index() for de_df in de_dfs]
+
+
+def warm_up_python_engine(n_genes=500, n_samples=4):
+    """
+    Runs the built-in engine once on a small synthetic table. Engine runs are forked from the
+    server process, so afterwards they start with the engine imported.
+    """
+    from utils.helper_functions.synthetic_counts import synthetic_counts
+    df, conditions_table = synthetic_counts(n_genes, n_samples)
+    python_engine_results(CountMatrix.from_frame(df), conditions_table, [('Control', 'Treatment')], max_workers=1)
+
+
+def _python_engine_process(count_data, conditions_table, contrasts, workdir):
+    try:
+        de_dfs = python_engine_results(count_data, conditions_table, contrasts)
+        pd.to_pickle(de_dfs, os.path.join(workdir, 'de_out.pkl'))
+    except Exception as e:
+        with open(os.path.join(workdir, 'error.txt'), 'w') as f:
+            f.write(str(e) or type(e).__name__)
+        raise SystemExit(1)
+
+
+# Built-in engine, run in a child process so it does not hold the web worker and can be cancelled
+def run_python_engine(count_data, conditions_table, contrasts, workdir, cancel_event=None):
+    # The counts reach the child process with its arguments
+    with phase_timer('python', 'input_write'):
+        process = multiprocessing.Process(
+            target=_python_engine_process,
+            args=(count_data, conditions_table, contrasts, workdir),
+            daemon=True
+        )
+        process.start()
+    with phase_timer('python', 'engine_run'):
+        while process.is_alive():
+            process.join(0.2)
+            if cancel_event is not None and cancel_event.is_set():
+                process.terminate()
+                process.join()
+                raise JobCancelled()
+
+    if process.exitcode != 0:
+        error_path = os.path.join(workdir, 'error.txt')
+        message = open(error_path).read() if os.path.exists(error_path) else f'exit code {process.exitcode}'
+        raise RuntimeError(f'DE analysis failed: {message}')
+    with phase_timer('python', 'result_read'):
+        return pd.read_pickle(os.path.join(workdir, 'de_out.pkl'))
+
+
+# DESeq2 on a warm R worker, the counts go over the worker's stdin and the results come back
+# in a binary file (see r_exchange.py)
+def run_r_engine(count_data, conditions_table, contrasts, workdir, r_worker_pool, cancel_event=None):
+    output_path = result_path(workdir)
+    try:
+        with phase_timer('r', 'input_write'):
+            request = encode_request(count_data, conditions_table, contrasts, output_path)
+        with phase_timer('r', 'engine_run'):
+            r_worker_pool.run_deseq(request, cancel_event=cancel_event)
+        with phase_timer('r', 'result_read'):
+            return read_results(output_path, count_data.genes)
+    finally:
+        # A worker that failed or was stopped may not have left the file behind, its error is the one to report
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(output_path)
+
+
+def run_de_analysis(count_data, conditions_table, contrasts, engine, workdir, r_worker_pool=None, cancel_event=None):
+    """
+    Runs the DE analysis of the selected samples with the chosen engine ('python' or 'r').
+    The model is fitted once and every (numerator, denominator) contrast is extracted from it,
+    the numerator of the first contrast is the reference level of the design.
+    Returns a dict of result frames keyed by contrast_label().
+    """
+    if engine == 'python':
+        de_dfs = run_python_engine(count_data, conditions_table, contrasts, workdir, cancel_event)
+    else:
+        de_dfs = run_r_engine(count_data, conditions_table, contrasts, workdir, r_worker_pool, cancel_event)
+    return {contrast_label(contrast): de_df for contrast, de_df in zip(contrasts, de_dfs)}
@@ -0,0 +1,538 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import special, stats
+
+from utils.helper_functions.count_matrix import CountMatrix
+
+# In-process re-implementation of the steps DGE_deseq2.r runs through DESeq2:
+# median-of-ratios size factors, gene-wise / trended / MAP dispersions,
+# the negative binomial Wald test and BH adjusted p-values with independent filtering.
+# Everything is vectorised across the gene x sample matrix. The model is fitted once per design
+# and any number of contrasts between its condition levels is extracted from that fit.
+
+# Constants used by DESeq2
+MIN_DISP = 1e-8
+MIN_MU = 0.5
+OUTLIER_SD = 2
+BETA_RIDGE = 1e-6 / np.log(2) ** 2
+MAX_BETA = 30
+DISP_MAX_ITER = 100
+RESULT_COLUMNS = ['baseMean', 'log2FoldChange', 'lfcSE', 'stat', 'pvalue', 'padj']
+# Threads extracting the contrasts of one fit
+CONTRAST_WORKERS = int(os.environ.get('DE_CONTRAST_WORKERS', min(4, os.cpu_count() or 1)))
+
+
+# Median-of-ratios size factors
+def estimate_size_factors(counts):
+    with np.errstate(divide='ignore'):
+        log_counts = np.log(counts)
+    log_geo_means = log_counts.mean(axis=1)
+    usable = np.isfinite(log_geo_means)
+    if not usable.any():
+        raise ValueError('Every gene contains at least one zero, size factors cannot be estimated.')
+    ratios = log_counts[usable] - log_geo_means[usable, None]
+    return np.exp(np.median(ratios, axis=0))
+
+
+# Design matrix for ~ Conditions with the reference level as intercept
+def design_matrix(conditions, reference_condition):
+    conditions = np.asarray(conditions)
+    levels = [reference_condition] + sorted(set(conditions) - {reference_condition})
+    columns = [np.ones(len(conditions))] + [(conditions == level).astype(float) for level in levels[1:]]
+    return np.column_stack(columns), levels
+
+
+# Contrast of numerator vs denominator level, the first level is absorbed in the intercept
+def contrast_vector(levels, numerator, denominator):
+    contrast = np.zeros(len(levels))
+    for level, sign in ((numerator, 1), (denominator, -1)):
+        index = levels.index(level)
+        if index > 0:
+            contrast[index] += sign
+    return contrast
+
+
+# X'WX for every gene at once, w is genes x samples
+def _weighted_crossprod(x, w):
+    n_coefs = x.shape[1]
+    outer = (x[:, :, None] * x[:, None, :]).reshape(len(x), -1)
+    return (w @ outer).reshape(-1, n_coefs, n_coefs)
+
+
+# log det(B) and trace(B^-1 dB) for a stack of matrices, in closed form for the two-coefficient design
+def _logdet(b):
+    if b.shape[1] == 2:
+        return np.log(b[:, 0, 0] * b[:, 1, 1] - b[:, 0, 1] * b[:, 1, 0])
+    return np.linalg.slogdet(b)[1]
+
+
+def _trace_solve(b, db):
+    if b.shape[1] == 2:
+        det = b[:, 0, 0] * b[:, 1, 1] - b[:, 0, 1] * b[:, 1, 0]
+        return (b[:, 1, 1] * db[:, 0, 0] - b[:, 0, 1] * db[:, 1, 0]
+                - b[:, 1, 0] * db[:, 0, 1] + b[:, 0, 0] * db[:, 1, 1]) / det
+    return np.trace(np.linalg.solve(b, db), axis1=1, axis2=2)
+
+
+# Cox-Reid adjusted log posterior of the dispersion, evaluated for every gene at once
+def _log_posterior(log_alpha, counts, mu, x, prior_mean=None, prior_var=None):
+    alpha = np.exp(log_alpha)[:, None]
+    alpha_neg1 = 1.0 / alpha
+    ll_part = (special.gammaln(counts + alpha_neg1) - special.gammaln(alpha_neg1)
+               - counts * np.log(mu + alpha_neg1) - alpha_neg1 * np.log1p(mu * alpha)).sum(axis=1)
+    cr_term = -0.5 * _logdet(_weighted_crossprod(x, 1.0 / (1.0 / mu + alpha)))
+    posterior = ll_part + cr_term
+    if prior_mean is not None:
+        posterior -= 0.5 * (log_alpha - prior_mean) ** 2 / prior_var
+    return posterior
+
+
+# Derivative of the log posterior with respect to log(alpha)
+def _dlog_posterior(log_alpha, counts, mu, x, prior_mean=None, prior_var=None):
+    alpha = np.exp(log_alpha)[:, None]
+    alpha_neg1 = 1.0 / alpha
+    ll_part = alpha_neg1[:, 0] ** 2 * (special.digamma(alpha_neg1) + np.log1p(mu * alpha) - mu * alpha / (1.0 + mu * alpha)
+                                       - special.digamma(counts + alpha_neg1) + counts / (mu + alpha_neg1)).sum(axis=1)
+    b = _weighted_crossprod(x, 1.0 / (1.0 / mu + alpha))
+    db = _weighted_crossprod(x, -1.0 / (1.0 / mu + alpha) ** 2)
+    cr_term = -0.5 * _trace_solve(b, db)
+    derivative = (ll_part + cr_term) * alpha[:, 0]
+    if prior_mean is not None:
+        derivative -= (log_alpha - prior_mean) / prior_var
+    return derivative
+
+
+# Line search on log(alpha) following the Armijo rule, as in DESeq2's fitDisp
+def _fit_dispersion(counts, mu, x, log_alpha, prior_mean=None, prior_var=None,
+                    kappa_0=1.0, tol=1e-6, max_iter=DISP_MAX_ITER, epsilon=1e-4):
+    n_genes = counts.shape[0]
+    prior_mean = np.broadcast_to(prior_mean, n_genes) if prior_mean is not None else None
+
+    def _select(idx):
+        return counts[idx], mu[idx], x, None if prior_mean is None else prior_mean[idx], prior_var
+
+    log_alpha = log_alpha.copy()
+    lp = _log_posterior(log_alpha, counts, mu, x, prior_mean, prior_var)
+    dlp = _dlog_posterior(log_alpha, counts, mu, x, prior_mean, prior_var)
+    initial_lp = lp.copy()
+    kappa = np.full(n_genes, kappa_0)
+    iterations = np.zeros(n_genes, dtype=int)
+    accepted = np.zeros(n_genes, dtype=int)
+    active = np.ones(n_genes, dtype=bool)
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+        iterations[idx] += 1
+        a, d, k = log_alpha[idx], dlp[idx], kappa[idx]
+        # keep log(alpha) within [-30, 10] where lgamma is stable
+        with np.errstate(divide='ignore', invalid='ignore'):
+            k = np.where(a + k * d < -30.0, (-30.0 - a) / d, k)
+            k = np.where(a + k * d > 10.0, (10.0 - a) / d, k)
+        proposal = a + k * d
+        proposal_lp = _log_posterior(proposal, *_select(idx))
+        accept = -proposal_lp <= -lp[idx] - k * epsilon * d ** 2
+
+        # rejected proposals halve the step size
+        kappa[idx[~accept]] = k[~accept] / 2.0
+        idx, k = idx[accept], k[accept]
+        change = proposal_lp[accept] - lp[idx]
+        log_alpha[idx] = proposal[accept]
+        lp[idx] = proposal_lp[accept]
+        accepted[idx] += 1
+        stop = (change < tol) | (log_alpha[idx] < np.log(MIN_DISP / 10))
+        active[idx[stop]] = False
+
+        idx, k = idx[~stop], k[~stop]
+        if idx.size:
+            dlp[idx] = _dlog_posterior(log_alpha[idx], *_select(idx))
+            k = np.minimum(k * 1.1, kappa_0)
+            kappa[idx] = np.where(accepted[idx] % 5 == 0, k / 2.0, k)
+    return log_alpha, iterations, initial_lp, lp
+
+
+# Grid search of the log posterior, used where the line search did not converge
+def _fit_dispersion_grid(counts, mu, x, max_disp, prior_mean=None, prior_var=None, grid_size=20):
+    n_genes = counts.shape[0]
+    prior_mean = np.broadcast_to(prior_mean, n_genes) if prior_mean is not None else None
+    grid = np.linspace(np.log(MIN_DISP), np.log(max_disp), grid_size)
+    delta = grid[1] - grid[0]
+    scores = np.stack([_log_posterior(np.full(n_genes, a), counts, mu, x, prior_mean, prior_var) for a in grid])
+    best = grid[np.argmax(scores, axis=0)]
+    fine_grid = best + np.linspace(-delta, delta, grid_size)[:, None]
+    scores = np.stack([_log_posterior(a, counts, mu, x, prior_mean, prior_var) for a in fine_grid])
+    return np.exp(fine_grid[np.argmax(scores, axis=0), np.arange(n_genes)])
+
+
+# Gene-wise estimates started from the rough moments estimate, with the mean from the linear model
+def estimate_gene_dispersions(counts, norm_counts, size_factors, x, max_disp):
+    n_samples, n_coefs = x.shape
+    hat = x @ np.linalg.pinv(x)
+    linear_mu = norm_counts @ hat.T
+    rough_mu = np.maximum(linear_mu, 1)
+    rough_disp = np.maximum((((norm_counts - rough_mu) ** 2 - rough_mu) / rough_mu ** 2).sum(axis=1) / (n_samples - n_coefs), 0)
+    means = norm_counts.mean(axis=1)
+    moments_disp = (norm_counts.var(axis=1, ddof=1) - np.mean(1 / size_factors) * means) / means ** 2
+    alpha_init = np.clip(np.minimum(rough_disp, moments_disp), MIN_DISP, max_disp)
+
+    mu = np.maximum(linear_mu * size_factors, MIN_MU)
+    log_alpha, iterations, initial_lp, last_lp = _fit_dispersion(counts, mu, x, np.log(alpha_init))
+    disp_gene_est = np.minimum(np.exp(log_alpha), max_disp)
+    # moves that did not increase the log posterior by more than one millionth are not accepted
+    no_increase = last_lp < initial_lp + np.abs(initial_lp) / 1e6
+    disp_gene_est[no_increase] = alpha_init[no_increase]
+    refit = ~((iterations < DISP_MAX_ITER) & (iterations != 1)) & (disp_gene_est > 10 * MIN_DISP)
+    if refit.any():
+        disp_gene_est[refit] = _fit_dispersion_grid(counts[refit], mu[refit], x, max_disp)
+    return np.clip(disp_gene_est, MIN_DISP, max_disp), mu
+
+
+# Gamma-family GLM with identity link, as used by glm() in the parametric trend fit
+def _gamma_identity_glm(means, disps, start, max_iter=25, tol=1e-8):
+    x = np.column_stack([np.ones_like(means), 1.0 / means])
+    coefs = start
+    deviance_old = np.inf
+    for _ in range(max_iter):
+        fitted = x @ coefs
+        weights = 1.0 / fitted ** 2
+        coefs_old = coefs
+        coefs = np.linalg.solve(x.T @ (x * weights[:, None]), x.T @ (disps * weights))
+        # step halving while the fitted values are outside the domain of the Gamma family
+        for _ in range(max_iter):
+            fitted = x @ coefs
+            if np.all(fitted > 0):
+                break
+            coefs = (coefs + coefs_old) / 2
+        else:
+            return None
+        deviance = np.sum(-2 * (np.log(disps / fitted) - (disps - fitted) / fitted))
+        if abs(deviance - deviance_old) / (abs(deviance) + 0.1) < tol:
+            break
+        deviance_old = deviance
+    return coefs
+
+
+# Coefficients (asymptDisp, extraPois) of the parametric dispersion trend, None if the fit does not converge
+def dispersion_trend_coefs(base_mean, disp_gene_est):
+    use_for_fit = disp_gene_est > 100 * MIN_DISP
+    means = base_mean[use_for_fit]
+    disps = disp_gene_est[use_for_fit]
+    coefs = np.array([0.1, 1.0])
+    for _ in range(11):
+        residuals = disps / (coefs[0] + coefs[1] / means)
+        good = (residuals > 1e-4) & (residuals < 15)
+        old_coefs = coefs
+        coefs = _gamma_identity_glm(means[good], disps[good], coefs)
+        if coefs is None or not np.all(coefs > 0):
+            return None
+        if np.sum(np.log(coefs / old_coefs) ** 2) < 1e-6:
+            return coefs
+    return None
+
+
+# Mean dispersion used as the trend when the parametric fit fails
+def mean_dispersion(disp_gene_est):
+    use_for_mean = disp_gene_est > 10 * MIN_DISP
+    return stats.trim_mean(disp_gene_est[use_for_mean], 0.001)
+
+
+# Dispersion trend asymptDisp + extraPois / mean, falling back to a mean trend if the fit fails
+def fit_dispersion_trend(base_mean, disp_gene_est):
+    coefs = dispersion_trend_coefs(base_mean, disp_gene_est)
+    if coefs is not None:
+        return coefs[0] + coefs[1] / base_mean
+    return np.full_like(base_mean, mean_dispersion(disp_gene_est))
+
+
+# Vectorised IRLS for the negative binomial GLM, returning natural log coefficients and their covariances
+def fit_negative_binomial_glm(counts, size_factors, x, dispersions, max_iter=100, tol=1e-8):
+    n_genes, n_coefs = counts.shape[0], x.shape[1]
+    ridge = np.eye(n_coefs) * BETA_RIDGE
+    alpha = dispersions[:, None]
+
+    beta = np.linalg.lstsq(x, np.log(counts / size_factors + 0.1).T, rcond=None)[0].T
+    mu = np.maximum(size_factors * np.exp(beta @ x.T), MIN_MU)
+    deviance_old = np.zeros(n_genes)
+    active = np.ones(n_genes, dtype=bool)
+    for iteration in range(max_iter):
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+        mu_a = mu[idx]
+        w = mu_a / (1 + alpha[idx] * mu_a)
+        z = np.log(mu_a / size_factors) + (counts[idx] - mu_a) / mu_a
+        xtwx = _weighted_crossprod(x, w) + ridge
+        xtwz = np.einsum('jp,gj->gp', x, w * z)
+        beta_a = np.linalg.solve(xtwx, xtwz[..., None])[..., 0]
+        diverged = np.abs(beta_a).max(axis=1) > MAX_BETA
+        beta_a = np.clip(beta_a, -MAX_BETA, MAX_BETA)
+        beta[idx] = beta_a
+        mu[idx] = np.maximum(size_factors * np.exp(beta_a @ x.T), MIN_MU)
+        size = 1.0 / alpha[idx]
+        deviance = -2 * stats.nbinom.logpmf(counts[idx], size, size / (size + mu[idx])).sum(axis=1)
+        converged = np.abs(deviance - deviance_old[idx]) / (np.abs(deviance) + 0.1) < tol
+        deviance_old[idx] = deviance
+        if iteration > 0:
+            active[idx[converged | diverged | np.isnan(deviance)]] = False
+
+    w = mu / (1 + alpha * mu)
+    xtwx = _weighted_crossprod(x, w)
+    xtwx_ridge_inv = np.linalg.inv(xtwx + ridge)
+    sigma = xtwx_ridge_inv @ xtwx @ xtwx_ridge_inv
+    return beta, sigma, mu
+
+
+# Benjamini-Hochberg adjustment, NaNs are ignored as in p.adjust.
+# The decreasing order of the p-values can be passed in when adjusting many subsets of the same vector.
+def p_adjust_bh(pvalues, order=None):
+    adjusted = np.full(pvalues.shape, np.nan)
+    if order is None:
+        valid = np.flatnonzero(~np.isnan(pvalues))
+        order = valid[np.argsort(pvalues[valid], kind='stable')[::-1]]
+    n = order.size
+    if n == 0:
+        return adjusted
+    ranks = np.arange(n, 0, -1)
+    adjusted[order] = np.minimum(1, np.minimum.accumulate(n / ranks * pvalues[order]))
+    return adjusted
+
+
+# Port of R's lowess (Cleveland's clowess), used to pick the independent filtering threshold
+def _lowess(x, y, f=2 / 3, n_steps=3):
+    n = len(x)
+    ns = max(2, min(n, int(f * n + 1e-7)))
+    delta = 0.01 * (x[-1] - x[0])
+    fitted = np.zeros(n)
+    robustness = np.ones(n)
+    for step in range(n_steps + 1):
+        nleft, nright, last, i = 0, ns - 1, -1, 0
+        while True:
+            if nright < n - 1 and x[i] - x[nleft] > x[nright + 1] - x[i]:
+                nleft += 1
+                nright += 1
+                continue
+            h = max(x[i] - x[nleft], x[nright] - x[i])
+            r = np.abs(x - x[i])
+            # points from nleft up to the first one beyond the radius on the right, ties included
+            beyond = np.flatnonzero((np.arange(n) >= nleft) & (r > 0.999 * h) & (x > x[i]))
+            stop = beyond[0] if beyond.size else n
+            window = (np.arange(n) >= nleft) & (np.arange(n) < stop) & (r <= 0.999 * h)
+            weights = np.where(r <= 0.001 * h, 1.0, (1 - (r / h) ** 3) ** 3) * window
+            if step > 0:
+                weights = weights * robustness
+            if weights.sum() <= 0:
+                fitted[i] = y[i]
+            else:
+                weights = weights / weights.sum()
+                if h > 0:
+                    centre = np.sum(weights * x)
+                    spread = np.sum(weights * (x - centre) ** 2)
+                    if np.sqrt(spread) > 0.001 * (x[-1] - x[0]):
+                        weights = weights * ((x[i] - centre) / spread * (x - centre) + 1)
+                fitted[i] = np.sum(weights * y)
+            if last < i - 1:
+                alpha = (x[last + 1:i] - x[last]) / (x[i] - x[last])
+                fitted[last + 1:i] = alpha * fitted[i] + (1 - alpha) * fitted[last]
+            last = i
+            cut = x[last] + delta
+            i = last + 1
+            while i < n and x[i] <= cut:
+                if x[i] == x[last]:
+                    fitted[i] = fitted[last]
+                    last = i
+                i += 1
+            i = max(last + 1, i - 1)
+            if last >= n - 1:
+                break
+        residuals = y - fitted
+        if step == n_steps:
+            break
+        cmad = 6 * np.median(np.abs(residuals))
+        if cmad < 1e-7 * np.mean(np.abs(residuals)):
+            break
+        robustness = np.clip(1 - (np.abs(residuals) / cmad) ** 2, 0, None) ** 2
+        robustness[np.abs(residuals) <= 0.001 * cmad] = 1.0
+        robustness[np.abs(residuals) > 0.999 * cmad] = 0.0
+    return fitted
+
+
+# Independent filtering on baseMean followed by BH, as done by results()
+def independent_filtering(base_mean, pvalues, alpha=0.1):
+    lower_quantile = np.mean(base_mean == 0)
+    upper_quantile = 0.95 if lower_quantile < 0.95 else 1
+    theta = np.linspace(lower_quantile, upper_quantile, 50)
+    cutoffs = np.quantile(base_mean, theta)
+    valid = np.flatnonzero(~np.isnan(pvalues))
+    order = valid[np.argsort(pvalues[valid], kind='stable')[::-1]]
+    filtered_padj = np.full((len(pvalues), len(theta)), np.nan)
+    for k, cutoff in enumerate(cutoffs):
+        filtered_padj[:, k] = p_adjust_bh(pvalues, order[base_mean[order] >= cutoff])
+    with np.errstate(invalid='ignore'):
+        num_rej = np.sum(filtered_padj < alpha, axis=0)
+    if num_rej.max() <= 10:
+        return filtered_padj[:, 0]
+    lo_fit = _lowess(theta, num_rej.astype(float), f=1 / 5)
+    residual = 0 if np.all(num_rej == 0) else num_rej[num_rej > 0] - lo_fit[num_rej > 0]
+    threshold = lo_fit.max() - np.sqrt(np.mean(np.square(residual)))
+    above = np.flatnonzero(num_rej > threshold)
+    return filtered_padj[:, above[0] if above.size else 0]
+
+
+# Cook's distances for the samples in cells with three or more replicates
+def _max_cooks(counts, norm_counts, mu, x, dispersions, hat_diag):
+    cells = np.unique(x, axis=0, return_inverse=True)[1].ravel()
+    cell_sizes = np.bincount(cells)
+    in_large_cell = cell_sizes[cells] >= 3
+    if not in_large_cell.any():
+        return None
+
+    # robustMethodOfMomentsDisp with trimmed cell variances
+    variances = []
+    for cell in np.flatnonzero(cell_sizes >= 3):
+        cell_counts = norm_counts[:, cells == cell]
+        n = cell_counts.shape[1]
+        trim_bin = 0 if n <= 3.5 else (1 if n <= 23.5 else 2)
+        trim = [1 / 3, 1 / 4, 1 / 8][trim_bin]
+        scale = [2.04, 1.86, 1.51][trim_bin]
+        cell_mean = stats.trim_mean(cell_counts, trim, axis=1)
+        variances.append(scale * stats.trim_mean((cell_counts - cell_mean[:, None]) ** 2, trim, axis=1))
+    means = norm_counts.mean(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        robust_disp = np.maximum((np.max(variances, axis=0) - means) / means ** 2, 0.04)
+
+    variance = mu + robust_disp[:, None] * mu ** 2
+    cooks = (counts - mu) ** 2 / variance / x.shape[1] * hat_diag / (1 - hat_diag) ** 2
+    cooks = np.where(in_large_cell, cooks, -np.inf)
+    return cooks.max(axis=1), cooks.argmax(axis=1)
+
+
+# Fits size factors, dispersions and the negative binomial GLM once for the whole design
+def fit_deseq(count_data, conditions_table, reference_condition):
+    """
+    Fits the ~ Conditions model of DGE_deseq2.r to the samples in conditions_table.
+    count_data is a CountMatrix (or a frame with the gene IDs in the first column followed by
+    one column per sample), conditions_table has 'Samples' and 'Conditions' columns.
+    Returns the fit as a dict, contrasts are then extracted from it with contrast_results().
+    """
+    samples = conditions_table['Samples'].tolist()
+    if not isinstance(count_data, CountMatrix):
+        count_data = CountMatrix.from_frame(count_data)
+    counts = count_data.select(samples).array().astype(float)
+    conditions = conditions_table['Conditions'].astype(str).to_numpy()
+    x, levels = design_matrix(conditions, reference_condition)
+    n_samples, n_coefs = x.shape
+    if n_samples <= n_coefs:
+        raise ValueError('The design has no residual degrees of freedom, add replicates to each condition.')
+
+    size_factors = estimate_size_factors(counts)
+    norm_counts = counts / size_factors
+    base_mean = norm_counts.mean(axis=1)
+    nonzero = counts.sum(axis=1) > 0
+    counts_nz, norm_nz, base_mean_nz = counts[nonzero], norm_counts[nonzero], base_mean[nonzero]
+    max_disp = max(10, n_samples)
+
+    # Gene-wise estimates
+    disp_gene_est, mu = estimate_gene_dispersions(counts_nz, norm_nz, size_factors, x, max_disp)
+
+    # Trend and prior width, the sampling variance of log dispersions is trigamma((m - p) / 2)
+    disp_fit = fit_dispersion_trend(base_mean_nz, disp_gene_est)
+    above_min_disp = disp_gene_est >= 100 * MIN_DISP
+    disp_residuals = np.log(disp_gene_est) - np.log(disp_fit)
+    var_log_disp_ests = stats.median_abs_deviation(disp_residuals[above_min_disp], scale='normal') ** 2
+    disp_prior_var = max(var_log_disp_ests - special.polygamma(1, (n_samples - n_coefs) / 2), 0.25)
+
+    # Maximum a posteriori estimates, keeping gene-wise estimates for dispersion outliers
+    disp_init = np.where(disp_gene_est > 0.1 * disp_fit, disp_gene_est, disp_fit)
+    log_alpha, iterations, _, _ = _fit_dispersion(counts_nz, mu, x, np.log(disp_init), np.log(disp_fit), disp_prior_var)
+    disp_map = np.exp(log_alpha)
+    refit = iterations >= DISP_MAX_ITER
+    if refit.any():
+        disp_map[refit] = _fit_dispersion_grid(counts_nz[refit], mu[refit], x, max_disp,
+                                               np.log(disp_fit[refit]), disp_prior_var)
+    dispersions = np.clip(disp_map, MIN_DISP, max_disp)
+    disp_outlier = np.log(disp_gene_est) > np.log(disp_fit) + OUTLIER_SD * np.sqrt(var_log_disp_ests)
+    dispersions[disp_outlier] = disp_gene_est[disp_outlier]
+
+    beta, sigma, mu = fit_negative_binomial_glm(counts_nz, size_factors, x, dispersions)
+
+    # Cook's distance filtering, only possible with three or more replicates in a condition.
+    # It does not depend on the contrast, so it is done once for all of them.
+    w = mu / (1 + dispersions[:, None] * mu)
+    xtwx_ridge_inv = np.linalg.inv(_weighted_crossprod(x, w) + np.eye(n_coefs) * BETA_RIDGE)
+    hat_diag = w * np.einsum('jp,gpq,jq->gj', x, xtwx_ridge_inv, x)
+    max_cooks = _max_cooks(counts_nz, norm_nz, mu, x, dispersions, hat_diag)
+    cooks_outlier = np.zeros(len(counts_nz), dtype=bool)
+    if max_cooks is not None:
+        cooks_outlier = max_cooks[0] > stats.f.ppf(0.99, n_coefs, n_samples - n_coefs)
+        if len(levels) == 2:
+            # Do not filter genes where three or more counts are larger than the outlier count
+            outlier_count = counts_nz[np.arange(len(counts_nz)), max_cooks[1]]
+            cooks_outlier &= (counts_nz > outlier_count[:, None]).sum(axis=1) < 3
+
+    return {
+        'gene_ids': count_data.genes, 'levels': levels, 'conditions': conditions, 'counts': counts_nz,
+        'base_mean': base_mean, 'nonzero': nonzero, 'beta': beta, 'sigma': sigma, 'cooks_outlier': cooks_outlier,
+    }
+
+
+# Wald tests of all contrasts at once, contrasts is a list of (numerator, denominator) levels.
+# Returns genes x contrasts arrays of log2 fold changes, standard errors, statistics and p-values.
+def wald_tests(beta, sigma, levels, contrasts):
+    c = np.column_stack([contrast_vector(levels, numerator, denominator) for numerator, denominator in contrasts])
+    log2_fold_change = beta @ c / np.log(2)
+    lfc_se = np.sqrt(np.einsum('pk,gpq,qk->gk', c, sigma, c)) / np.log(2)
+    stat = log2_fold_change / lfc_se
+    pvalue = 2 * stats.norm.sf(np.abs(stat))
+    return log2_fold_change, lfc_se, stat, pvalue
+
+
+# Result frame of one contrast: Cook's filtering, zero counts in both levels and independent filtering
+def _contrast_frame(fit, contrast, log2_fold_change, lfc_se, stat, pvalue):
+    pvalue = np.where(fit['cooks_outlier'], np.nan, pvalue)
+    # As in results(), genes without counts in either level of the contrast get a fold change of 0
+    in_contrast = np.isin(fit['conditions'], contrast)
+    both_zero = ~fit['counts'][:, in_contrast].any(axis=1)
+    if both_zero.any():
+        log2_fold_change = np.where(both_zero, 0.0, log2_fold_change)
+        stat = np.where(both_zero, 0.0, stat)
+        pvalue = np.where(both_zero, 1.0, pvalue)
+
+    nonzero = fit['nonzero']
+    results = np.full((len(fit['gene_ids']), len(RESULT_COLUMNS)), np.nan)
+    results[:, 0] = fit['base_mean']
+    results[nonzero, 1:5] = np.column_stack([log2_fold_change, lfc_se, stat, pvalue])
+    results[:, 5] = independent_filtering(fit['base_mean'], results[:, 4])
+    return pd.DataFrame(results, index=pd.Index(fit['gene_ids']), columns=RESULT_COLUMNS)
+
+
+def contrast_results(fit, contrasts, max_workers=CONTRAST_WORKERS):
+    """
+    Extracts every (numerator, denominator) contrast from one fit_deseq() fit.
+    The Wald tests are computed together, the per-contrast filtering runs in parallel threads.
+    Returns one frame per contrast, indexed by gene ID with the same columns as DESeq2's results().
+    """
+    for contrast in contrasts:
+        unknown = [level for level in contrast if level not in fit['levels']]
+        if unknown:
+            raise ValueError(f'No samples of condition {unknown[0]} selected.')
+    tests = wald_tests(fit['beta'], fit['sigma'], fit['levels'], contrasts)
+
+    def _frame(k):
+        return _contrast_frame(fit, contrasts[k], *(values[:, k] for values in tests))
+
+    if len(contrasts) == 1 or max_workers <= 1:
+        return [_frame(k) for k in range(len(contrasts))]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(contrasts))) as executor:
+        return list(executor.map(_frame, range(len(contrasts))))
+
+
+def run_deseq(count_data, conditions_table, reference_condition, contrasts):
+    """
+    Differential expression following DGE_deseq2.r, for every (numerator, denominator) contrast in contrasts.
+    The model and dispersions are fitted once and shared by all contrasts. Returns one frame per contrast.
+    """
+    fit = fit_deseq(count_data, conditions_table, reference_condition)
+    return contrast_results(fit, contrasts)
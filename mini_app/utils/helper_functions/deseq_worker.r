@@ -0,0 +1,107 @@
+suppressPackageStartupMessages(library("DESeq2"))
+suppressPackageStartupMessages(library("BiocParallel"))
+
+# Long-lived DESeq2 worker, started by utils/helper_functions/r_worker_pool.py
+# DESeq2 is loaded once, jobs are read from stdin one per line (tab separated):
+#   RUN, followed by a binary request (layout in utils/helper_functions/r_exchange.py) with the counts,
+#   the conditions of the samples and the contrasts. Every contrast is extracted from the same DESeq()
+#   fit and the results of all of them are written as binary columns to the result file of the request.
+#   PING
+#   QUIT
+# Each job is answered with one line on stdout: OK, ERROR <message> or PONG.
+# DESeq2 messages go to stderr so stdout only carries the protocol.
+
+# Workers extracting the contrasts of one fit
+contrast_workers <- as.integer(Sys.getenv("DE_CONTRAST_WORKERS", "4"))
+format_version <- 1L
+
+# Reads the binary request following a RUN line
+read_request <- function(input) {
+    if (!identical(readBin(input, "raw", 4), charToRaw("DEXQ"))) stop("Unexpected request data")
+    header <- readBin(input, "integer", 4, size=4, endian="little")
+    if (length(header) < 4 || header[1] != format_version) stop("Unsupported request format")
+    n_genes <- header[2]
+    n_samples <- header[3]
+    n_contrasts <- header[4]
+
+    strings <- readBin(input, "character", 2 + 2 * n_samples + 2 * n_contrasts)
+    Encoding(strings) <- "UTF-8"
+    n_counts <- as.double(n_genes) * n_samples
+    counts <- readBin(input, "integer", n_counts, size=4, endian="little")
+    if (length(counts) < n_counts) stop("Incomplete request data")
+
+    samples <- strings[2 + seq_len(n_samples)]
+    contrasts <- strings[2 + 2 * n_samples + seq_len(2 * n_contrasts)]
+    list(
+        reference = strings[1],
+        output = strings[2],
+        counts = matrix(counts, nrow=n_genes, dimnames=list(NULL, samples)),
+        conditions = strings[2 + n_samples + seq_len(n_samples)],
+        numerators = contrasts[seq_len(n_contrasts)],
+        denominators = contrasts[n_contrasts + seq_len(n_contrasts)]
+    )
+}
+
+# Writes the result frames of all contrasts to one binary file
+write_results <- function(results, output) {
+    con <- file(output, "wb")
+    on.exit(close(con))
+    columns <- names(results[[1]])
+    writeBin(charToRaw("DEXR"), con)
+    writeBin(c(format_version, length(results), nrow(results[[1]]), length(columns)), con, size=4, endian="little")
+    writeBin(columns, con)
+    for (res in results) {
+        writeBin(as.double(unlist(res, use.names=FALSE)), con, size=8, endian="little")
+    }
+}
+
+# Same analysis as DGE_deseq2.r, with the model fitted once for all contrasts
+run_deseq <- function(request) {
+    colData <- data.frame(Conditions=factor(request$conditions), row.names=colnames(request$counts))
+
+    dds <- DESeqDataSetFromMatrix(countData = request$counts, colData = colData, design = ~ Conditions)
+    dds$Conditions <- relevel(dds$Conditions, ref = request$reference)
+
+    dds <- DESeq(dds)
+
+    n_contrasts <- length(request$numerators)
+    workers <- max(1, min(n_contrasts, contrast_workers))
+    bpparam <- if (workers > 1) MulticoreParam(workers) else SerialParam()
+    results <- bplapply(seq_len(n_contrasts), function(i) {
+        contrast <- c("Conditions", request$numerators[i], request$denominators[i])
+        as.data.frame(results(dds, contrast=contrast))
+    }, BPPARAM=bpparam)
+    write_results(results, request$output)
+}
+
+# Binary mode, so readLines and readBin share the same unbuffered position in the stream
+input <- file("stdin", open="rb")
+cat("READY\n")
+flush(stdout())
+
+while (length(line <- readLines(input, n=1)) > 0) {
+    fields <- strsplit(line, "\t", fixed=TRUE)[[1]]
+    in_sync <- TRUE
+
+    if (fields[1] == "QUIT") {
+        break
+    } else if (fields[1] == "PING") {
+        reply <- "PONG"
+    } else if (fields[1] == "RUN" && length(fields) == 1) {
+        reply <- tryCatch({
+            request <- tryCatch(read_request(input), error = function(e) {
+                # The rest of the request cannot be told apart from the next job, the worker is replaced
+                in_sync <<- FALSE
+                stop(e)
+            })
+            run_deseq(request)
+            "OK"
+        }, error = function(e) paste("ERROR", gsub("[\r\n\t]", " ", conditionMessage(e)), sep="\t"))
+    } else {
+        reply <- paste("ERROR", "Unknown request", sep="\t")
+    }
+
+    cat(reply, "\n", sep="")
+    flush(stdout())
+    if (!in_sync) break
+}
@@ -0,0 +1,265 @@
+import functools
+import gzip
+import os
+
+import numpy as np
+
+from utils.helper_functions.app_paths import app_path
+from utils.helper_functions.dataset_store import stored_cache
+from utils.helper_functions.volcano import volcano_arrays, volcano_gene_index, highlighted
+
+# Over-representation of gene sets among the significant genes of a DE result.
+# Gene sets are read from the GMT files in GENE_SET_DIR (one set per line: name, description, genes),
+# once per version of the files. For every result they are indexed over its gene universe, the genes
+# with a padj as in the volcano plot, as one sparse array of member positions sorted by set.
+# Testing all sets for new cutoffs is then a lookup of the significant genes at those positions,
+# a bincount per set and one vectorized hypergeometric test, followed by BH adjustment.
+# The hypergeometric tails are summed with the ratio of consecutive probabilities over a window of
+# standard deviations around each overlap, as calling scipy's hypergeom.sf for thousands of sets
+# takes a large fraction of a second.
+# Results are cached per result and cutoffs, so moving the effect size slider back is a cache hit.
+
+GENE_SET_DIR = os.environ.get('GENE_SET_DIR', app_path('utils/gene_sets'))
+GMT_SUFFIXES = ('.gmt', '.gmt.gz')
+# Sets with fewer or more member genes in the universe are not tested
+MIN_SET_SIZE = 10
+MAX_SET_SIZE = 500
+PADJ_CUTOFFS = (0.01, 0.05, 0.1)
+DIRECTIONS = {'both': 'Up and down', 'up': 'Up', 'down': 'Down'}
+ENRICHMENT_ROWS = 100
+# Overlapping genes listed per set in the table
+LISTED_GENES = 10
+# Width of the summed part of the hypergeometric tails, in standard deviations
+TAIL_SDS = 12
+
+
+def gmt_files(directory=GENE_SET_DIR):
+    """
+    (path, mtime, size) of the GMT files in directory, the key the gene sets are cached under.
+    """
+    if not os.path.isdir(directory):
+        return ()
+    files = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(GMT_SUFFIXES):
+            stat = os.stat(os.path.join(directory, name))
+            files.append((os.path.join(directory, name), stat.st_mtime_ns, stat.st_size))
+    return tuple(files)
+
+
+@functools.lru_cache(maxsize=2)
+def load_gene_sets(files):
+    """
+    Gene sets of the given gmt_files(): names, descriptions and source files of the sets, and the
+    lowercased IDs of all their member genes with the number of the set each belongs to.
+    """
+    names, descriptions, sources, members, set_ids = [], [], [], [], []
+    for path, _, _ in files:
+        source = os.path.basename(path)
+        for suffix in GMT_SUFFIXES:
+            source = source.removesuffix(suffix)
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as f:
+            for line in f:
+                fields = line.rstrip('\r\n').split('\t')
+                genes = [gene.strip() for gene in fields[2:] if gene.strip()]
+                if not fields[0].strip() or not genes:
+                    continue
+                set_ids.extend([len(names)] * len(genes))
+                members.extend(genes)
+                names.append(fields[0].strip())
+                descriptions.append(fields[1].strip())
+                sources.append(source)
+    return {
+        'names': names,
+        'descriptions': descriptions,
+        'sources': sources,
+        'members': np.char.lower(np.array(members, dtype=str)),
+        'set_ids': np.array(set_ids, dtype=np.int64),
+    }
+
+
+def warm_up_gene_sets():
+    """
+    Reads the current GMT files, so the first enrichment of a server process does not wait for it.
+    """
+    load_gene_sets(gmt_files())
+
+
+class GeneSetIndex:
+    """
+    Gene sets with MIN_SET_SIZE to MAX_SET_SIZE genes in a result's universe: `sets` (numbers in the
+    loaded gene sets), their `sizes`, and the universe positions of their genes in `members`,
+    set by set from `offsets[i]` to `offsets[i + 1]`.
+    """
+    def __init__(self, gene_sets, gene_index):
+        universe_size = len(gene_index)
+        positions = gene_index.lookup(gene_sets['members'])
+        hit = positions >= 0
+        # Sorted unique (set, gene) pairs, a gene listed twice in a set counts once
+        pairs = np.unique(gene_sets['set_ids'][hit] * universe_size + positions[hit])
+        set_ids, members = np.divmod(pairs, universe_size)
+        sizes = np.bincount(set_ids, minlength=len(gene_sets['names']))
+        tested = (sizes >= MIN_SET_SIZE) & (sizes <= MAX_SET_SIZE)
+
+        self.gene_sets = gene_sets
+        self.universe_size = universe_size
+        self.sets = np.flatnonzero(tested)
+        self.sizes = sizes[self.sets]
+        self.members = members[tested[set_ids]]
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)])
+        # Number of the tested set of every member, for counting overlaps with bincount
+        self._member_sets = np.repeat(np.arange(len(self.sets)), self.sizes)
+
+    def __len__(self):
+        return len(self.sets)
+
+    def overlaps(self, significant):
+        """
+        Number of genes of each set that are True in the boolean universe mask significant.
+        """
+        return np.bincount(self._member_sets[significant[self.members]], minlength=len(self.sets))
+
+    def set_members(self, i):
+        return self.members[self.offsets[i]:self.offsets[i + 1]]
+
+
+@functools.lru_cache(maxsize=4)
+def log_factorials(n):
+    from scipy.special import gammaln
+    return gammaln(np.arange(n + 1) + 1.0)
+
+
+def hypergeometric_sf(k, universe, sizes, drawn):
+    """
+    P(X >= k) for every set, X being the number of the `drawn` genes among the `universe` genes
+    that fall into a set of `sizes` genes.
+    """
+    k, n = np.asarray(k, dtype=np.int64), np.asarray(sizes, dtype=np.int64)
+    lowest, highest = np.maximum(0, n + drawn - universe), np.minimum(n, drawn)
+    mean = n * drawn / max(universe, 1)
+    sd = np.sqrt(mean * (universe - drawn) / max(universe, 1) * (universe - n) / max(universe - 1, 1))
+    log_fact = log_factorials(universe)
+
+    def pmf(x, n):
+        return np.exp(log_fact[drawn] - log_fact[x] - log_fact[drawn - x] + log_fact[universe - drawn]
+                      - log_fact[n - x] - log_fact[universe - drawn - n + x]
+                      - log_fact[universe] + log_fact[n] + log_fact[universe - n])
+
+    def tail(rows, first, step, last):
+        # Sum of P(X = x) from x = first towards last (step 1 or -1), within TAIL_SDS standard deviations
+        width = min(int(np.ceil(TAIL_SDS * (sd[rows].max() + 1))), int(np.abs(last - first).max()) + 1)
+        x = first[:, None] + step * np.arange(width)[None, :]
+        sizes = n[rows, None]
+        # P(X = x) / P(X = x - step), from P(X = x + 1) / P(X = x) = (n - x)(drawn - x) / ((x + 1)(universe - n - drawn + x + 1))
+        below = x - 1 if step == 1 else x
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            ratios = (sizes - below) * (drawn - below) / ((below + 1.0) * (universe - sizes - drawn + below + 1.0))
+            factors = ratios if step == 1 else 1 / ratios
+        factors[:, 0] = 1
+        terms = np.cumprod(np.where(step * (last[:, None] - x) >= 0, factors, 0), axis=1)
+        return pmf(first, n[rows]) * terms.sum(axis=1)
+
+    sf = np.where(k <= lowest, 1.0, 0.0)
+    # Above the mean the upper tail is summed from k up, below it the lower tail from k - 1 down
+    upper = np.flatnonzero((k > lowest) & (k <= highest) & (k > mean))
+    lower = np.flatnonzero((k > lowest) & (k <= highest) & (k <= mean))
+    if len(upper):
+        sf[upper] = tail(upper, k[upper], 1, highest[upper])
+    if len(lower):
+        sf[lower] = 1 - tail(lower, k[lower] - 1, -1, lowest[lower])
+    return np.clip(sf, 0, 1)
+
+
+# Index of the current gene sets over the genes of a stored result
+@stored_cache(maxsize=8)
+def gene_set_index(dataset_key, files):
+    index = volcano_gene_index(dataset_key)
+    if index is None:
+        return None
+    return GeneSetIndex(load_gene_sets(files), index)
+
+
+def significant_genes(x, y, effects, padj_cutoff, direction='both'):
+    """
+    Mask of the genes beyond the effect size lines with a padj below padj_cutoff,
+    for 'up' or 'down' only those with a positive or negative log2FoldChange.
+    """
+    significant = highlighted(x, y, effects, -np.log10(padj_cutoff))
+    if direction == 'up':
+        significant &= x > 0
+    elif direction == 'down':
+        significant &= x < 0
+    return significant
+
+
+@stored_cache(maxsize=64)
+def enrichment(dataset_key, effects, padj_cutoff, direction, files):
+    """
+    Hypergeometric over-representation test of every indexed gene set among the significant genes
+    of a stored result. Returns the index, the significant mask and the overlap, expected overlap,
+    p-value and BH adjusted p-value of every set, or None if the result is gone.
+    """
+    from utils.helper_functions.deseq_engine import p_adjust_bh
+    arrays = volcano_arrays(dataset_key)
+    index = gene_set_index(dataset_key, files)
+    if arrays is None or index is None:
+        return None
+    x, y, _ = arrays
+    significant = significant_genes(x, y, effects, padj_cutoff, direction)
+    n_significant = int(significant.sum())
+    overlaps = index.overlaps(significant)
+    # P(X >= overlap) for X the number of significant genes in a random set of the same size
+    pvalues = hypergeometric_sf(overlaps, index.universe_size, index.sizes, n_significant)
+    return {
+        'index': index,
+        'significant': significant,
+        'overlaps': overlaps,
+        'expected': index.sizes * n_significant / max(index.universe_size, 1),
+        'pvalues': pvalues,
+        'padj': p_adjust_bh(pvalues),
+    }
+
+
+def enrichment_table(dataset_key, effects, padj_cutoff, direction='both', rows=ENRICHMENT_ROWS):
+    """
+    Table records of the `rows` gene sets with the lowest p-values among those with significant genes,
+    and a one line summary of the test.
+    """
+    files = gmt_files()
+    if not files:
+        return [], (f'No gene sets found: add GMT files ({", ".join(GMT_SUFFIXES)}) with the gene IDs of the '
+                    f'count table to {GENE_SET_DIR}, or set GENE_SET_DIR to the folder that has them.')
+    effects = tuple(sorted(float(effect) for effect in effects or (0, 0)))
+    result = enrichment(dataset_key, effects, padj_cutoff, direction, files)
+    if result is None:
+        return [], 'No differential expression data available.'
+
+    index, significant = result['index'], result['significant']
+    if not len(index):
+        n_sets = len(index.gene_sets['names'])
+        return [], (f'None of the {n_sets} gene sets in {len(files)} GMT files has {MIN_SET_SIZE} to {MAX_SET_SIZE} '
+                    f'of the tested genes. The gene sets have to use the gene IDs of the count table.')
+    genes = volcano_arrays(dataset_key)[2]
+    with_overlap = np.flatnonzero(result['overlaps'] > 0)
+    top = with_overlap[np.argsort(result['pvalues'][with_overlap], kind='stable')][:rows]
+    records = []
+    for i in top:
+        members = index.set_members(i)
+        hits = genes[members[significant[members]]]
+        number = index.sets[i]
+        records.append({
+            'Gene set': index.gene_sets['names'][number],
+            'Source': index.gene_sets['sources'][number],
+            'Size': int(index.sizes[i]),
+            'Overlap': int(result['overlaps'][i]),
+            'Expected': round(float(result['expected'][i]), 2),
+            'pvalue': float(f"{result['pvalues'][i]:.3g}"),
+            'padj': float(f"{result['padj'][i]:.3g}"),
+            'Genes': ', '.join(hits[:LISTED_GENES]) + (', ...' if len(hits) > LISTED_GENES else ''),
+        })
+    n_enriched = int((result['padj'] < padj_cutoff).sum())
+    summary = (f'{int(significant.sum())} of {index.universe_size} genes pass the cutoffs. '
+               f'{n_enriched} of {len(index)} gene sets ({MIN_SET_SIZE} to {MAX_SET_SIZE} genes, '
+               f'from {len(files)} GMT files) are enriched with padj < {padj_cutoff}.')
+    return records, summary
@@ -0,0 +1,103 @@
+import functools
+import importlib.util
+import os
+import re
+import tempfile
+
+import pandas as pd
+from flask import abort, send_file
+
+from utils.helper_functions.dataset_store import dataset_store
+
+# Export of stored DE results in several file formats.
+# Each export is written once with pandas' vectorised writers next to the stored frame
+# and then streamed from disk by a Flask route, so the web process never builds the file in memory.
+
+EXPORT_NAME = 'Deseq_results'
+EXPORT_FORMATS = {
+    'csv': {'label': 'CSV', 'extension': 'csv', 'mimetype': 'text/csv'},
+    'tsv.gz': {'label': 'TSV (gzip)', 'extension': 'tsv.gz', 'mimetype': 'application/gzip'},
+    'parquet': {'label': 'Parquet', 'extension': 'parquet', 'mimetype': 'application/octet-stream',
+                'requires': 'pyarrow'},
+    'xlsx': {'label': 'Excel', 'extension': 'xlsx', 'requires': 'openpyxl',
+             'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'},
+}
+DOWNLOAD_ROUTE = '/download/deseq'
+DATASET_KEY = re.compile(r'^[0-9a-f]{40}$')
+# Columns every stored DE result has, other stored datasets (count matrices, normalized counts) are not exported
+RESULT_COLUMNS = ['GeneID', 'baseMean', 'log2FoldChange', 'pvalue', 'padj']
+
+
+# Looks the module up without importing it, the writer is imported on the first export
+@functools.lru_cache(maxsize=None)
+def _importable(module):
+    try:
+        return importlib.util.find_spec(module) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+# Formats whose writer is installed, Parquet and Excel need optional packages
+def available_formats():
+    return [fmt for fmt, spec in EXPORT_FORMATS.items() if 'requires' not in spec or _importable(spec['requires'])]
+
+
+def write_export(df, fmt, path):
+    """
+    Writes a result frame to path in one of the EXPORT_FORMATS.
+    """
+    if fmt == 'csv':
+        df.to_csv(path, index=False)
+    elif fmt == 'tsv.gz':
+        df.to_csv(path, sep='\t', index=False, compression='gzip')
+    elif fmt == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_excel(path, index=False, engine='openpyxl')
+
+
+def export_file(dataset_key, fmt):
+    """
+    Returns the path of the stored result exported as fmt, writing the file on first request.
+    Returns None if the result is no longer stored or the key is not a DE result.
+    """
+    directory = dataset_store.directory(dataset_key)
+    if directory is None:
+        return None
+    path = os.path.join(directory, f"export.{EXPORT_FORMATS[fmt]['extension']}")
+    if os.path.exists(path):
+        return path
+
+    df = dataset_store.get(dataset_key)
+    if not isinstance(df, pd.DataFrame) or not set(RESULT_COLUMNS).issubset(df.columns):
+        return None
+    # Written under a temporary name so a concurrent download never sees a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-export-')
+    os.close(fd)
+    try:
+        write_export(df, fmt, tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return path
+
+
+def export_url(dataset_key, fmt):
+    return f'{DOWNLOAD_ROUTE}/{dataset_key}/{fmt}'
+
+
+def register_export_route(server):
+    """
+    Adds the download route for exported DE results to the Flask server of the app.
+    """
+    @server.route(f'{DOWNLOAD_ROUTE}/<dataset_key>/<fmt>')
+    def download_deseq_results(dataset_key, fmt):
+        if not DATASET_KEY.match(dataset_key) or fmt not in available_formats():
+            abort(404)
+        path = export_file(dataset_key, fmt)
+        if path is None:
+            abort(404)
+        spec = EXPORT_FORMATS[fmt]
+        return send_file(path, mimetype=spec['mimetype'], as_attachment=True,
+                         download_name=f"{EXPORT_NAME}.{spec['extension']}")
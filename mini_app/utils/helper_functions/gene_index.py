@@ -0,0 +1,64 @@
+import numpy as np
+
+from utils.helper_functions.dataset_store import dataset_store, stored_cache
+
+# Gene search over the GeneID column of a stored DE result.
+# The lowercased gene IDs are sorted once per result, a prefix search is then two binary searches
+# on that array, so typeahead stays well under a millisecond on 60k genes.
+
+SEARCH_LIMIT = 50
+# Sorts after every character a gene ID can contain, closes the range of IDs starting with a prefix
+_PREFIX_END = '\U0010ffff'
+
+
+class GeneIndex:
+    """
+    Case-insensitive prefix index over an array of gene IDs.
+    """
+    def __init__(self, genes):
+        self.genes = np.asarray(genes).astype(str)
+        keys = np.char.lower(self.genes)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    def __len__(self):
+        return len(self.genes)
+
+    def search(self, prefix, limit=SEARCH_LIMIT):
+        """
+        Up to `limit` gene IDs starting with prefix, in alphabetical order.
+        """
+        prefix = str(prefix or '').strip().lower()
+        if not prefix:
+            return []
+        start = np.searchsorted(self.keys, prefix, 'left')
+        end = np.searchsorted(self.keys, prefix + _PREFIX_END, 'left')
+        return self.genes[self.order[start:min(end, start + limit)]].tolist()
+
+    def lookup(self, keys):
+        """
+        Position of each of the lowercased gene IDs in keys in the indexed array, -1 for the ones not in it.
+        """
+        keys = np.asarray(keys).astype(str)
+        if not len(self.keys):
+            return np.full(len(keys), -1)
+        found = np.minimum(np.searchsorted(self.keys, keys, 'left'), len(self.keys) - 1)
+        return np.where(self.keys[found] == keys, self.order[found], -1)
+
+    def positions(self, genes):
+        """
+        Positions of the given gene IDs in the indexed array, genes that are not in it are left out.
+        """
+        if not genes:
+            return np.zeros(0, dtype=int)
+        positions = self.lookup(np.char.lower(np.asarray(genes).astype(str)))
+        return positions[positions >= 0]
+
+
+# Gene indexes of the most recently viewed results, keyed by dataset store key
+@stored_cache(maxsize=8)
+def gene_index(dataset_key):
+    df = dataset_store.get(dataset_key)
+    if df is None or 'GeneID' not in df.columns:
+        return None
+    return GeneIndex(df['GeneID'].to_numpy())
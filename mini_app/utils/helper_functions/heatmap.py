@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+from utils.helper_functions.dataset_store import dataset_store, stored_cache
+
+# Clustered heatmap of the top DE genes of a result, drawn from the variance stabilised counts
+# stored with the run (see normalized_counts.py). The matrix and the gene rankings are loaded
+# once per result and kept as arrays, a new number of genes or ranking only slices them
+# and clusters the slice again.
+
+HEATMAP_SIZES = (25, 50, 100, 200, 500)
+# Ranking metrics, the top genes are the first ones in ascending order of the key
+RANK_METRICS = {
+    'padj': {'label': 'padj', 'key': lambda df: df['padj'].to_numpy(dtype=float)},
+    'lfc': {'label': '|log2FoldChange|', 'key': lambda df: -np.abs(df['log2FoldChange'].to_numpy(dtype=float))},
+}
+LINKAGE_METHOD = 'average'
+COLORSCALE = 'RdBu_r'
+
+
+# Gene index, sample names and genes x samples values of stored variance stabilised counts
+@stored_cache(maxsize=4)
+def heatmap_matrix(normalized_key):
+    df = dataset_store.get(normalized_key)
+    if df is None:
+        return None
+    samples = [col for col in df.columns if col != 'GeneID']
+    values = np.column_stack([df[sample].to_numpy(dtype=np.float32) for sample in samples])
+    return pd.Index(df['GeneID'].astype(str)), samples, values
+
+
+# Gene IDs of a stored DE result from best to worst by the metric, genes without a value are left out
+@stored_cache(maxsize=16)
+def ranked_genes(dataset_key, metric):
+    df = dataset_store.get(dataset_key)
+    if df is None:
+        return None
+    key = RANK_METRICS[metric]['key'](df)
+    present = np.flatnonzero(~np.isnan(key))
+    order = present[np.argsort(key[present], kind='stable')]
+    return df['GeneID'].to_numpy().astype(str)[order]
+
+
+# Leaf order of a hierarchical clustering of the rows, on euclidean distances
+def cluster_order(values):
+    if len(values) < 3:
+        return np.arange(len(values))
+    from scipy.cluster.hierarchy import leaves_list, linkage
+    return leaves_list(linkage(values, method=LINKAGE_METHOD, metric='euclidean'))
+
+
+@stored_cache(maxsize=32)
+def heatmap_data(dataset_key, normalized_key, n_genes, metric):
+    """
+    (genes, samples, row z-scores, values) of the top n_genes of a result by metric,
+    with rows and columns in the order of their clustering. None if either dataset is gone.
+    """
+    matrix = heatmap_matrix(normalized_key)
+    ranked = ranked_genes(dataset_key, metric)
+    if matrix is None or ranked is None:
+        return None
+    index, samples, values = matrix
+    rows = index.get_indexer(ranked[:n_genes])
+    rows = rows[rows >= 0]
+    values = values[rows]
+
+    # Rows are centred and scaled so the clustering and the colours show each gene's pattern
+    scale = values.std(axis=1, keepdims=True)
+    z_scores = (values - values.mean(axis=1, keepdims=True)) / np.where(scale > 0, scale, 1)
+    row_order = cluster_order(z_scores)
+    col_order = cluster_order(z_scores.T)
+    genes = index[rows].to_numpy()[row_order]
+    return (genes, [samples[i] for i in col_order], z_scores[np.ix_(row_order, col_order)],
+            values[np.ix_(row_order, col_order)])
+
+
+def heatmap_figure(dataset_key, normalized_key, n_genes, metric):
+    """
+    Plotly figure dict of the clustered heatmap, or None if the result or its counts are gone.
+    """
+    data = heatmap_data(dataset_key, normalized_key, n_genes, metric)
+    if data is None:
+        return None
+    genes, samples, z_scores, values = data
+    trace = {
+        'type': 'heatmap',
+        'z': np.round(z_scores, 3).tolist(),
+        'x': samples,
+        'y': genes.tolist(),
+        'customdata': np.round(values, 3).tolist(),
+        'colorscale': COLORSCALE,
+        'zmid': 0,
+        'colorbar': {'title': {'text': 'Row z-score'}},
+        'hovertemplate': '%{y}<br>%{x}<br>VST: %{customdata}<br>z-score: %{z}<extra></extra>',
+    }
+    layout = {
+        'title': {'text': f'Top {len(genes)} genes by {RANK_METRICS[metric]["label"]}', 'x': 0.5},
+        'height': max(400, 150 + 14 * len(genes)),
+        'xaxis': {'tickangle': -45},
+        # First row of the clustering at the top
+        'yaxis': {'autorange': 'reversed', 'showticklabels': len(genes) <= 100},
+        'margin': {'l': 150},
+    }
+    return {'data': [trace], 'layout': layout}
@@ -0,0 +1,240 @@
+import collections
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from utils.helper_functions.registry import registry, process_owner, owner_alive, to_json, from_json
+
+# Background job scheduler for long running analyses.
+# At most `max_concurrent` jobs run at a time, the rest wait in a bounded queue.
+# Every job gets its own temporary working directory which is removed when it ends.
+# Jobs run in the server process that accepted them and are mirrored in the shared registry,
+# so any other server process can report their status and cancel them.
+
+MAX_CONCURRENT = int(os.environ.get('DE_JOB_CONCURRENCY', 2))
+MAX_QUEUED = int(os.environ.get('DE_JOB_QUEUE_DEPTH', 20))
+JOB_RETENTION = 3600
+# How often a process looks for cancel requests made through other processes
+CANCEL_POLL_INTERVAL = 1.0
+WORKDIR_ROOT = os.environ.get('DE_JOB_WORKDIR', None)
+
+
+class JobQueueFull(RuntimeError):
+    pass
+
+
+class JobCancelled(RuntimeError):
+    pass
+
+
+class Job:
+    def __init__(self, fn, args, on_update=None):
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.args = args
+        self.status = 'queued'
+        self.progress = ''
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.workdir = None
+        self.cancel_event = threading.Event()
+        self.on_update = on_update
+
+    def set_progress(self, message):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+        self.progress = message
+        if self.on_update is not None:
+            self.on_update(self)
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'progress': self.progress,
+            'elapsed': self.elapsed(),
+            'waited': (self.started or time.time()) - self.submitted,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+class JobScheduler:
+    """
+    Runs submitted functions as fn(job, *args) on background threads.
+    The function should call job.set_progress() between steps and stop when job.cancel_event is set.
+    """
+    def __init__(self, max_concurrent=MAX_CONCURRENT, max_queued=MAX_QUEUED, workdir_root=WORKDIR_ROOT,
+                 registry=registry):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.workdir_root = workdir_root
+        self.registry = registry
+        self._jobs = {}
+        self._pending = collections.deque()
+        self._running = 0
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    def submit(self, fn, *args):
+        with self._lock:
+            self._purge()
+            if len(self._pending) >= self.max_queued:
+                raise JobQueueFull(f'{len(self._pending)} jobs are already waiting, please try again later.')
+            job = Job(fn, args, on_update=self._save)
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._save(job)
+            self._watch_cancel_requests()
+        self._dispatch()
+        return job.id
+
+    def _save(self, job):
+        # Mirrors the job in the registry, the result must be JSON serialisable.
+        # A cancel request stored by another process is never cleared here.
+        self.registry.execute(
+            'INSERT INTO jobs (id, owner, status, progress, submitted, started, finished, result, error, '
+            'cancel_requested) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET status = excluded.status, progress = excluded.progress, '
+            'started = excluded.started, finished = excluded.finished, result = excluded.result, '
+            'error = excluded.error, cancel_requested = MAX(cancel_requested, excluded.cancel_requested)',
+            (job.id, process_owner(), job.status, job.progress, job.submitted, job.started, job.finished,
+             to_json(job.result), job.error, int(job.cancel_event.is_set()))
+        )
+
+    def _watch_cancel_requests(self):
+        # Started with the first job, a daemon thread applying cancel requests stored by other processes
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+
+        def _watch():
+            while True:
+                time.sleep(CANCEL_POLL_INTERVAL)
+                with self._lock:
+                    active = [job.id for job in self._jobs.values() if job.finished is None]
+                if not active:
+                    continue
+                rows = self.registry.execute(
+                    f"SELECT id FROM jobs WHERE cancel_requested = 1 AND id IN ({','.join('?' * len(active))})",
+                    active
+                ).fetchall()
+                for row in rows:
+                    self.cancel(row['id'])
+
+        self._watcher = threading.Thread(target=_watch, daemon=True)
+        self._watcher.start()
+
+    def _dispatch(self):
+        with self._lock:
+            while self._running < self.max_concurrent and self._pending:
+                job = self._pending.popleft()
+                self._running += 1
+                job.status = 'running'
+                job.started = time.time()
+                self._save(job)
+                threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _run(self, job):
+        try:
+            if self.workdir_root:
+                os.makedirs(self.workdir_root, exist_ok=True)
+            job.workdir = tempfile.mkdtemp(prefix=f'de-job-{job.id[:8]}-', dir=self.workdir_root)
+            job.result = job.fn(job, *job.args)
+            job.status = 'cancelled' if job.cancel_event.is_set() else 'finished'
+        except Exception as e:
+            if job.cancel_event.is_set():
+                job.status = 'cancelled'
+            else:
+                job.status = 'failed'
+                job.error = str(e) or type(e).__name__
+        finally:
+            job.finished = time.time()
+            if job.workdir:
+                shutil.rmtree(job.workdir, ignore_errors=True)
+            self._save(job)
+            with self._lock:
+                self._running -= 1
+            self._dispatch()
+
+    def _purge(self):
+        # Forget jobs that ended more than JOB_RETENTION seconds ago
+        now = time.time()
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished is not None and now - job.finished > JOB_RETENTION]:
+            del self._jobs[job_id]
+        self.registry.execute('DELETE FROM jobs WHERE finished < ?', (now - JOB_RETENTION,))
+
+    def cancel(self, job_id):
+        """
+        Cancels a queued job straight away, a running job is asked to stop through its cancel_event.
+        Jobs of other server processes are flagged in the registry and cancelled by their process.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                cursor = self.registry.execute(
+                    'UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND finished IS NULL', (job_id,)
+                )
+                return cursor.rowcount > 0
+            if job.finished is not None:
+                return False
+            job.cancel_event.set()
+            if job in self._pending:
+                self._pending.remove(job)
+                job.status = 'cancelled'
+                job.finished = time.time()
+            self._save(job)
+        return True
+
+    def status(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return self._registry_status(job_id)
+        status = job.to_dict()
+        if job.status == 'queued':
+            with self._lock:
+                status['position'] = self._pending.index(job) + 1 if job in self._pending else 0
+        return status
+
+    def _registry_status(self, job_id):
+        # Status of a job run by another server process
+        row = self.registry.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        row = dict(row)
+        if row['finished'] is None and not owner_alive(row['owner']):
+            row.update(status='failed', error='The server process running the analysis has stopped.',
+                       finished=time.time())
+            self.registry.execute('UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ? AND finished IS NULL',
+                                  (row['status'], row['error'], row['finished'], job_id))
+        now = time.time()
+        status = {
+            'id': job_id,
+            'status': row['status'],
+            'progress': row['progress'],
+            'elapsed': 0.0 if row['started'] is None else (row['finished'] or now) - row['started'],
+            'waited': (row['started'] or now) - row['submitted'],
+            'result': from_json(row['result']),
+            'error': row['error'],
+        }
+        if row['status'] == 'queued':
+            status['position'] = self.registry.execute(
+                "SELECT COUNT(*) FROM jobs WHERE owner = ? AND status = 'queued' AND submitted <= ?",
+                (row['owner'], row['submitted'])
+            ).fetchone()[0]
+        return status
+
+
+# Scheduler shared by all DE runs of the app
+de_job_scheduler = JobScheduler()
@@ -0,0 +1,296 @@
+import bisect
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+
+import dash
+from flask import Response, g, jsonify, request
+
+from utils.helper_functions.app_paths import app_path
+from utils.helper_functions.registry import process_owner, owner_alive
+
+# Instrumentation of the Dash callbacks and the DE engines, exported in the Prometheus text format.
+# Two views of every callback are kept:
+#   dash_callback_seconds          time spent in the callback function itself (instrumented_callback)
+#   dash_request_seconds           the whole /_dash-update-component request, including JSON parsing
+#                                  and serialisation, with the request and response sizes in bytes
+# The DE engines report their phases (input write, engine run, result read) through phase_timer().
+# Each server process writes a snapshot of its metrics to METRICS_DIR about once a second, and
+# /metrics adds up the snapshots of all processes. GET /metrics serves them to local clients.
+# With CALLBACK_PROFILE_TOGGLE=1, POST /metrics/profile with enable=1 makes the process that receives it
+# dump a cProfile file for every following callback request. The flag is per process, like
+# PROFILE_CALLBACKS at startup, so with several workers each one has to be switched on its own.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SIZE_BUCKETS = tuple(4 ** i * 256 for i in range(10))  # 256 B to 64 MB
+# Stores whose size is reported on their own whenever a callback sends or receives them
+TRACKED_STORES = ('gc-filestorage', 'diff-exp-content', 'de-results', 'conditions_table')
+METRICS_ROUTE = '/metrics'
+METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC', '0') == '1'
+PROFILE_DIR = os.environ.get('CALLBACK_PROFILE_DIR', app_path('utils/outputs/profiles'))
+# The profiling toggle route only exists when this is set
+PROFILE_TOGGLE = os.environ.get('CALLBACK_PROFILE_TOGGLE', '0') == '1'
+LOCAL_ADDRESSES = ('127.0.0.1', '::1', None)
+METRICS_DIR = os.environ.get('METRICS_DIR', app_path('utils/outputs/cache/metrics'))
+SNAPSHOT_INTERVAL = 1.0
+# Snapshots of stopped processes are dropped after this many seconds
+SNAPSHOT_RETENTION = 24 * 3600
+
+
+class Histogram:
+    def __init__(self, buckets, counts=None, total=0.0):
+        self.buckets = tuple(buckets)
+        self.counts = list(counts) if counts is not None else [0] * (len(buckets) + 1)
+        self.sum = total
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and histograms keyed by metric name and label values.
+    With a snapshot_dir, the metrics of every process using the same directory are reported together.
+    """
+    def __init__(self, snapshot_dir=None):
+        self.snapshot_dir = snapshot_dir
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._last_snapshot = 0.0
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._snapshot()
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+            self._snapshot()
+
+    def _state(self):
+        return {
+            'counters': [[name, labels, value] for (name, labels), value in self._counters.items()],
+            'histograms': [[name, labels, h.buckets, h.counts, h.sum] for (name, labels), h in self._histograms.items()],
+        }
+
+    def _snapshot(self, force=False):
+        # Called with the lock held, writes this process's metrics at most every SNAPSHOT_INTERVAL seconds
+        now = time.time()
+        if self.snapshot_dir is None or (not force and now - self._last_snapshot < SNAPSHOT_INTERVAL):
+            return
+        self._last_snapshot = now
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.snapshot_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._state(), f)
+        os.replace(tmp_path, os.path.join(self.snapshot_dir, f'{process_owner()}.json'))
+
+    def _merged(self):
+        # Own metrics plus the latest snapshots of the other processes
+        counters = dict(self._counters)
+        histograms = {key: Histogram(h.buckets, h.counts, h.sum) for key, h in self._histograms.items()}
+        if self.snapshot_dir is None or not os.path.isdir(self.snapshot_dir):
+            return counters, histograms
+        own = f'{process_owner()}.json'
+        for entry in os.scandir(self.snapshot_dir):
+            if entry.name == own or entry.name.startswith('.') or not entry.name.endswith('.json'):
+                continue
+            if not owner_alive(entry.name[:-5]) and time.time() - entry.stat().st_mtime > SNAPSHOT_RETENTION:
+                os.remove(entry.path)
+                continue
+            try:
+                with open(entry.path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in state['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, buckets, counts, total in state['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                histogram = histograms.get(key)
+                if histogram is None:
+                    histograms[key] = Histogram(buckets, counts, total)
+                elif list(histogram.buckets) == list(buckets):
+                    histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                    histogram.sum += total
+        return counters, histograms
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        def _labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+            return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+        lines = []
+        with self._lock:
+            self._snapshot(force=True)
+            counters, histograms = self._merged()
+            for kind, entries in (('counter', counters), ('histogram', histograms)):
+                for name in sorted({name for name, _ in entries}):
+                    if name in self._help:
+                        lines.append(f'# HELP {name} {self._help[name]}')
+                    lines.append(f'# TYPE {name} {kind}')
+                    for (metric, labels), value in sorted(entries.items(), key=lambda item: item[0]):
+                        if metric != name:
+                            continue
+                        if kind == 'counter':
+                            lines.append(f'{name}{_labels(labels)} {value}')
+                            continue
+                        cumulative = 0
+                        for bound, count in zip(value.buckets + ('+Inf',), value.counts):
+                            cumulative += count
+                            lines.append(f'{name}_bucket{_labels(labels, [("le", bound)])} {cumulative}')
+                        lines.append(f'{name}_sum{_labels(labels)} {value.sum}')
+                        lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+# Registry of this server process, reporting the metrics of all of them
+metrics = MetricsRegistry(METRICS_DIR)
+metrics.describe('dash_callback_calls_total', 'Calls of each Dash callback function.')
+metrics.describe('dash_callback_errors_total', 'Callback calls that raised an exception other than PreventUpdate.')
+metrics.describe('dash_callback_seconds', 'Time spent in the callback function.')
+metrics.describe('dash_request_seconds', 'Time of the whole callback request, including JSON parsing and serialisation.')
+metrics.describe('dash_request_bytes', 'Size of the callback request body.')
+metrics.describe('dash_response_bytes', 'Size of the callback response body.')
+metrics.describe('dash_store_bytes', 'JSON size of the tracked dcc.Store values sent to or from a callback.')
+metrics.describe('de_engine_phase_seconds', 'Time of each phase of a DE engine run.')
+
+
+def instrumented_callback(*args, **kwargs):
+    """
+    Drop-in replacement for dash.callback that counts and times every call of the decorated function.
+    """
+    register = dash.callback(*args, **kwargs)
+
+    def _decorator(fn):
+        @functools.wraps(fn)
+        def _timed(*fn_args, **fn_kwargs):
+            start_time = time.perf_counter()
+            try:
+                return fn(*fn_args, **fn_kwargs)
+            except dash.exceptions.PreventUpdate:
+                raise
+            except Exception:
+                metrics.inc('dash_callback_errors_total', callback=fn.__name__)
+                raise
+            finally:
+                metrics.inc('dash_callback_calls_total', callback=fn.__name__)
+                metrics.observe('dash_callback_seconds', time.perf_counter() - start_time, callback=fn.__name__)
+        return register(_timed)
+    return _decorator
+
+
+@contextlib.contextmanager
+def phase_timer(engine, phase):
+    """
+    Times one phase of a DE engine run, e.g. `with phase_timer('r', 'engine_run'): ...`.
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('de_engine_phase_seconds', time.perf_counter() - start_time, engine=engine, phase=phase)
+
+
+def _store_sizes(values, direction):
+    # values is a list of {'id': ..., 'property': ..., 'value': ...} from a callback request
+    for item in values or []:
+        if isinstance(item, dict) and item.get('id') in TRACKED_STORES:
+            size = len(json.dumps(item.get('value')))
+            metrics.observe('dash_store_bytes', size, SIZE_BUCKETS, store=item['id'], direction=direction)
+
+
+def _callback_name(app, output):
+    entry = app.callback_map.get(output)
+    return getattr(entry.get('callback'), '__name__', output) if entry else output
+
+
+def register_metrics(app):
+    """
+    Adds the request instrumentation, the /metrics route and the profiling toggle to a Dash app.
+    """
+    server = app.server
+    state = {'profile': os.environ.get('PROFILE_CALLBACKS', '0') == '1'}
+
+    def _is_callback_request():
+        return request.method == 'POST' and request.path.endswith('_dash-update-component')
+
+    @server.before_request
+    def _start_request_metrics():
+        if not _is_callback_request():
+            return
+        g.metrics_start = time.perf_counter()
+        if state['profile']:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @server.after_request
+    def _record_request_metrics(response):
+        if 'metrics_start' not in g:
+            return response
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+        body = request.get_json(silent=True) or {}
+        name = _callback_name(app, body.get('output', ''))
+        metrics.observe('dash_request_seconds', time.perf_counter() - g.pop('metrics_start'), callback=name)
+        metrics.observe('dash_request_bytes', request.content_length or 0, SIZE_BUCKETS, callback=name)
+        if not response.is_streamed:
+            metrics.observe('dash_response_bytes', response.calculate_content_length() or 0, SIZE_BUCKETS,
+                            callback=name)
+            if response.status_code == 200 and any(store in body.get('output', '') for store in TRACKED_STORES):
+                outputs = json.loads(response.get_data()).get('response', {})
+                _store_sizes([{'id': store_id, 'value': value} for store_id, props in outputs.items()
+                              for value in props.values()], 'output')
+        _store_sizes(body.get('inputs'), 'input')
+        _store_sizes(body.get('state'), 'input')
+        if profiler is not None:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(os.path.join(PROFILE_DIR, f'{time.time_ns()}-{name}.prof'))
+        return response
+
+    def _local_only():
+        return METRICS_PUBLIC or request.remote_addr in LOCAL_ADDRESSES
+
+    @server.route(METRICS_ROUTE)
+    def prometheus_metrics():
+        if not _local_only():
+            return Response('Forbidden\n', status=403, mimetype='text/plain')
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    if not PROFILE_TOGGLE:
+        return
+
+    # Switches profiling of the process serving the request, enable comes as a form or query parameter
+    @server.route(f'{METRICS_ROUTE}/profile', methods=['POST'])
+    def callback_profiling():
+        if not _local_only():
+            return jsonify({'error': 'Forbidden'}), 403
+        enable = request.values.get('enable')
+        if enable is not None:
+            state['profile'] = enable in ('1', 'true', 'on')
+        return jsonify({'profile': state['profile'], 'directory': PROFILE_DIR, 'pid': os.getpid()})
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+
+from utils.helper_functions.count_matrix import CountMatrix
+
+# Variance stabilised counts of the samples of a DE run, computed once per run and stored with its results.
+# Follows DESeq2's vst() with its defaults: blind to the design, median-of-ratios size factors and a
+# parametric dispersion trend fitted on 1000 genes spread over the range of mean counts, falling back
+# to the mean dispersion when the trend cannot be fitted. The values are on a log2-like scale.
+
+VST_SUBSET = 1000
+VST_MIN_MEAN = 5
+
+
+# Genes the dispersion trend is fitted on, evenly spaced over the ranks of their mean counts
+def _trend_genes(base_mean, n_genes):
+    candidates = np.flatnonzero(base_mean > VST_MIN_MEAN)
+    if len(candidates) < n_genes:
+        return np.flatnonzero(base_mean > 0)
+    ranked = candidates[np.argsort(base_mean[candidates], kind='stable')]
+    return ranked[np.round(np.linspace(0, len(ranked) - 1, n_genes)).astype(int)]
+
+
+def variance_stabilized(count_data, samples, n_subset=VST_SUBSET):
+    """
+    Frame with a GeneID column and one float32 column of variance stabilised values per sample.
+    count_data is a CountMatrix or a frame with the gene IDs in the first column.
+    """
+    from utils.helper_functions.deseq_engine import (estimate_size_factors, estimate_gene_dispersions,
+                                                     dispersion_trend_coefs, mean_dispersion)
+    if not isinstance(count_data, CountMatrix):
+        count_data = CountMatrix.from_frame(count_data)
+    samples = list(samples)
+    counts = count_data.select(samples).array().astype(float)
+    if counts.shape[1] < 2:
+        raise ValueError('Variance stabilised counts need at least two samples.')
+
+    size_factors = estimate_size_factors(counts)
+    norm_counts = counts / size_factors
+    base_mean = norm_counts.mean(axis=1)
+
+    # Dispersions of a design with only an intercept, so the values do not depend on the conditions
+    genes = _trend_genes(base_mean, n_subset)
+    x = np.ones((counts.shape[1], 1))
+    disp_gene_est, _ = estimate_gene_dispersions(counts[genes], norm_counts[genes], size_factors, x,
+                                                 max(10, counts.shape[1]))
+    coefs = dispersion_trend_coefs(base_mean[genes], disp_gene_est)
+    if coefs is not None:
+        asympt_disp, extra_pois = coefs
+        values = np.log((1 + extra_pois + 2 * asympt_disp * norm_counts
+                         + 2 * np.sqrt(asympt_disp * norm_counts * (1 + extra_pois + asympt_disp * norm_counts)))
+                        / (4 * asympt_disp)) / np.log(2)
+    else:
+        alpha = mean_dispersion(disp_gene_est)
+        values = (2 * np.arcsinh(np.sqrt(alpha * norm_counts)) - np.log(alpha) - np.log(4)) / np.log(2)
+
+    vst = pd.DataFrame(values.astype(np.float32), columns=samples)
+    vst.insert(0, 'GeneID', count_data.genes)
+    return vst
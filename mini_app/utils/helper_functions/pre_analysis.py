@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils.helper_functions.dataset_store import dataset_store, stored_cache
+
+# Pre-analysis stage run between the sample selection and the DE engine:
+# per-sample library QC and a minimum count / minimum samples filter on genes.
+# Both are computed on the whole count matrix at once and cached per dataset.
+# The filter is off unless set, so by default every gene goes to the DE engine as before.
+
+MIN_COUNT = int(os.environ.get('DE_FILTER_MIN_COUNT', 0))
+MIN_SAMPLES = int(os.environ.get('DE_FILTER_MIN_SAMPLES', 0))
+
+
+@stored_cache(maxsize=16)
+def library_qc(dataset_key):
+    """
+    Library size, fraction of zero counts and number of detected genes of every sample in a stored count matrix.
+    """
+    count_matrix = dataset_store.get(dataset_key)
+    if count_matrix is None:
+        return None
+    counts = count_matrix.array()
+    detected = np.count_nonzero(counts, axis=0)
+    return pd.DataFrame({
+        'Samples': count_matrix.samples,
+        'library_size': counts.sum(axis=0, dtype=np.uint64),
+        'zero_fraction': 1 - detected / counts.shape[0],
+        'detected_genes': detected,
+    })
+
+
+@stored_cache(maxsize=64)
+def gene_filter(dataset_key, samples, min_count=MIN_COUNT, min_samples=MIN_SAMPLES):
+    """
+    Boolean mask of the genes with at least min_count reads in at least min_samples of the given samples.
+    """
+    count_matrix = dataset_store.get(dataset_key)
+    if count_matrix is None:
+        return None
+    return low_count_mask(count_matrix.select(list(samples)), min_count, min_samples)
+
+
+def low_count_mask(count_matrix, min_count=MIN_COUNT, min_samples=MIN_SAMPLES):
+    """
+    Boolean mask of the genes with at least min_count reads in at least min_samples samples of count_matrix.
+    """
+    counts = count_matrix.array()
+    if min_count <= 0 or min_samples <= 0:
+        return np.ones(counts.shape[0], dtype=bool)
+    return np.count_nonzero(counts >= min_count, axis=1) >= min_samples
+
+
+def _apply_mask(selected, mask):
+    if mask.all():
+        return selected
+    return selected.take_genes(mask)
+
+
+def filter_counts(dataset_key, samples, min_count=MIN_COUNT, min_samples=MIN_SAMPLES):
+    """
+    Count matrix of the selected samples keeping only the genes that pass gene_filter.
+    """
+    count_matrix = dataset_store.get(dataset_key)
+    if count_matrix is None:
+        return None
+    selected = count_matrix.select(list(samples))
+    return _apply_mask(selected, gene_filter(dataset_key, tuple(samples), min_count, min_samples))
+
+
+def filter_count_matrix(count_matrix, samples, min_count=MIN_COUNT, min_samples=MIN_SAMPLES):
+    """
+    Same as filter_counts for a count matrix that is not in the dataset store (e.g. in batch runs).
+    """
+    selected = count_matrix.select(list(samples))
+    return _apply_mask(selected, low_count_mask(selected, min_count, min_samples))
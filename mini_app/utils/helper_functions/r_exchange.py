@@ -0,0 +1,91 @@
+import itertools
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from utils.helper_functions.count_matrix import CountMatrixError
+
+# Binary exchange of a DE run with the DESeq2 worker (deseq_worker.r), instead of CSV files.
+# The request follows the RUN line on the worker's stdin:
+#   'DEXQ', int32 version, genes, samples, contrasts
+#   NUL terminated UTF-8 strings: reference condition, result path, sample names, their conditions,
+#   the numerators and the denominators of the contrasts
+#   the counts as int32, one sample after the other (column-major, as R stores a matrix)
+# The counts are streamed from the count matrix one sample at a time, nothing is written to disk.
+# The worker writes the results of all contrasts to one file at the result path:
+#   'DEXR', int32 version, contrasts, genes, columns, NUL terminated column names
+#   float64 values, contrast by contrast and column by column
+# Result files are created in EXCHANGE_DIR, shared memory (/dev/shm) when the host has it.
+# All numbers are little-endian, R's NA is read as NaN.
+
+REQUEST_MAGIC = b'DEXQ'
+RESULT_MAGIC = b'DEXR'
+FORMAT_VERSION = 1
+# R integers are signed 32 bit
+R_INTEGER_MAX = np.iinfo(np.int32).max
+EXCHANGE_DIR = os.environ.get('DESEQ_EXCHANGE_DIR', '/dev/shm' if os.path.isdir('/dev/shm') else '')
+
+
+def _strings(values):
+    return b''.join(str(value).encode() + b'\0' for value in values)
+
+
+def result_path(workdir):
+    """
+    New empty file for the results of a run, in EXCHANGE_DIR or else in workdir.
+    """
+    fd, path = tempfile.mkstemp(prefix='de_out_', suffix='.bin', dir=EXCHANGE_DIR or workdir)
+    os.close(fd)
+    return path
+
+
+def encode_request(count_data, conditions_table, contrasts, output_path):
+    """
+    Chunks (bytes) of the request for the samples in conditions_table, the reference level is the
+    numerator of the first contrast. The counts are checked here, before anything is sent, and
+    converted one sample at a time while the chunks are written.
+    """
+    samples = conditions_table['Samples'].astype(str).tolist()
+    count_data = count_data.select(samples)
+    if len(count_data.genes) and max(int(count_data.column(sample).max()) for sample in samples) > R_INTEGER_MAX:
+        raise CountMatrixError(f'DESeq2 takes counts up to {R_INTEGER_MAX}.')
+
+    header = REQUEST_MAGIC + np.array([FORMAT_VERSION, len(count_data.genes), len(samples), len(contrasts)],
+                                      dtype='<i4').tobytes()
+    header += _strings([contrasts[0][0], output_path] + samples
+                       + conditions_table['Conditions'].astype(str).tolist()
+                       + [numerator for numerator, _ in contrasts] + [denominator for _, denominator in contrasts])
+    columns = (count_data.column(sample).astype('<i4').tobytes() for sample in samples)
+    return itertools.chain([header], columns)
+
+
+def read_results(path, genes):
+    """
+    One result frame per contrast from a result file, with the gene IDs in a 'GeneID' column
+    followed by the DESeq2 result columns.
+    """
+    with open(path, 'rb') as f:
+        data = bytearray(os.fstat(f.fileno()).st_size)
+        f.readinto(data)
+    if data[:4] != RESULT_MAGIC:
+        raise ValueError('The DESeq2 worker did not write a result file.')
+    version, n_contrasts, n_genes, n_columns = np.frombuffer(data, '<i4', 4, 4).tolist()
+    if version != FORMAT_VERSION or n_genes != len(genes):
+        raise ValueError('The DESeq2 result file does not match the request.')
+
+    offset = 20
+    columns = []
+    for _ in range(n_columns):
+        end = data.index(0, offset)
+        columns.append(data[offset:end].decode())
+        offset = end + 1
+    values = np.frombuffer(data, '<f8', n_contrasts * n_columns * n_genes, offset)
+    genes = np.asarray(genes).astype(object)
+    de_dfs = []
+    for block in values.reshape(n_contrasts, n_columns, n_genes):
+        de_df = pd.DataFrame(dict(zip(columns, block)))
+        de_df.insert(0, 'GeneID', genes)
+        de_dfs.append(de_df)
+    return de_dfs
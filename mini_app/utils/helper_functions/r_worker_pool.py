@@ -0,0 +1,274 @@
+import os
+import queue
+import subprocess
+import threading
+import time
+
+from utils.helper_functions.app_paths import app_path
+
+# Pool of long-lived Rscript processes running deseq_worker.r.
+# Each worker loads DESeq2 once and then takes jobs over its stdin/stdout pipes,
+# so a DE run only pays for the DESeq2 computation and not for R startup.
+# The pipes are binary: protocol lines are UTF-8 text, the RUN line is followed by the request data.
+
+WORKER_SCRIPT = app_path('utils/helper_functions/deseq_worker.r')
+
+# Defaults, can be overridden through the environment
+POOL_SIZE = int(os.environ.get('DESEQ_R_POOL_SIZE', 2))
+MAX_JOBS_PER_WORKER = int(os.environ.get('DESEQ_R_MAX_JOBS', 50))
+JOB_TIMEOUT = float(os.environ.get('DESEQ_R_JOB_TIMEOUT', 600))
+STARTUP_TIMEOUT = float(os.environ.get('DESEQ_R_STARTUP_TIMEOUT', 120))
+HEALTH_CHECK_TIMEOUT = 5
+# A worker that fails to start is started again up to SPAWN_ATTEMPTS times, waiting SPAWN_BACKOFF seconds
+# after the first failure and twice as long after each further one
+SPAWN_ATTEMPTS = 3
+SPAWN_BACKOFF = 1
+
+
+class RWorkerError(RuntimeError):
+    pass
+
+
+class RWorkerCancelled(RWorkerError):
+    pass
+
+
+class RWorker:
+    """
+    One Rscript process speaking the line protocol of deseq_worker.r
+    """
+    def __init__(self, command, startup_timeout=STARTUP_TIMEOUT):
+        self.jobs_done = 0
+        # stderr is inherited so DESeq2 messages show up in the server log as before
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._lines = queue.Queue()
+        threading.Thread(target=self._read_stdout, daemon=True).start()
+        try:
+            if self._read_line(startup_timeout) != 'READY':
+                raise RWorkerError('R worker did not start correctly')
+        except Exception:
+            self.close()
+            raise
+
+    def _read_stdout(self):
+        for line in self.process.stdout:
+            self._lines.put(line.decode(errors='replace').rstrip('\n'))
+        # None marks the end of the stream, i.e. the worker exited
+        self._lines.put(None)
+
+    def _read_line(self, timeout, cancel_event=None):
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f'R worker did not answer within {timeout} seconds')
+            if cancel_event is not None and cancel_event.is_set():
+                raise RWorkerCancelled('R worker job was cancelled')
+            try:
+                line = self._lines.get(timeout=min(remaining, 0.2))
+                break
+            except queue.Empty:
+                continue
+        if line is None:
+            raise RWorkerError(f'R worker exited with code {self.process.wait()}')
+        return line
+
+    def request(self, fields, timeout, cancel_event=None, data=()):
+        # data is an iterable of bytes chunks sent after the request line
+        try:
+            self.process.stdin.write(('\t'.join(fields) + '\n').encode())
+            for chunk in data:
+                self.process.stdin.write(chunk)
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            raise RWorkerError('R worker is not accepting jobs')
+        return self._read_line(timeout, cancel_event)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def ping(self, timeout=HEALTH_CHECK_TIMEOUT):
+        try:
+            return self.is_alive() and self.request(['PING'], timeout) == 'PONG'
+        except (TimeoutError, RWorkerError):
+            return False
+
+    def close(self, force=False):
+        if force and self.is_alive():
+            self.process.kill()
+            self.process.wait()
+        if self.is_alive():
+            try:
+                self.process.stdin.write(b'QUIT\n')
+                self.process.stdin.flush()
+                self.process.wait(timeout=2)
+            except (BrokenPipeError, OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+
+
+class RWorkerPool:
+    """
+    Keeps `size` warm R workers. A worker is recycled after `max_jobs_per_worker` jobs,
+    after a crash, a failed health check or a job running longer than `job_timeout` seconds.
+    Workers that could not be started are started again when a job next waits for one.
+    """
+    def __init__(self, size=POOL_SIZE, max_jobs_per_worker=MAX_JOBS_PER_WORKER, job_timeout=JOB_TIMEOUT,
+                 startup_timeout=STARTUP_TIMEOUT, command=('Rscript', WORKER_SCRIPT)):
+        self.size = size
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.job_timeout = job_timeout
+        self.startup_timeout = startup_timeout
+        self.command = list(command)
+        self._idle = queue.Queue()
+        self._started = False
+        self._closed = False
+        self._lock = threading.Lock()
+        self._startup_error = None
+        # Workers alive (idle or busy) or starting, the pool is topped up to size from this
+        self._workers = 0
+
+    def start(self):
+        # Workers are started in the background so the caller is not blocked by R startup
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self._top_up()
+
+    def _start_worker(self):
+        # Runs in its own thread, counted in _workers until the worker is up or every attempt failed
+        for attempt in range(SPAWN_ATTEMPTS):
+            if attempt:
+                time.sleep(SPAWN_BACKOFF * 2 ** (attempt - 1))
+            if self._closed:
+                break
+            try:
+                worker = RWorker(self.command, self.startup_timeout)
+            except Exception as e:
+                self._startup_error = e
+                continue
+            self._startup_error = None
+            if not self._closed:
+                self._idle.put(worker)
+                return
+            worker.close()
+            break
+        with self._lock:
+            self._workers -= 1
+
+    def _top_up(self):
+        # Starts workers in place of the ones that could not be started or restarted
+        while True:
+            with self._lock:
+                if self._closed or self._workers >= self.size:
+                    return
+                self._workers += 1
+            threading.Thread(target=self._start_worker, daemon=True).start()
+
+    def _unavailable(self):
+        # The last startup error once no worker is alive or starting, None while one may still take jobs
+        with self._lock:
+            return self._startup_error if self._workers == 0 else None
+
+    def wait_ready(self, timeout=None):
+        """
+        Starts the pool and waits until a worker is idle. Returns the number of idle workers.
+        Raises RWorkerError if workers cannot be started and TimeoutError after timeout seconds.
+        """
+        self.start()
+        timeout = self.startup_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while self._idle.empty():
+            error = self._unavailable()
+            if error is not None:
+                raise RWorkerError(f'R worker could not be started: {error}')
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f'No R worker started within {timeout} seconds')
+            time.sleep(0.1)
+        return self._idle.qsize()
+
+    def _replace(self, worker, force=False):
+        worker.close(force)
+        # The replacement takes over the worker's place in _workers
+        with self._lock:
+            if self._closed:
+                self._workers -= 1
+                return
+        threading.Thread(target=self._start_worker, daemon=True).start()
+
+    def _acquire(self, cancel_event=None):
+        self.start()
+        self._top_up()
+        # All workers may be busy with jobs, which can run up to job_timeout
+        deadline = time.monotonic() + max(self.job_timeout, self.startup_timeout)
+        while time.monotonic() < deadline:
+            if cancel_event is not None and cancel_event.is_set():
+                raise RWorkerCancelled('R worker job was cancelled')
+            try:
+                worker = self._idle.get(timeout=0.2)
+            except queue.Empty:
+                error = self._unavailable()
+                if error is not None and self._idle.empty():
+                    raise RWorkerError(f'R worker could not be started: {error}')
+                self._top_up()
+                continue
+            # Health check before handing the worker out
+            if worker.ping():
+                return worker
+            self._replace(worker)
+        raise RWorkerError('No R worker became available')
+
+    def _release(self, worker):
+        worker.jobs_done += 1
+        if worker.jobs_done >= self.max_jobs_per_worker:
+            self._replace(worker)
+        else:
+            self._idle.put(worker)
+
+    def run_deseq(self, request, cancel_event=None):
+        """
+        Runs the DESeq2 analysis of deseq_worker.r on a warm worker and waits for it to finish.
+        request holds the bytes chunks of a request from r_exchange.encode_request(), every contrast
+        is extracted from the same fit and the results are written to the result file it names.
+        Raises RWorkerError if the analysis fails and TimeoutError if it runs longer than job_timeout.
+        Setting cancel_event stops the job, the worker running it is replaced.
+        """
+        worker = self._acquire(cancel_event)
+        try:
+            reply = worker.request(['RUN'], self.job_timeout, cancel_event, request)
+        except (TimeoutError, RWorkerError):
+            # The worker is killed so a stuck, cancelled or crashed job does not hold on to it
+            self._replace(worker, force=True)
+            raise
+        self._release(worker)
+
+        if reply != 'OK':
+            raise RWorkerError(reply.partition('\t')[2] or reply)
+
+    def health_check(self):
+        """
+        Pings every idle worker, replacing the ones that do not answer.
+        Returns the number of healthy idle workers.
+        """
+        healthy = []
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker.ping():
+                healthy.append(worker)
+            else:
+                self._replace(worker)
+        for worker in healthy:
+            self._idle.put(worker)
+        return len(healthy)
+
+    def shutdown(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
@@ -0,0 +1,128 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from utils.helper_functions.app_paths import app_path
+
+# SQLite database shared by every server process of the app (see README, "Production serving").
+# It holds the DE jobs (so any worker can report on or cancel a job started by another one)
+# and the result cache index. The datasets themselves are shared through the dataset store on disk.
+# The database runs in WAL mode, so readers never wait for a writer.
+
+REGISTRY_PATH = os.environ.get('APP_REGISTRY_PATH', app_path('utils/outputs/cache/registry.sqlite3'))
+BUSY_TIMEOUT = 30
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress TEXT NOT NULL DEFAULT '',
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    result TEXT,
+    error TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, status);
+CREATE TABLE IF NOT EXISTS de_results (
+    key TEXT PRIMARY KEY,
+    datasets TEXT NOT NULL,
+    normalized TEXT,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    runtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS de_results_last_used ON de_results (last_used);
+'''
+# Columns added after their table was first released, added to older databases on startup
+ADDED_COLUMNS = {'de_results': [('normalized', 'TEXT')]}
+
+
+# Identifier of this server process, unique across the hosts sharing a registry
+def process_owner():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+# Whether the process behind an owner identifier is still running, owners on other hosts are assumed alive
+def owner_alive(owner):
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    return True
+
+
+class Registry:
+    """
+    Thin wrapper around the shared SQLite database, with one connection per thread and process.
+    """
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection().executescript(SCHEMA)
+        self._add_columns()
+
+    def _add_columns(self):
+        db = self.connection()
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {row['name'] for row in db.execute(f'PRAGMA table_info({table})')}
+            for name, sql_type in columns:
+                if name in existing:
+                    continue
+                try:
+                    db.execute(f'ALTER TABLE {table} ADD COLUMN {name} {sql_type}')
+                except sqlite3.OperationalError as e:
+                    # Another process added it first
+                    if 'duplicate column' not in str(e):
+                        raise
+
+    def connection(self):
+        # Connections are not shared with threads or with processes forked from this one
+        if getattr(self._local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    def execute(self, sql, params=()):
+        return self.connection().execute(sql, params)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the statements of the with block in one write transaction.
+        """
+        db = self.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+
+def to_json(value):
+    return None if value is None else json.dumps(value)
+
+
+def from_json(text):
+    return None if text is None else json.loads(text)
+
+
+# Registry shared by the job scheduler and the result cache
+registry = Registry()
@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+import time
+
+from utils.helper_functions.dataset_store import dataset_store
+from utils.helper_functions.registry import registry
+
+# Memoised DE results keyed by (filtered count matrix, conditions table, contrasts, engine).
+# The result frames live in the dataset store, this index only maps a design to the stored key of each contrast
+# and of the variance stabilised counts of the run.
+# The index is kept in the shared registry, so cached results survive app restarts and are seen by every server process.
+
+MAX_ENTRIES = int(os.environ.get('DE_RESULT_CACHE_SIZE', 100))
+TTL = float(os.environ.get('DE_RESULT_CACHE_TTL_HOURS', 24 * 7)) * 3600
+
+
+# Hash of everything that determines a DE result, count_data is the CountMatrix of the selected samples
+def result_key(count_data, conditions_table, contrasts, engine):
+    design = {
+        'counts': count_data.key(),
+        'conditions': conditions_table[['Samples', 'Conditions']].astype(str).values.tolist(),
+        'contrasts': [list(contrast) for contrast in contrasts],
+        'engine': engine,
+    }
+    return hashlib.sha1(json.dumps(design).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Maps result keys to the dataset store keys of their contrasts, evicting entries older than `ttl` seconds
+    and the least recently used entries beyond `max_entries`.
+    """
+    def __init__(self, store=dataset_store, registry=registry, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.store = store
+        self.registry = registry
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    def get(self, key):
+        """
+        Returns the cache entry for key ({'datasets': {contrast: key}, 'normalized': key, 'created': ...,
+        'runtime': ...}) or None on a miss.
+        """
+        row = self.registry.execute('SELECT * FROM de_results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row, datasets=json.loads(row['datasets']))
+        now = time.time()
+        # Expired, or a stored frame has been evicted from the dataset store (or the entry predates normalized counts)
+        datasets = list(entry['datasets'].values()) + [entry['normalized']]
+        if now - entry['created'] > self.ttl or any(not dataset or dataset not in self.store for dataset in datasets):
+            self.registry.execute('DELETE FROM de_results WHERE key = ?', (key,))
+            return None
+        self.registry.execute('UPDATE de_results SET last_used = ? WHERE key = ?', (now, key))
+        entry['last_used'] = now
+        return entry
+
+    def put(self, key, datasets, runtime, normalized=None):
+        now = time.time()
+        with self.registry.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO de_results (key, datasets, normalized, created, last_used, runtime) '
+                       'VALUES (?, ?, ?, ?, ?, ?)', (key, json.dumps(datasets), normalized, now, now, runtime))
+            db.execute('DELETE FROM de_results WHERE created < ?', (now - self.ttl,))
+            db.execute('DELETE FROM de_results WHERE key NOT IN '
+                       '(SELECT key FROM de_results ORDER BY last_used DESC LIMIT ?)', (self.max_entries,))
+
+
+# Cache shared by all DE runs of the app
+de_result_cache = ResultCache()
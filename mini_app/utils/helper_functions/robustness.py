@@ -0,0 +1,247 @@
+import functools
+import multiprocessing
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from utils.helper_functions.dataset_store import dataset_store, stored_cache
+from utils.helper_functions.de_pipeline import python_engine_results, run_r_engine
+from utils.helper_functions.job_queue import JobCancelled
+from utils.helper_functions.pre_analysis import low_count_mask
+from utils.helper_functions.volcano import highlighted
+
+# Robustness sweeps: the DE analysis of a base design is run again on subsets of its samples,
+# leaving out one sample at a time or drawing random subsets of every condition, to find the genes
+# whose calls depend on a few samples.
+# The designs of a sweep run in parallel. With the built-in engine they run on a process pool whose
+# workers are forked with the count matrix of the sweep, a memory-mapped array from the dataset store,
+# so they all read the same copy and only sample lists and results go through the pool's pipes.
+# DESeq2 designs run on threads sharing the warm R workers.
+# The fold changes and padj of every design are stored per contrast as genes x designs frames,
+# the per-gene stability summary is computed from those for the effect sizes of the volcano plot.
+
+SWEEP_MODES = {'leave_one_out': 'Leave one sample out', 'random': 'Random subsets'}
+SWEEP_WORKERS = int(os.environ.get('DE_SWEEP_WORKERS', os.cpu_count() or 1))
+SWEEP_SUBSETS = 10
+MAX_SUBSETS = 100
+# Share of the samples of every condition drawn into a random subset
+SUBSET_FRACTION = 0.8
+# Samples every condition keeps in a subset design
+MIN_REPLICATES = 2
+BASE_DESIGN = 'All samples'
+STABILITY_ROWS = 1000
+
+
+def subset_designs(conditions_table, mode='leave_one_out', n_subsets=SWEEP_SUBSETS, fraction=SUBSET_FRACTION, seed=0):
+    """
+    (name, conditions table) of the subset designs of a base design, every condition keeping at least
+    MIN_REPLICATES samples. Leave-one-out designs that would break that are left out, random subsets
+    draw `fraction` of the samples of every condition and are all different from each other and from the base.
+    """
+    conditions_table = conditions_table[['Samples', 'Conditions']].reset_index(drop=True)
+    groups = {level: rows.index.to_numpy() for level, rows in conditions_table.groupby('Conditions', sort=False)}
+    designs = []
+    if mode == 'leave_one_out':
+        for i, sample in enumerate(conditions_table['Samples']):
+            if len(groups[conditions_table['Conditions'][i]]) > MIN_REPLICATES:
+                designs.append((f'without {sample}', conditions_table.drop(index=i).reset_index(drop=True)))
+        return designs
+
+    rng = np.random.default_rng(seed)
+    sizes = {level: min(len(rows), max(MIN_REPLICATES, int(round(fraction * len(rows))))) for level, rows in groups.items()}
+    seen = {tuple(range(len(conditions_table)))}
+    for _ in range(n_subsets * 20):
+        if len(designs) == n_subsets:
+            break
+        rows = tuple(sorted(np.concatenate([rng.choice(rows, sizes[level], replace=False)
+                                            for level, rows in groups.items()]).tolist()))
+        if rows not in seen:
+            seen.add(rows)
+            designs.append((f'subset {len(designs) + 1}', conditions_table.iloc[list(rows)].reset_index(drop=True)))
+    return designs
+
+
+def design_result(count_matrix, conditions_table, contrasts, min_count, min_samples, engine='python',
+                  workdir=None, r_worker_pool=None, cancel_event=None):
+    """
+    Positions of the genes passing the low count filter of one design, and the log2FoldChange and
+    padj of those genes for every contrast.
+    """
+    selected = count_matrix.select(conditions_table['Samples'].tolist())
+    mask = low_count_mask(selected, min_count, min_samples)
+    filtered = selected if mask.all() else selected.take_genes(mask)
+    if engine == 'python':
+        de_dfs = python_engine_results(filtered, conditions_table, contrasts, max_workers=1)
+    else:
+        de_dfs = run_r_engine(filtered, conditions_table, contrasts, workdir, r_worker_pool, cancel_event)
+    return np.flatnonzero(mask), [(de_df['log2FoldChange'].to_numpy(dtype=np.float32),
+                                   de_df['padj'].to_numpy(dtype=np.float32)) for de_df in de_dfs]
+
+
+# Count matrix of the sweep in the pool's worker processes, set when they start
+_count_matrix = None
+
+
+def _init_worker(count_matrix):
+    global _count_matrix
+    _count_matrix = count_matrix
+
+
+def _run_design(task, contrasts, min_count, min_samples):
+    name, samples, conditions = task
+    conditions_table = pd.DataFrame({'Samples': samples, 'Conditions': conditions})
+    try:
+        return name, design_result(_count_matrix, conditions_table, contrasts, min_count, min_samples), None
+    except Exception as e:
+        return name, None, str(e) or type(e).__name__
+
+
+def run_designs(job, count_matrix, designs, contrasts, engine, min_count, min_samples, r_worker_pool=None,
+                workers=SWEEP_WORKERS):
+    """
+    Runs the DE analysis of every (name, conditions table) design in parallel, reporting progress on job.
+    Returns {name: design_result()} and {name: error} of the designs that failed.
+    """
+    results, errors = {}, {}
+
+    def _done(name, result, error):
+        if error is None:
+            results[name] = result
+        else:
+            errors[name] = error
+        job.set_progress(f'Ran {len(results) + len(errors)} of {len(designs)} designs')
+
+    if engine == 'python':
+        tasks = [(name, table['Samples'].tolist(), table['Conditions'].tolist()) for name, table in designs]
+        run = functools.partial(_run_design, contrasts=contrasts, min_count=min_count, min_samples=min_samples)
+        # Forked workers inherit the count matrix instead of unpickling a copy each.
+        # Leaving the block terminates them, also when the job is cancelled
+        with multiprocessing.get_context('fork').Pool(max(1, min(workers, len(tasks))), initializer=_init_worker,
+                                                      initargs=(count_matrix,)) as pool:
+            pending = pool.imap_unordered(run, tasks)
+            for _ in tasks:
+                while True:
+                    try:
+                        _done(*pending.next(timeout=0.2))
+                        break
+                    except multiprocessing.TimeoutError:
+                        if job.cancel_event.is_set():
+                            raise JobCancelled()
+        return results, errors
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(r_worker_pool.size, len(designs))))
+    try:
+        futures = {executor.submit(design_result, count_matrix, table, contrasts, min_count, min_samples, engine,
+                                   job.workdir, r_worker_pool, job.cancel_event): name for name, table in designs}
+        for future in as_completed(futures):
+            try:
+                _done(futures[future], future.result(), None)
+            except JobCancelled:
+                raise
+            except Exception as e:
+                if job.cancel_event.is_set():
+                    raise JobCancelled()
+                _done(futures[future], None, str(e) or type(e).__name__)
+    finally:
+        executor.shutdown(cancel_futures=True)
+    return results, errors
+
+
+def sweep_frames(genes, results, contrasts):
+    """
+    One (log2FoldChange, padj) pair of genes x designs frames per contrast, with a GeneID column followed
+    by one column per design in the order of results. Genes not tested in any design are left out.
+    """
+    names = list(results)
+    frames = []
+    for k in range(len(contrasts)):
+        lfc = np.full((len(genes), len(names)), np.nan, dtype=np.float32)
+        padj = np.full((len(genes), len(names)), np.nan, dtype=np.float32)
+        for j, name in enumerate(names):
+            positions, values = results[name]
+            lfc[positions, j], padj[positions, j] = values[k]
+        tested = ~np.isnan(lfc).all(axis=1)
+        pair = []
+        for values in (lfc, padj):
+            frame = pd.DataFrame(values[tested], columns=names)
+            frame.insert(0, 'GeneID', np.asarray(genes)[tested].astype(object))
+            pair.append(frame)
+        frames.append(tuple(pair))
+    return frames
+
+
+@stored_cache(maxsize=16)
+def stability_summary(lfc_key, padj_key, effects):
+    """
+    Per-gene summary of a stored sweep: significance with all samples, share of the subset designs a gene
+    is significant in, and the spread of its log2FoldChange over them. None if the sweep is gone.
+    """
+    lfc_df, padj_df = dataset_store.get(lfc_key), dataset_store.get(padj_key)
+    if lfc_df is None or padj_df is None:
+        return None
+    designs = [col for col in lfc_df.columns if col != 'GeneID']
+    lfc = np.column_stack([lfc_df[design].to_numpy(dtype=float) for design in designs])
+    padj = np.column_stack([padj_df[design].to_numpy(dtype=float) for design in designs])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        significant = highlighted(lfc, -np.log10(padj), effects)
+    # The first column is the base design, subsets without any tested gene are left out
+    ran = ~np.isnan(lfc[:, 1:]).all(axis=0)
+    subset_lfc, subset_significant = lfc[:, 1:][:, ran], significant[:, 1:][:, ran]
+    n_subsets = subset_lfc.shape[1]
+    base = lfc[:, 0]
+    # Genes tested in no subset give all-NaN rows, their spread is NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        summary = {
+            'genes': lfc_df['GeneID'].to_numpy().astype(str),
+            'n_subsets': n_subsets,
+            'base_significant': significant[:, 0],
+            'frequency': subset_significant.sum(axis=1) / max(n_subsets, 1),
+            'tested': (~np.isnan(subset_lfc)).sum(axis=1),
+            'base_lfc': base,
+            'mean_lfc': np.nanmean(subset_lfc, axis=1),
+            'sd_lfc': np.nanstd(subset_lfc, axis=1),
+            'range_lfc': np.nanmax(subset_lfc, axis=1) - np.nanmin(subset_lfc, axis=1),
+            'sign_changes': ((np.sign(subset_lfc) != np.sign(base)[:, None]) & ~np.isnan(subset_lfc)).sum(axis=1),
+        }
+    return summary
+
+
+def _rounded(value, digits=3):
+    return None if np.isnan(value) else round(float(value), digits)
+
+
+def stability_table(lfc_key, padj_key, effects, rows=STABILITY_ROWS):
+    """
+    Table records of the genes significant with all samples or in any subset design, the least stable
+    calls with all samples first, and a one line summary of the sweep.
+    """
+    effects = tuple(sorted(float(effect) for effect in effects or (0, 0)))
+    summary = stability_summary(lfc_key, padj_key, effects)
+    if summary is None:
+        return [], 'The results of the sweep are no longer available, run it again.'
+
+    base, frequency = summary['base_significant'], summary['frequency']
+    shown = np.flatnonzero(base | (frequency > 0))
+    order = shown[np.lexsort((-np.nan_to_num(summary['range_lfc'][shown]), frequency[shown], ~base[shown]))][:rows]
+    records = [{
+        'GeneID': summary['genes'][i],
+        BASE_DESIGN: 'Yes' if base[i] else 'No',
+        'Significant in': round(float(frequency[i]), 3),
+        'Tested in': int(summary['tested'][i]),
+        'log2FC': _rounded(summary['base_lfc'][i]),
+        'log2FC mean': _rounded(summary['mean_lfc'][i]),
+        'log2FC SD': _rounded(summary['sd_lfc'][i]),
+        'log2FC range': _rounded(summary['range_lfc'][i]),
+        'Sign changes': int(summary['sign_changes'][i]),
+    } for i in order]
+
+    n_base = int(base.sum())
+    text = (f"{summary['n_subsets']} subset designs. Of the {n_base} genes significant with all samples, "
+            f"{int((base & (frequency == 1)).sum())} stay significant in every subset and "
+            f"{int((base & (frequency < 0.5)).sum())} in fewer than half of them. "
+            f"{int((~base & (frequency > 0)).sum())} other genes are significant in some subsets.")
+    return records, text
@@ -0,0 +1,171 @@
+import threading
+
+import numpy as np
+
+from utils.helper_functions.dataset_store import dataset_store, stored_cache
+
+# Sample level QC of an uploaded count matrix: PCA and sample distances on log2 normalized counts
+# of the genes that vary most between the included samples.
+# The log counts of all samples are computed once per dataset (sample_qc, cached per dataset key).
+# When the included samples change, the per-gene sums behind the variances are only updated with the
+# samples that were added or removed, and the PCA uses a randomized truncated SVD, whose cost grows
+# with the number of components rather than with the rank of the matrix.
+
+TOP_GENES = 500
+N_COMPONENTS = 3
+UNASSIGNED = 'No condition'
+
+
+def randomized_svd(a, n_components, n_oversamples=10, n_iter=4, seed=0):
+    """
+    Truncated SVD (u, s, vt) of a with n_components components, from a random projection of a
+    refined by n_iter power iterations. Signs are fixed so the largest entry of each column of u is positive.
+    """
+    rng = np.random.default_rng(seed)
+    size = min(n_components + n_oversamples, *a.shape)
+    q = a @ rng.standard_normal((a.shape[1], size))
+    for _ in range(n_iter):
+        q, _ = np.linalg.qr(q)
+        q, _ = np.linalg.qr(a.T @ q)
+        q = a @ q
+    q, _ = np.linalg.qr(q)
+    u_small, s, vt = np.linalg.svd(q.T @ a, full_matrices=False)
+    u = (q @ u_small)[:, :n_components]
+    signs = np.sign(u[np.abs(u).argmax(axis=0), np.arange(u.shape[1])])
+    signs[signs == 0] = 1
+    return u * signs, s[:n_components], vt[:n_components] * signs[:, None]
+
+
+# log2(normalized counts + 1), with median-of-ratios size factors or library sizes when every gene has a zero
+def log_normalized(counts):
+    from utils.helper_functions.deseq_engine import estimate_size_factors
+    counts = np.asarray(counts, dtype=np.float32)
+    try:
+        size_factors = estimate_size_factors(counts)
+    except ValueError:
+        library_sizes = np.maximum(counts.sum(axis=0), 1)
+        size_factors = library_sizes / np.exp(np.log(library_sizes).mean())
+    return np.log2(counts / size_factors.astype(np.float32) + 1)
+
+
+class SampleQC:
+    """
+    Log normalized counts of every sample of a count matrix, with running per-gene sums
+    over the samples included in the last summary.
+    """
+    def __init__(self, count_matrix):
+        self.samples = list(count_matrix.samples)
+        self._positions = {sample: i for i, sample in enumerate(self.samples)}
+        self.values = log_normalized(count_matrix.array())
+        self._lock = threading.Lock()
+        self._included = np.zeros(len(self.samples), dtype=bool)
+        self._sum = np.zeros(len(self.values))
+        self._sum_sq = np.zeros(len(self.values))
+
+    def _include(self, columns):
+        included = np.zeros(len(self.samples), dtype=bool)
+        included[columns] = True
+        added = np.flatnonzero(included & ~self._included)
+        removed = np.flatnonzero(self._included & ~included)
+        if len(added) + len(removed) >= included.sum():
+            # Summing the included samples is cheaper than updating
+            block = self.values[:, included].astype(np.float64)
+            self._sum, self._sum_sq = block.sum(axis=1), (block ** 2).sum(axis=1)
+        else:
+            for changed, sign in ((added, 1), (removed, -1)):
+                if len(changed):
+                    block = self.values[:, changed].astype(np.float64)
+                    self._sum += sign * block.sum(axis=1)
+                    self._sum_sq += sign * (block ** 2).sum(axis=1)
+        self._included = included
+
+    def summary(self, samples, top_genes=TOP_GENES, n_components=N_COMPONENTS):
+        """
+        PCA scores, explained variance ratios and the euclidean distance matrix of the given samples,
+        on their top_genes most variable genes. None with fewer than two known samples.
+        """
+        samples = [sample for sample in dict.fromkeys(samples) if sample in self._positions]
+        if len(samples) < 2:
+            return None
+        columns = [self._positions[sample] for sample in samples]
+        with self._lock:
+            self._include(columns)
+            mean = self._sum / len(columns)
+            variance = self._sum_sq / len(columns) - mean ** 2
+        genes = np.argpartition(variance, -top_genes)[-top_genes:] if len(variance) > top_genes else slice(None)
+        block = self.values[genes][:, columns].T.astype(np.float64)
+
+        centered = block - block.mean(axis=0)
+        n_components = min(n_components, len(samples) - 1)
+        u, s, _ = randomized_svd(centered, n_components)
+        total = (centered ** 2).sum()
+        squared_norms = (block ** 2).sum(axis=1)
+        distances = np.sqrt(np.maximum(squared_norms[:, None] + squared_norms[None, :] - 2 * block @ block.T, 0))
+        np.fill_diagonal(distances, 0)
+        return {
+            'samples': samples,
+            'scores': u * s,
+            'explained': s ** 2 / total if total > 0 else np.zeros(len(s)),
+            'distances': distances,
+            'n_genes': block.shape[1],
+        }
+
+
+# QC state of the most recently viewed datasets, keyed by dataset store key
+@stored_cache(maxsize=4)
+def sample_qc(dataset_key):
+    count_matrix = dataset_store.get(dataset_key)
+    if count_matrix is None:
+        return None
+    return SampleQC(count_matrix)
+
+
+def pca_figure(summary, conditions):
+    """
+    PC1 / PC2 scatter of a SampleQC summary with one trace per condition, conditions maps samples to their condition.
+    """
+    scores, explained = summary['scores'], summary['explained']
+    labels = np.array([conditions.get(sample, UNASSIGNED) for sample in summary['samples']])
+    samples = np.array(summary['samples'])
+    second = scores[:, 1] if scores.shape[1] > 1 else np.zeros(len(scores))
+    data = []
+    for condition in dict.fromkeys(labels):
+        members = labels == condition
+        data.append({
+            'type': 'scatter', 'mode': 'markers', 'name': condition,
+            'x': scores[members, 0].round(3).tolist(), 'y': second[members].round(3).tolist(),
+            'text': samples[members].tolist(), 'marker': {'size': 10},
+            'hovertemplate': '%{text}<br>PC1: %{x}<br>PC2: %{y}<extra>' + condition + '</extra>',
+        })
+    pc2 = f'PC2 ({explained[1]:.0%})' if len(explained) > 1 else 'PC2'
+    return {'data': data, 'layout': {
+        'title': {'text': f"PCA of {len(samples)} samples ({summary['n_genes']} most variable genes)", 'x': 0.5},
+        'xaxis': {'title': {'text': f'PC1 ({explained[0]:.0%})'}, 'zeroline': False},
+        'yaxis': {'title': {'text': pc2}, 'zeroline': False},
+        'hovermode': 'closest', 'height': 450,
+    }}
+
+
+def distance_figure(summary):
+    """
+    Heatmap of the sample distances of a SampleQC summary, samples ordered by their clustering.
+    """
+    distances = summary['distances']
+    order = np.arange(len(distances))
+    if len(distances) > 2:
+        from scipy.cluster.hierarchy import leaves_list, linkage
+        from scipy.spatial.distance import squareform
+        order = leaves_list(linkage(squareform(distances, checks=False), method='average'))
+    samples = [summary['samples'][i] for i in order]
+    return {'data': [{
+        'type': 'heatmap',
+        'z': distances[np.ix_(order, order)].round(2).tolist(),
+        'x': samples, 'y': samples,
+        'colorscale': 'Blues_r',
+        'colorbar': {'title': {'text': 'Distance'}},
+        'hovertemplate': '%{x}<br>%{y}<br>Distance: %{z}<extra></extra>',
+    }], 'layout': {
+        'title': {'text': 'Sample distances', 'x': 0.5},
+        'yaxis': {'autorange': 'reversed'}, 'xaxis': {'tickangle': -45},
+        'height': 450,
+    }}
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+# Seeded generator of negative binomial count tables shaped like RNA-seq data, used by benchmark.py.
+# Gene means are log-normal, dispersions follow a DESeq2-like trend (asymptotic dispersion plus 1 / mean),
+# library sizes vary between samples and a fraction of the genes changes between Control and Treatment.
+
+MEAN_LOG = 4.0
+SD_LOG = 2.0
+ASYMPTOTIC_DISP = 0.05
+SIZE_FACTOR_SD = 0.25
+
+
+def synthetic_counts(n_genes, n_samples, seed=0, de_fraction=0.1, fold_change=2.0):
+    """
+    Count table (GeneID column followed by one column per sample) and its conditions table,
+    with the first half of the samples as Control and the rest as Treatment.
+    The same arguments always give the same table.
+    """
+    rng = np.random.default_rng(seed)
+    base_mean = rng.lognormal(MEAN_LOG, SD_LOG, n_genes)
+    dispersion = ASYMPTOTIC_DISP + 1 / base_mean
+    size_factors = rng.lognormal(0, SIZE_FACTOR_SD, n_samples)
+
+    n_control = max(1, n_samples // 2)
+    treatment = np.arange(n_samples) >= n_control
+    log_fold_change = np.zeros(n_genes)
+    de_genes = rng.choice(n_genes, int(n_genes * de_fraction), replace=False)
+    log_fold_change[de_genes] = np.log(fold_change) * rng.choice([-1, 1], len(de_genes))
+
+    mu = base_mean[:, None] * size_factors[None, :] * np.exp(log_fold_change[:, None] * treatment[None, :])
+    size = 1 / dispersion[:, None]
+    counts = rng.negative_binomial(size, size / (size + mu)).astype(np.uint32)
+
+    samples = [f'Sample{i + 1}' for i in range(n_samples)]
+    df = pd.DataFrame(counts, columns=samples)
+    df.insert(0, 'GeneID', [f'GENE{i + 1:06d}' for i in range(n_genes)])
+    conditions_table = pd.DataFrame({'Samples': samples, 'Conditions': np.where(treatment, 'Treatment', 'Control')})
+    return df, conditions_table
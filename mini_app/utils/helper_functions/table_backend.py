@@ -0,0 +1,177 @@
+import re
+
+import numpy as np
+
+from utils.helper_functions.dataset_store import dataset_store, stored_cache
+
+# Server side paging, sorting and filtering for the DE results DataTable (custom backend mode).
+# Each stored result gets its sort orders built once, a page request then only
+# applies the filter masks, reorders the indices and slices out the requested rows.
+
+SORTED_COLUMNS = ('padj', 'pvalue', 'log2FoldChange', 'baseMean')
+MISSING_VALUE = '_'
+
+# DataTable filter operators, word forms mapped to symbols.
+# DataTable prefixes them with 's' (case-sensitive) or 'i' (case-insensitive), e.g. 'scontains', 'i=', 'ine',
+# following the case toggle of each filter cell. Without a prefix comparisons are case-sensitive, as in DataTable
+OPERATORS = {
+    'eq': '=', 'ne': '!=', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>=',
+    '=': '=', '!=': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>=',
+    'contains': 'contains', 'datestartswith': 'datestartswith',
+}
+FILTER_PART = re.compile(
+    r'^\{(?P<column>[^}]+)\}\s*'
+    r'(?:(?P<blank>is (?:blank|nil))'
+    r'|(?P<case>[is])?(?P<operator><=|>=|!=|=|<|>|(?:eq|ne|lt|le|gt|ge|contains|datestartswith)\b)\s*(?P<value>.*))$',
+    re.IGNORECASE
+)
+
+
+# Splits a filter query into (column, operator, value, case_sensitive) tuples,
+# e.g. '{padj} s< 0.05 && {GeneID} icontains ENSG'
+def parse_filter_query(filter_query):
+    filters = []
+    for part in (filter_query or '').split(' && '):
+        part = part.strip()
+        if not part:
+            continue
+        match = FILTER_PART.match(part)
+        if match is None:
+            raise ValueError(f'Unsupported filter: {part}')
+        if match.group('blank'):
+            filters.append((match.group('column'), 'blank', None, True))
+            continue
+        operator = OPERATORS[match.group('operator').lower()]
+        case_sensitive = (match.group('case') or 's').lower() == 's'
+        value = match.group('value').strip()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'`':
+            value = value[1:-1]
+        filters.append((match.group('column'), operator, value, case_sensitive))
+    return filters
+
+
+class ResultTable:
+    """
+    A stored DE result prepared for paging, with prebuilt sort orders for SORTED_COLUMNS.
+    Sort orders of the other columns are built on first use.
+    """
+    def __init__(self, df):
+        self.df = df
+        self.columns = list(df.columns)
+        self.numeric = {col for col in self.columns if df[col].dtype.kind in 'fiu'}
+        self._values = {col: df[col].to_numpy() for col in self.columns}
+        self._orders = {}
+        self._strings = {}
+        self._lowered = {}
+        for col in SORTED_COLUMNS:
+            if col in self.numeric:
+                self._order(col)
+
+    def _order(self, col):
+        # Ascending order with missing values last, the descending order keeps them last too
+        if col not in self._orders:
+            values = self._values[col]
+            if col in self.numeric:
+                order = np.argsort(values, kind='stable')
+                missing = np.isnan(values[order]) if values.dtype.kind == 'f' else np.zeros(len(order), bool)
+                present, absent = order[~missing], order[missing]
+            else:
+                order = np.argsort(self._string_values(col).to_numpy(), kind='stable')
+                present, absent = order, order[:0]
+            self._orders[col] = (np.concatenate([present, absent]),
+                                 np.concatenate([present[::-1], absent]))
+        return self._orders[col]
+
+    def _string_values(self, col):
+        if col not in self._strings:
+            self._strings[col] = self.df[col].astype(str)
+        return self._strings[col]
+
+    def _lower_values(self, col):
+        if col not in self._lowered:
+            self._lowered[col] = self._string_values(col).str.lower()
+        return self._lowered[col]
+
+    def _mask(self, col, operator, value, case_sensitive=True):
+        values = self._values[col]
+        if operator == 'blank':
+            if col in self.numeric:
+                return np.isnan(values) if values.dtype.kind == 'f' else np.zeros(len(values), bool)
+            return self.df[col].isna().to_numpy() | (self._string_values(col).str.strip() == '').to_numpy()
+
+        if col in self.numeric and operator not in ('contains', 'datestartswith'):
+            try:
+                number = float(value)
+            except ValueError:
+                return np.zeros(len(values), bool)
+            with np.errstate(invalid='ignore'):
+                if operator == '=':
+                    return values == number
+                if operator == '!=':
+                    return values != number
+                if operator == '<':
+                    return values < number
+                if operator == '<=':
+                    return values <= number
+                if operator == '>':
+                    return values > number
+                return values >= number
+
+        strings = self._string_values(col)
+        if operator == 'contains':
+            return strings.str.contains(value, case=case_sensitive, regex=False).to_numpy()
+        if not case_sensitive:
+            strings, value = self._lower_values(col), value.lower()
+        if operator == 'datestartswith':
+            return strings.str.startswith(value).to_numpy()
+        if operator == '=':
+            return (strings == value).to_numpy()
+        if operator == '!=':
+            return (strings != value).to_numpy()
+        if operator == '<':
+            return (strings < value).to_numpy()
+        if operator == '<=':
+            return (strings <= value).to_numpy()
+        if operator == '>':
+            return (strings > value).to_numpy()
+        return (strings >= value).to_numpy()
+
+    def page(self, page_current=0, page_size=20, sort_by=None, filter_query=''):
+        """
+        Returns (records, page_count) for one page of the filtered and sorted table.
+        Missing and infinite values are shown as MISSING_VALUE.
+        """
+        mask = np.ones(len(self.df), bool)
+        for col, operator, value, case_sensitive in parse_filter_query(filter_query):
+            if col in self._values:
+                mask &= self._mask(col, operator, value, case_sensitive)
+
+        # Only single column sorting, as set on the DataTable.
+        # A sort on a column the table does not have (e.g. left over from another result) is ignored
+        sort_by = [sort for sort in sort_by or [] if sort.get('column_id') in self._values]
+        if sort_by:
+            ascending, descending = self._order(sort_by[0]['column_id'])
+            order = ascending if sort_by[0].get('direction') == 'asc' else descending
+            rows = order[mask[order]]
+        else:
+            rows = np.flatnonzero(mask)
+
+        page_size = max(int(page_size or 20), 1)
+        page_count = max(-(-len(rows) // page_size), 1)
+        start = min(int(page_current or 0), page_count - 1) * page_size
+        page_df = self.df.iloc[rows[start:start + page_size]]
+        page_df = page_df.replace([np.nan, np.inf, -np.inf], MISSING_VALUE)
+        return page_df.to_dict('records'), page_count
+
+    def datatable_columns(self):
+        return [{'name': col, 'id': col, 'type': 'numeric' if col in self.numeric else 'text'}
+                for col in self.columns]
+
+
+# Result tables of the most recently viewed results, keyed by dataset store key
+@stored_cache(maxsize=8)
+def result_table(dataset_key):
+    df = dataset_store.get(dataset_key)
+    if df is None:
+        return None
+    return ResultTable(df)
@@ -0,0 +1,176 @@
+import numpy as np
+
+from utils.helper_functions.dataset_store import dataset_store, stored_cache
+from utils.helper_functions.gene_index import GeneIndex
+
+# WebGL volcano plot built from arrays computed once per DE result.
+# Slider moves are applied in the browser (see VOLCANO_THRESHOLD_JS), only recolouring
+# the points and moving the effect size lines of the figure that is already there.
+# Genes chosen in the gene search are drawn as an extra trace on top (selection_trace), which is
+# swapped into the figure in the browser by VOLCANO_SELECTION_JS.
+
+GENOMEWIDELINE = 1.30
+POINT_COLOR = '#2186f4'
+HIGHLIGHT_COLOR = 'red'
+LINE_COLOR = 'grey'
+THINNING_GRID = (400, 200)
+SELECTION_TRACE = 'Selected genes'
+SELECTION_COLOR = '#ffb000'
+
+
+# log2FoldChange, -log10(padj) and gene IDs of a stored result, NaN padj rows removed
+@stored_cache(maxsize=16)
+def volcano_arrays(dataset_key):
+    df = dataset_store.get(dataset_key)
+    if df is None:
+        return None
+    keep = df['padj'].notna().to_numpy()
+    x = df['log2FoldChange'].to_numpy(dtype=float)[keep]
+    with np.errstate(divide='ignore'):
+        y = -np.log10(df['padj'].to_numpy(dtype=float)[keep])
+    # padj of exactly 0 is drawn at the top of the plot instead of at infinity
+    finite = np.isfinite(y)
+    if not finite.all():
+        y[~finite] = 1.05 * y[finite].max() if finite.any() else 1.0
+    genes = df['GeneID'].to_numpy().astype(str)[keep]
+    return x, y, genes
+
+
+# Gene index over the points of volcano_arrays, to find the points of selected genes
+@stored_cache(maxsize=16)
+def volcano_gene_index(dataset_key):
+    arrays = volcano_arrays(dataset_key)
+    return None if arrays is None else GeneIndex(arrays[2])
+
+
+def selection_trace(dataset_key, genes):
+    """
+    Labelled markers of the selected genes of a stored DE result, to draw over either volcano plot.
+    Genes without a padj are left out like in the plot itself.
+    """
+    arrays = volcano_arrays(dataset_key)
+    if arrays is None:
+        return None
+    x, y, gene_ids = arrays
+    idx = volcano_gene_index(dataset_key).positions(genes or [])
+    return {
+        'type': 'scatter',
+        'x': x[idx].tolist(),
+        'y': y[idx].tolist(),
+        'text': gene_ids[idx].tolist(),
+        'mode': 'markers+text',
+        'textposition': 'top center',
+        'marker': {'color': SELECTION_COLOR, 'size': 11, 'line': {'color': 'black', 'width': 1}},
+        'hovertemplate': '%{text}<br>log2FoldChange: %{x:.3f}<br>-log10(padj): %{y:.3f}<extra></extra>',
+        'name': SELECTION_TRACE,
+        'showlegend': False,
+    }
+
+
+# Keeps every point in `keep` and one point per occupied grid cell for the others
+def thin_indices(x, y, keep, grid=THINNING_GRID):
+    rest = np.flatnonzero(~keep)
+    if rest.size == 0:
+        return np.flatnonzero(keep)
+    cell_x = ((x[rest] - x.min()) / (np.ptp(x) or 1) * (grid[0] - 1)).astype(int)
+    cell_y = ((y[rest] - y.min()) / (np.ptp(y) or 1) * (grid[1] - 1)).astype(int)
+    _, first = np.unique(cell_x * grid[1] + cell_y, return_index=True)
+    return np.sort(np.concatenate([np.flatnonzero(keep), rest[first]]))
+
+
+def highlighted(x, y, effects, genomewideline=GENOMEWIDELINE):
+    return (y > genomewideline) & ((x > max(effects)) | (x < min(effects)))
+
+
+def webgl_volcano_figure(dataset_key, effects, thin=False, genomewideline=GENOMEWIDELINE, selected=None):
+    """
+    Scattergl volcano plot of a stored DE result, styled like dash_bio.VolcanoPlot.
+    With thin=True dense non-significant points are reduced to one per grid cell,
+    every gene above the genome-wide line is kept. The selected genes are drawn on top, thinned or not.
+    """
+    arrays = volcano_arrays(dataset_key)
+    if arrays is None:
+        return None
+    x, y, genes = arrays
+    if thin:
+        idx = thin_indices(x, y, y > genomewideline)
+        x, y, genes = x[idx], y[idx], genes[idx]
+
+    xlim = float(1.05 * np.max(np.abs(x))) if x.size else 1.0
+    ymin, ymax = (float(y.min()), float(y.max())) if y.size else (0.0, 1.0)
+    line = {'color': LINE_COLOR, 'width': 2, 'dash': 'dash'}
+
+    # Plain figure dict, plotly's validators take longer than building the arrays themselves
+    trace = {
+        'type': 'scattergl',
+        'x': x.tolist(),
+        'y': y.tolist(),
+        'text': genes.tolist(),
+        'mode': 'markers',
+        'marker': {
+            'color': highlighted(x, y, effects, genomewideline).astype(int).tolist(),
+            'colorscale': [[0, POINT_COLOR], [1, HIGHLIGHT_COLOR]],
+            'cmin': 0,
+            'cmax': 1,
+            'size': 5,
+        },
+        'hovertemplate': '%{text}<br>log2FoldChange: %{x:.3f}<br>-log10(padj): %{y:.3f}<extra></extra>',
+        'name': 'Genes',
+    }
+    layout = {
+        'title': {'text': 'Volcano Plot', 'font': {'family': 'sans-serif', 'size': 20},
+                  'x': 0.5, 'xanchor': 'right', 'yanchor': 'top'},
+        'hovermode': 'closest',
+        'xaxis': {'title': {'text': 'log2FoldChange'}, 'zeroline': False, 'range': [-xlim, xlim]},
+        'yaxis': {'title': {'text': '-log10(padj)'}, 'zeroline': False},
+        'shapes': [
+            {'name': 'effect_size_min', 'type': 'line', 'line': line, 'xref': 'x', 'yref': 'y',
+             'x0': min(effects), 'x1': min(effects), 'y0': ymin, 'y1': ymax},
+            {'name': 'effect_size_max', 'type': 'line', 'line': line, 'xref': 'x', 'yref': 'y',
+             'x0': max(effects), 'x1': max(effects), 'y0': ymin, 'y1': ymax},
+            {'name': 'genomewideline', 'type': 'line', 'line': line, 'xref': 'x', 'yref': 'y',
+             'x0': -xlim, 'x1': xlim, 'y0': genomewideline, 'y1': genomewideline},
+        ],
+        # Read by VOLCANO_THRESHOLD_JS to recognise the figure
+        'meta': {'volcano': 'webgl', 'genomewideline': genomewideline},
+    }
+    return {'data': [trace, selection_trace(dataset_key, selected)], 'layout': layout}
+
+
+# Clientside callback moving the effect size lines and recolouring the points of a webgl_volcano_figure
+VOLCANO_THRESHOLD_JS = """
+function(effects, figure) {
+    if (!figure || !figure.layout || !figure.layout.meta || figure.layout.meta.volcano !== 'webgl') {
+        return window.dash_clientside.no_update;
+    }
+    const low = Math.min(...effects);
+    const high = Math.max(...effects);
+    const threshold = figure.layout.meta.genomewideline;
+    const trace = figure.data[0];
+    const color = trace.x.map((x, i) => (trace.y[i] > threshold && (x > high || x < low)) ? 1 : 0);
+    const shapes = figure.layout.shapes.map(shape => {
+        if (shape.name === 'effect_size_min') {
+            return {...shape, x0: low, x1: low};
+        }
+        if (shape.name === 'effect_size_max') {
+            return {...shape, x0: high, x1: high};
+        }
+        return shape;
+    });
+    return {
+        data: [{...trace, marker: {...trace.marker, color: color}}, ...figure.data.slice(1)],
+        layout: {...figure.layout, shapes: shapes}
+    };
+}
+"""
+
+# Clientside callback replacing the selected genes trace of either volcano figure with a selection_trace
+VOLCANO_SELECTION_JS = """
+function(selection, figure) {
+    if (!selection || !figure || !figure.data) {
+        return window.dash_clientside.no_update;
+    }
+    const data = figure.data.filter(trace => trace.name !== selection.name);
+    return {...figure, data: [...data, selection]};
+}
+"""
@@ -0,0 +1,89 @@
+import threading
+import time
+
+from flask import jsonify
+
+# Background warm-up of a server process and the readiness route reporting on it.
+# Heavy libraries (SciPy, dash_bio, the export writers) are imported the first time they are used,
+# so a new process starts listening quickly. The steps added with warmup.add() (page layout,
+# built-in engine, R workers) then run in order on a background thread, started once the server is up:
+# by the gunicorn post_worker_init hook, by app.py's main block, or else by the first request.
+# GET /ready answers 503 until every step has finished and 200 afterwards. A failed step (e.g. the
+# R workers when R is not installed) does not hold readiness back, it is listed with its error.
+
+READY_ROUTE = '/ready'
+
+
+class Warmup:
+    """
+    Named warm-up steps, run once and in order on a background thread.
+    """
+    def __init__(self):
+        self.steps = []
+        self.results = {}
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, name, fn):
+        self.steps.append((name, fn))
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='warmup', daemon=True)
+                self._thread.start()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the warm-up started with start() and returns whether it finished.
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.ready
+
+    def _run(self):
+        self.started = time.time()
+        for name, fn in self.steps:
+            self.results[name] = {'status': 'running'}
+            start_time = time.perf_counter()
+            try:
+                fn()
+                result = {'status': 'ok'}
+            except Exception as e:
+                result = {'status': 'failed', 'error': str(e) or type(e).__name__}
+            result['seconds'] = round(time.perf_counter() - start_time, 3)
+            self.results[name] = result
+        self.finished = time.time()
+
+    @property
+    def ready(self):
+        return self.finished is not None
+
+    def status(self):
+        return {
+            'ready': self.ready,
+            'warmup_s': round(self.finished - self.started, 3) if self.ready else None,
+            'steps': {name: self.results.get(name, {'status': 'pending'}) for name, _ in self.steps},
+        }
+
+
+# Warm-up of this server process
+warmup = Warmup()
+
+
+def register_readiness_route(server):
+    """
+    Adds the /ready route to the Flask server of the app and starts the warm-up on the first request
+    if nothing started it before.
+    """
+    @server.before_request
+    def _start_warmup():
+        warmup.start()
+
+    @server.route(READY_ROUTE)
+    def readiness():
+        return jsonify(warmup.status()), 200 if warmup.ready else 503
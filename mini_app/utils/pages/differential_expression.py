@@ -1,45 +1,78 @@
-from dash import html, callback, Input,  Output, State
+from dash import html, dash_table, clientside_callback, ctx, Input,  Output, State, no_update
 from dash.exceptions import PreventUpdate
 import pandas as pd
-import os
-import subprocess
-import dash_bio
-import numpy as np
-import io
-from io import StringIO
+import atexit
+import time
+
+from utils.helper_functions.de_pipeline import (run_de_analysis, parse_levels, design_contrasts, contrast_label,
+                                                warm_up_python_engine)
+from utils.helper_functions.job_queue import de_job_scheduler, JobQueueFull
+from utils.helper_functions.r_worker_pool import RWorkerPool
+from utils.helper_functions.dataset_store import dataset_store
+from utils.helper_functions.result_cache import de_result_cache, result_key
+from utils.helper_functions.export import available_formats, export_url
+from utils.helper_functions.table_backend import result_table
+from utils.helper_functions.pre_analysis import filter_counts, gene_filter, library_qc
+from utils.helper_functions.volcano import (webgl_volcano_figure, selection_trace, VOLCANO_THRESHOLD_JS,
+                                           VOLCANO_SELECTION_JS, GENOMEWIDELINE)
+from utils.helper_functions.gene_index import gene_index, SEARCH_LIMIT
+from utils.helper_functions.normalized_counts import variance_stabilized
+from utils.helper_functions.heatmap import heatmap_figure
+from utils.helper_functions.sample_qc import sample_qc, pca_figure, distance_figure
+from utils.helper_functions.enrichment import enrichment_table, warm_up_gene_sets
+from utils.helper_functions.robustness import (subset_designs, run_designs, sweep_frames, stability_table,
+                                               BASE_DESIGN, MIN_REPLICATES, MAX_SUBSETS, SWEEP_SUBSETS)
+from utils.helper_functions.metrics import instrumented_callback as callback
+from utils.helper_functions.warmup import warmup
 
 
 def de_functions():
+    # Warm R workers with DESeq2 loaded, shared by all DE runs.
+    # They start with the warm-up once the server is up, or with the first R run.
+    r_worker_pool = RWorkerPool()
+    atexit.register(r_worker_pool.shutdown)
+    warmup.add('python_engine', warm_up_python_engine)
+    warmup.add('gene_sets', warm_up_gene_sets)
+    warmup.add('r_engine', r_worker_pool.wait_ready)
+
     # Callback to update the sample names in the table for dropdowns
     @callback(
         Output('table-dropdown', 'data'),
         [Input('gc-filestorage', 'data')]
     )
     def update_sample_names(input_data):
-        if input_data:
-            df = pd.read_json(StringIO(input_data), orient='split')
-            sample_names = df.columns[1:]
+        count_matrix = dataset_store.get(input_data)
+        if count_matrix is not None:
+            sample_names = count_matrix.samples
             conditions = [' ' for sample in sample_names] # Shows empty at first
             df_samples = pd.DataFrame({'Samples': sample_names, 'Conditions': conditions})
             return df_samples.to_dict('records')
-        else:
-            print('Sorry no data')
-            return []
+        # No count table uploaded yet, or it is no longer stored
+        return []
         
 
+    # Offering the user-defined condition levels in the conditions dropdown
+    @callback(
+        Output('table-dropdown', 'dropdown'),
+        [Input('condition-levels', 'value')]
+    )
+    def update_condition_levels(levels_text):
+        options = [{'label': ' ', 'value': 'None'}]
+        options += [{'label': level, 'value': level} for level in parse_levels(levels_text)]
+        return {'Conditions': {'options': options}}
+
     # Define the output for the new callback to update the conditions table 
     @callback(
         Output('conditions_table', 'data'),
-        [Input('table-dropdown', 'data')]
+        [Input('table-dropdown', 'data'),
+        Input('condition-levels', 'value')]
     )
-    def update_conditions_table(table_data):
+    def update_conditions_table(table_data, levels_text):
         if table_data:
             df = pd.DataFrame(table_data, index=None)
 
-            df_filtered = df[df['Conditions'].isin(['Control', 'Treatment'])]
+            df_filtered = df[df['Conditions'].isin(parse_levels(levels_text))]
 
-            print(df_filtered)
-            
             return df_filtered.to_dict('records')
         else:
             return []
@@ -48,141 +81,490 @@ def de_functions():
 ###################################################################################################################
 
     # Running the DE analysis
+    # Conditions table and contrasts of the selected design, or a message saying what is missing
+    def analysis_design(conditions, levels_text, contrast_mode):
+        conditions_table = pd.DataFrame(conditions, index=None)
+        if conditions_table.empty:
+            return None, None, 'Select the conditions of the samples to analyse.'
+
+        # Contrasts between the levels that have samples, the first of them is the reference
+        selected_levels = set(conditions_table['Conditions'])
+        levels = [level for level in parse_levels(levels_text) if level in selected_levels]
+        if len(levels) < 2:
+            return None, None, 'Select samples of at least two conditions.'
+        return conditions_table, design_contrasts(levels, contrast_mode), None
+
+    # Results of all contrasts of a run as kept in the de-results store, with the run's normalized counts
+    def contrast_results(de_stores, normalized):
+        return [{'contrast': label, 'dataset': key, 'normalized': normalized} for label, key in de_stores.items()]
+
+    # DE job run on the scheduler, stores the result of every contrast and the variance stabilised counts
+    # of the run and remembers them in the result cache
+    def de_job(job, de_data_filtered, conditions_table, contrasts, engine, cache_key):
+        start_time = time.perf_counter()
+        job.set_progress('Running DESeq2' if engine != 'python' else 'Running built-in engine')
+        de_dfs = run_de_analysis(de_data_filtered, conditions_table, contrasts, engine, job.workdir,
+                                 r_worker_pool, job.cancel_event)
+        runtime = time.perf_counter() - start_time
+
+        job.set_progress('Normalizing counts')
+        normalized = dataset_store.put(variance_stabilized(de_data_filtered, conditions_table['Samples']))
+
+        job.set_progress('Storing results')
+        # Store de dfs server side, the dcc.Store only keeps their keys
+        de_stores = {label: dataset_store.put(de_df) for label, de_df in de_dfs.items()}
+        de_result_cache.put(cache_key, de_stores, runtime, normalized)
+        return contrast_results(de_stores, normalized)
+
+
     @callback(
-    Output('diff-exp-content', 'data'),
+    [Output('de-job', 'data'),
+    Output('de-job-poll', 'disabled'),
+    Output('loading-output', 'children'),
+    Output('de-results', 'data', allow_duplicate=True)],
     [Input('start-analysis-btn', 'n_clicks')],
     [State('conditions_table', 'data'),
-    State('gc-filestorage', 'data')],
+    State('gc-filestorage', 'data'),
+    State('de-engine', 'value'),
+    State('filter-min-count', 'value'),
+    State('filter-min-samples', 'value'),
+    State('condition-levels', 'value'),
+    State('contrast-mode', 'value')],
     prevent_initial_call=True
     )
-    def start_deseq(n_clicks, conditions, input_data):
-        if n_clicks:
-            # Loading the conditions table and filtering only the samples selected
-            conditions_table = pd.DataFrame(conditions, index=None)
-            samples_required = conditions_table['Samples'].tolist()
-            
-            # Loading the data and keeping only the selected samples
-            de_data = pd.read_json(StringIO(input_data), orient='split')
+    def start_deseq(n_clicks, conditions, input_data, engine, min_count, min_samples, levels_text, contrast_mode):
+        if not n_clicks:
+            raise PreventUpdate
 
-            gene_id_column = de_data.columns[0]
+        # Loading the conditions table and filtering only the samples selected
+        conditions_table, contrasts, message = analysis_design(conditions, levels_text, contrast_mode)
+        if message:
+            return None, True, message, no_update
+        samples_required = conditions_table['Samples'].tolist()
 
-            required_columns = [gene_id_column] + samples_required
+        # Loading the data, keeping only the selected samples and the genes passing the low count filter
+        de_data_filtered = filter_counts(input_data, samples_required, int(min_count or 0), int(min_samples or 0))
+        if de_data_filtered is None:
+            raise PreventUpdate
 
-            de_data_filtered = de_data[required_columns]
+        # Returning the memoised result if this design has been analysed before
+        cache_key = result_key(de_data_filtered, conditions_table, contrasts, engine)
+        cached = de_result_cache.get(cache_key)
+        if cached is not None:
+            message = f"Loaded cached results (original run took {cached['runtime']:.1f} s)."
+            return None, True, message, contrast_results(cached['datasets'], cached['normalized'])
 
-            # Making directory for DESEQ analysis
-            os.makedirs('utils/outputs/DESEQ', exist_ok=True)
+        # Queue the analysis, the page polls the job until it is done
+        try:
+            job_id = de_job_scheduler.submit(de_job, de_data_filtered, conditions_table, contrasts, engine, cache_key)
+        except JobQueueFull as e:
+            return None, True, str(e), no_update
 
-            # Making conditions and deseq data files
-            conditions_table.to_csv('utils/outputs/DESEQ/conditions_table.tsv', sep= '\t', index=False)
-            de_data_filtered.to_csv('utils/outputs/DESEQ/df_de.csv', index=False)
+        message = f'Analysis of {de_data_filtered.shape[0]} genes queued ({len(contrasts)} contrasts).'
+        return job_id, False, message, no_update
 
-            # DE ouput
-            de_out = 'utils/outputs/DESEQ/de_out.csv'
+    # Library QC of the uploaded samples and the number of genes kept by the low count filter
+    @callback(
+        Output('qc-summary', 'children'),
+        [Input('gc-filestorage', 'data'),
+        Input('conditions_table', 'data'),
+        Input('filter-min-count', 'value'),
+        Input('filter-min-samples', 'value')]
+    )
+    def update_qc_summary(input_data, conditions, min_count, min_samples):
+        qc = library_qc(input_data) if input_data else None
+        if qc is None:
+            return []
 
-            # R-script
-            script_path = 'utils/helper_functions/DGE_deseq2.r'
+        selected = [row['Samples'] for row in conditions or []]
+        if selected:
+            qc = qc[qc['Samples'].isin(selected)]
+            kept = gene_filter(input_data, tuple(selected), int(min_count or 0), int(min_samples or 0))
+            filter_text = f'{int(kept.sum())} of {len(kept)} genes pass the low count filter and go to the DE analysis.'
+        else:
+            filter_text = 'Select samples to see how many genes pass the low count filter.'
 
-            # R-Script for running DESEQ
-            print(f'Rscript {script_path} utils/outputs/DESEQ/df_de.csv utils/outputs/DESEQ/conditions_table.tsv de_out')
+        qc = qc.assign(zero_fraction=qc['zero_fraction'].round(3))
+        return [
+            dash_table.DataTable(
+                data=qc.to_dict('records'),
+                columns=[{'name': name, 'id': col} for col, name in
+                         [('Samples', 'Sample'), ('library_size', 'Library size'),
+                          ('zero_fraction', 'Zero fraction'), ('detected_genes', 'Detected genes')]],
+                page_size=15,
+                style_cell={'font-size': 'small'}
+            ),
+            html.Div(filter_text, style={'font-size': 'small', 'marginTop': '5px'})
+        ]
 
-            #Running DESEQ
-            res = subprocess.check_output(f'Rscript {script_path} utils/outputs/DESEQ/df_de.csv utils/outputs/DESEQ/conditions_table.tsv Control Treatment {de_out}', shell=True)
+    # PCA and distance matrix of the selected samples, or of all samples until some are selected.
+    # The log counts are computed once per upload, a new selection only updates the gene variances
+    @callback(
+        [Output('sample-pca', 'figure'),
+        Output('sample-distances', 'figure')],
+        [Input('gc-filestorage', 'data'),
+        Input('conditions_table', 'data')]
+    )
+    def update_sample_qc(input_data, conditions):
+        qc = sample_qc(input_data) if input_data else None
+        if qc is None:
+            raise PreventUpdate
+        conditions = {row['Samples']: row['Conditions'] for row in conditions or []}
+        summary = qc.summary(list(conditions) or qc.samples)
+        if summary is None:
+            message = {'data': [], 'layout': {
+                'xaxis': {'visible': False}, 'yaxis': {'visible': False},
+                'annotations': [{'text': 'Select at least two samples.', 'showarrow': False}]}}
+            return message, message
+        return pca_figure(summary, conditions), distance_figure(summary)
 
-            # Load in the DE framework, present it on page, give it to store
-            de_df = pd.read_csv(de_out)
+    # Polling the running DE job
+    @callback(
+    [Output('de-results', 'data'),
+    Output('loading-output', 'children', allow_duplicate=True),
+    Output('de-job-poll', 'disabled', allow_duplicate=True)],
+    [Input('de-job-poll', 'n_intervals')],
+    [State('de-job', 'data')],
+    prevent_initial_call=True
+    )
+    def poll_de_job(n_intervals, job_id):
+        status = de_job_scheduler.status(job_id) if job_id else None
+        if status is None:
+            return no_update, '', True
 
-            de_df = de_df.rename(columns={'Unnamed: 0': 'GeneID'})
+        if status['status'] == 'queued':
+            return no_update, f"Analysis queued (position {status['position']}, waiting {status['waited']:.0f} s).", False
+        if status['status'] == 'running':
+            return no_update, f"{status['progress']}... ({status['elapsed']:.0f} s)", False
+        if status['status'] == 'finished':
+            return status['result'], f"Analysis finished in {status['elapsed']:.1f} s.", True
+        if status['status'] == 'cancelled':
+            return no_update, 'Analysis cancelled.', True
+        return no_update, f"Analysis failed: {status['error']}", True
 
-            # Store de df in json store
-            de_store = de_df.to_json(date_format='iso', orient='split', double_precision=15)
-        
+    # Selecting the contrast shown in the results table, the volcano plot and the export
+    @callback(
+        [Output('diff-exp-content', 'data'),
+        Output('contrast-view', 'options'),
+        Output('contrast-view', 'value')],
+        [Input('de-results', 'data'),
+        Input('contrast-view', 'value')],
+        prevent_initial_call=True
+    )
+    def select_contrast(results, contrast):
+        if not results:
+            return None, [], None
+        datasets = {result['contrast']: result['dataset'] for result in results}
+        # New results keep the contrast being looked at when the run has it
+        if contrast not in datasets:
+            contrast = results[0]['contrast']
+        return datasets[contrast], list(datasets), contrast
 
-        return de_store
+    # Cancelling the running DE job
+    @callback(
+    Output('loading-output', 'children', allow_duplicate=True),
+    [Input('cancel-analysis-btn', 'n_clicks')],
+    [State('de-job', 'data')],
+    prevent_initial_call=True
+    )
+    def cancel_de_job(n_clicks, job_id):
+        if not n_clicks or not job_id:
+            raise PreventUpdate
+        if de_job_scheduler.cancel(job_id):
+            return 'Cancelling analysis...'
+        raise PreventUpdate
 
     # Callback to update the differential expression table - original data
+    # The table runs in custom mode, only the requested page is filtered, sorted and sent
     @callback(
         [Output('diff-exp-table', 'data', allow_duplicate=True),
-        Output('diff-exp-table', 'columns', allow_duplicate=True)],
-        Input('diff-exp-content', 'data'),
+        Output('diff-exp-table', 'columns', allow_duplicate=True),
+        Output('diff-exp-table', 'page_count'),
+        Output('diff-exp-table', 'page_current')],
+        [Input('diff-exp-content', 'data'),
+        Input('diff-exp-table', 'page_current'),
+        Input('diff-exp-table', 'page_size'),
+        Input('diff-exp-table', 'sort_by'),
+        Input('diff-exp-table', 'filter_query')],
         prevent_initial_call=True
     )
-    def update_diff_exp_table(input_data):
-        if input_data:
-            # Parse the input data and extract columns and data
-            df = pd.read_json(StringIO(input_data), orient='split', precise_float=True)
+    def update_diff_exp_table(input_data, page_current, page_size, sort_by, filter_query):
+        table = result_table(input_data) if input_data else None
+        if table is None:
+            return [], [], 1, 0
 
-            # Replace NaN and inf values with underscores
-            df.replace([np.nan, np.inf, -np.inf], '_', inplace=True)
-            
-            # Fill remaining NaN values with underscores
-            df.fillna('_', inplace=True)
-            
-            columns = [{'name': col, 'id': col} for col in df.columns]
-            data = df.to_dict('records')
-            return data, columns
-        else:
-            return [], []
+        # New results and new filters start from the first page
+        if ctx.triggered_id != 'diff-exp-table' or 'diff-exp-table.filter_query' in ctx.triggered_prop_ids:
+            page_current = 0
+        try:
+            data, page_count = table.page(page_current, page_size, sort_by, filter_query)
+        except ValueError:
+            # Filter the backend does not understand
+            return [], table.datatable_columns(), 1, 0
+        return data, table.datatable_columns(), page_count, min(page_current or 0, page_count - 1)
 
-    # Downloading the deseq results - Unaltered data
+    # Gene search typeahead, matches come from the prefix index of the shown result
+    # The selected genes stay in the options so the dropdown keeps showing them
+    @callback(
+        Output('gene-search', 'options'),
+        [Input('gene-search', 'search_value'),
+        Input('diff-exp-content', 'data')],
+        [State('gene-search', 'value')],
+        prevent_initial_call=True
+    )
+    def update_gene_options(search_value, input_data, selected):
+        index = gene_index(input_data) if input_data else None
+        matches = index.search(search_value, SEARCH_LIMIT) if index is not None else []
+        return [{'label': gene, 'value': gene} for gene in dict.fromkeys((selected or []) + matches)]
+
+    # Highlighting the selected genes on the shown table page, the page data itself is not sent again
+    @callback(
+        Output('diff-exp-table', 'style_data_conditional'),
+        [Input('gene-search', 'value')]
+    )
+    def highlight_table_genes(selected):
+        return [{'if': {'filter_query': f'{{GeneID}} = "{gene}"'}, 'backgroundColor': '#fff3b0', 'fontWeight': 'bold'}
+                for gene in selected or [] if '"' not in gene]
+
+    # Points of the selected genes, drawn into the volcano plot in the browser by the clientside callback below
     @callback(
-        Output('deseq_download_component', 'data', allow_duplicate=True),
-        Input('results-download-btn', 'n_clicks'),
-        Input('diff-exp-content', 'data'),
+        Output('gene-selection', 'data'),
+        [Input('gene-search', 'value'),
+        Input('diff-exp-content', 'data')],
         prevent_initial_call=True
-    )    
-    def download_original_deseq_results(n_clicks, input_data):
-        if input_data:
-            # Parse the input data and extract columns and data
-            df = pd.read_json(StringIO(input_data), orient='split', precise_float=True)
-            columns = [{'name': col, 'id': col} for col in df.columns]
-            data = df.to_dict('records')
-
-            if n_clicks:
-                if data is None or columns is None:
-                    # If data or columns are not available, prevent download
-                    raise PreventUpdate
-                else:
-                    # Prepare CSV content
-                    csv_string = ','.join([col['name'] for col in columns]) + '\n'
-                    for row in data:
-                        csv_string += ','.join([str(row[col['id']]) for col in columns]) + '\n'
-
-                    # Create download dictionary
-                    return dict(content=csv_string, filename='Deseq_results.csv')
+    )
+    def update_gene_selection(selected, input_data):
+        if not input_data:
+            raise PreventUpdate
+        return selection_trace(input_data, selected)
+
+    clientside_callback(
+        VOLCANO_SELECTION_JS,
+        Output('de_volcano_plot', 'figure', allow_duplicate=True),
+        Input('gene-selection', 'data'),
+        State('de_volcano_plot', 'figure'),
+        prevent_initial_call=True
+    )
+
+    # Downloading the deseq results - Unaltered data
+    # The button links to the export route, the file is only written and sent when it is clicked
+    @callback(
+        [Output('results-download-btn', 'href'),
+        Output('results-download-btn', 'disabled')],
+        [Input('diff-exp-content', 'data'),
+        Input('export-format', 'value')]
+    )
+    def update_download_link(input_data, fmt):
+        if not input_data or fmt not in available_formats():
+            return None, True
+        return export_url(input_data, fmt), False
                 
     # Creating the Volcano plot from deseq data
     @callback(
     Output('de_volcano_plot', 'figure'),
     Input('range-slider', 'value'),
     Input('diff-exp-content', 'data'),
+    Input('volcano-mode', 'value'),
+    Input('volcano-thin', 'value'),
+    State('gene-search', 'value'),
     prevent_initial_call=True
     )
-    def make_volcano_plot(effects, input_data):
-        if input_data:
-            # Parse the input data and extract columns and data
-            df = pd.read_json(StringIO(input_data), orient='split', precise_float=True)
+    def make_volcano_plot(effects, input_data, mode, thin, selected):
+        # In WebGL mode slider moves are handled in the browser by the clientside callback below
+        if mode == 'webgl' and ctx.triggered_id == 'range-slider':
+            raise PreventUpdate
 
+        if mode == 'webgl':
+            figure = webgl_volcano_figure(input_data, effects, thin=bool(thin), selected=selected)
+            if figure is not None:
+                return figure
+            return html.Div("No differential expression data available.", style={'textAlign': 'center'})
+
+        df = dataset_store.get(input_data)
+        if df is not None:
             df = df.dropna(subset=['padj'])  # Remove rows with NaN padj-values # 'pvalue'
             df = df.reset_index(drop=True)
 
-            # Create the Volcano plot
+            # Create the Volcano plot, dash_bio is only imported for this mode as it takes seconds to load
+            import dash_bio
             figure = dash_bio.VolcanoPlot(
                 dataframe=df,
                 effect_size='log2FoldChange',
                 p='padj', # 'pvalue'
                 gene='GeneID',
                 snp='GeneID', # Can't seem to remove snp as whenever that happens, throws an error
-                genomewideline_value=1.30, #2.5
+                genomewideline_value=GENOMEWIDELINE, #2.5
                 genomewideline_width=2,
                 effect_size_line=effects,
                 effect_size_line_width=2,
                 xlabel='log2FoldChange',  # Set x-axis label
                 ylabel='-log10(padj)'  # Set y-axis label
             )
+            # Selected genes from the gene search on top
+            figure.add_trace(selection_trace(input_data, selected))
 
             return figure
             
         else:
             # If no data available, return a message or placeholder
             return html.Div("No differential expression data available.", style={'textAlign': 'center'})
+
+    # Clustered heatmap of the top genes of the shown contrast, from the normalized counts stored with the run
+    # Changing the number of genes or the ranking only slices the cached matrix
+    @callback(
+        Output('de_heatmap', 'figure'),
+        [Input('diff-exp-content', 'data'),
+        Input('heatmap-genes', 'value'),
+        Input('heatmap-metric', 'value')],
+        [State('de-results', 'data')],
+        prevent_initial_call=True
+    )
+    def make_heatmap(input_data, n_genes, metric, results):
+        normalized = next((result.get('normalized') for result in results or [] if result['dataset'] == input_data), None)
+        figure = heatmap_figure(input_data, normalized, int(n_genes), metric) if input_data and normalized else None
+        if figure is not None:
+            return figure
+        return {'data': [], 'layout': {
+            'xaxis': {'visible': False}, 'yaxis': {'visible': False},
+            'annotations': [{'text': 'No differential expression data available.', 'showarrow': False}]}}
+
+    # Gene set over-representation among the significant genes of the shown contrast.
+    # The effect sizes come from the volcano slider, the results are cached per result and cutoffs.
+    @callback(
+        [Output('enrichment-table', 'data'),
+        Output('enrichment-summary', 'children')],
+        [Input('diff-exp-content', 'data'),
+        Input('range-slider', 'value'),
+        Input('enrichment-padj', 'value'),
+        Input('enrichment-direction', 'value')],
+        prevent_initial_call=True
+    )
+    def update_enrichment(input_data, effects, padj_cutoff, direction):
+        if not input_data:
+            return [], ''
+        return enrichment_table(input_data, effects, float(padj_cutoff), direction)
+
+    # Robustness sweep: the selected design is run again on subsets of its samples, all of them reading
+    # the uploaded count matrix, and the fold changes and padj of every design are stored per contrast.
+    # Sweeps are not kept in the result cache, the stored frames live as long as the dataset store keeps them
+    def sweep_job(job, count_matrix, conditions_table, contrasts, engine, mode, n_subsets, min_count, min_samples):
+        designs = [(BASE_DESIGN, conditions_table)] + subset_designs(conditions_table, mode, n_subsets)
+        results, errors = run_designs(job, count_matrix, designs, contrasts, engine, min_count, min_samples,
+                                      r_worker_pool)
+        if BASE_DESIGN not in results:
+            raise RuntimeError(f'the design with all samples failed: {errors.get(BASE_DESIGN)}')
+
+        job.set_progress('Storing results')
+        # Columns in the order of the designs, the design with all samples first
+        results = {name: results[name] for name, _ in designs if name in results}
+        frames = sweep_frames(count_matrix.genes, results, contrasts)
+        return {
+            'subsets': len(results) - 1,
+            'failed': sorted(errors),
+            'results': [{'contrast': contrast_label(contrast), 'lfc': dataset_store.put(lfc), 'padj': dataset_store.put(padj)}
+                        for contrast, (lfc, padj) in zip(contrasts, frames)],
+        }
+
+    @callback(
+    [Output('sweep-job', 'data'),
+    Output('sweep-poll', 'disabled'),
+    Output('sweep-output', 'children')],
+    [Input('start-sweep-btn', 'n_clicks')],
+    [State('conditions_table', 'data'),
+    State('gc-filestorage', 'data'),
+    State('de-engine', 'value'),
+    State('filter-min-count', 'value'),
+    State('filter-min-samples', 'value'),
+    State('condition-levels', 'value'),
+    State('contrast-mode', 'value'),
+    State('sweep-mode', 'value'),
+    State('sweep-subsets', 'value')],
+    prevent_initial_call=True
+    )
+    def start_sweep(n_clicks, conditions, input_data, engine, min_count, min_samples, levels_text, contrast_mode,
+                    mode, n_subsets):
+        if not n_clicks:
+            raise PreventUpdate
+        conditions_table, contrasts, message = analysis_design(conditions, levels_text, contrast_mode)
+        if message:
+            return None, True, message
+        count_matrix = dataset_store.get(input_data)
+        if count_matrix is None:
+            raise PreventUpdate
+
+        n_subsets = min(max(int(n_subsets or SWEEP_SUBSETS), 1), MAX_SUBSETS)
+        if not subset_designs(conditions_table, mode, n_subsets):
+            return None, True, f'Every condition needs more than {MIN_REPLICATES} samples for a robustness sweep.'
+        try:
+            job_id = de_job_scheduler.submit(sweep_job, count_matrix, conditions_table, contrasts, engine, mode,
+                                             n_subsets, int(min_count or 0), int(min_samples or 0))
+        except JobQueueFull as e:
+            return None, True, str(e)
+        return job_id, False, 'Robustness sweep queued.'
+
+    # Polling the running sweep
+    @callback(
+    [Output('sweep-results', 'data'),
+    Output('sweep-output', 'children', allow_duplicate=True),
+    Output('sweep-poll', 'disabled', allow_duplicate=True)],
+    [Input('sweep-poll', 'n_intervals')],
+    [State('sweep-job', 'data')],
+    prevent_initial_call=True
+    )
+    def poll_sweep_job(n_intervals, job_id):
+        status = de_job_scheduler.status(job_id) if job_id else None
+        if status is None:
+            return no_update, '', True
+
+        if status['status'] == 'queued':
+            return no_update, f"Sweep queued (position {status['position']}, waiting {status['waited']:.0f} s).", False
+        if status['status'] == 'running':
+            return no_update, f"{status['progress']}... ({status['elapsed']:.0f} s)", False
+        if status['status'] == 'finished':
+            result = status['result']
+            message = f"Sweep of {result['subsets']} subset designs finished in {status['elapsed']:.1f} s."
+            if result['failed']:
+                message += f" Failed designs: {', '.join(result['failed'])}."
+            return result['results'], message, True
+        if status['status'] == 'cancelled':
+            return no_update, 'Sweep cancelled.', True
+        return no_update, f"Sweep failed: {status['error']}", True
+
+    @callback(
+    Output('sweep-output', 'children', allow_duplicate=True),
+    [Input('cancel-sweep-btn', 'n_clicks')],
+    [State('sweep-job', 'data')],
+    prevent_initial_call=True
+    )
+    def cancel_sweep_job(n_clicks, job_id):
+        if not n_clicks or not job_id:
+            raise PreventUpdate
+        if de_job_scheduler.cancel(job_id):
+            return 'Cancelling sweep...'
+        raise PreventUpdate
+
+    # Per-gene stability of the contrast shown above, significance following the volcano effect size slider
+    @callback(
+        [Output('stability-table', 'data'),
+        Output('stability-summary', 'children')],
+        [Input('sweep-results', 'data'),
+        Input('contrast-view', 'value'),
+        Input('range-slider', 'value')],
+        prevent_initial_call=True
+    )
+    def update_stability(results, contrast, effects):
+        if not results:
+            return [], ''
+        sweeps = {result['contrast']: result for result in results}
+        sweep = sweeps.get(contrast, results[0])
+        records, summary = stability_table(sweep['lfc'], sweep['padj'], effects)
+        return records, f"{sweep['contrast']}: {summary}"
+
+    # Moving the effect size lines and recolouring the WebGL volcano without a server round trip
+    clientside_callback(
+        VOLCANO_THRESHOLD_JS,
+        Output('de_volcano_plot', 'figure', allow_duplicate=True),
+        Input('range-slider', 'value'),
+        State('de_volcano_plot', 'figure'),
+        prevent_initial_call=True
+    )
@@ -1,46 +1,14 @@
-from dash import callback, Input,  Output, State
+from dash import Input,  Output, State
 from dash.exceptions import PreventUpdate
-import numpy as np
 
 from utils.helper_functions.main_functions import *
+from utils.helper_functions.dataset_store import dataset_store
+from utils.helper_functions.count_matrix import CountMatrix, CountMatrixError
+from utils.helper_functions.count_table import parse_count_table, CountTableError, COUNT_TABLE_EXTENSIONS
+from utils.helper_functions.metrics import instrumented_callback as callback
 
 def upload_functions():
 
-    def validate_gene_count_format(df):
-        """
-        Validate if the uploaded file is in the correct gene count table format
-        Customize this function based on your specific requirements
-        """
-        try:
-            # Check if dataframe is not empty
-            if df.empty:
-                return False
-            
-            # Check if first column contains gene names/IDs (should be strings)
-            if not df.iloc[:, 0].dtype == 'object':
-                return False
-            
-            # Check if other columns contain numeric data (gene counts)
-            numeric_columns = df.select_dtypes(include=[np.number]).columns
-            if len(numeric_columns) < 1:
-                return False
-            
-            # Check for negative values in count data (counts should be non-negative)
-            numeric_data = df.select_dtypes(include=[np.number])
-            if (numeric_data < 0).any().any():
-                return False
-            
-            # Add more specific validation rules based on your gene count table requirements
-            # For example:
-            # - Minimum number of samples required
-            # - Specific column naming conventions
-            # - Gene ID format validation
-            
-            return True
-            
-        except Exception:
-            return False
-
     # Single callback for processing the file and updating all outputs
     @callback(
         [Output('gc-filestorage', 'data'),
@@ -63,26 +31,26 @@ def upload_functions():
                 decoded = base64.b64decode(content_string)
                 
                 # Check file extension
-                if filename.endswith('.csv'):
+                if filename.lower().endswith(COUNT_TABLE_EXTENSIONS):
+                    # csv/tsv/gz tables, featureCounts and HTSeq output
                     try:
-                        df = pd.read_csv(io.StringIO(decoded.decode('utf-8')))
-                    except UnicodeDecodeError:
-                        df = pd.read_csv(io.StringIO(decoded.decode('latin-1')))
+                        count_matrix = parse_count_table(decoded, filename)
+                    except CountTableError as e:
+                        return None, "", str(e), True
                 elif filename.endswith(('.xlsx', '.xls')):
-                    df = pd.read_excel(io.BytesIO(decoded))
+                    # Validate gene count table format while building the count matrix
+                    try:
+                        count_matrix = CountMatrix.from_frame(pd.read_excel(io.BytesIO(decoded)))
+                    except CountMatrixError as e:
+                        return None, "", str(e), True
                 else:
                     # Wrong file format
-                    error_msg = f"Wrong format: {filename}. Please upload a CSV or Excel file."
-                    return None, "", error_msg, True
-                
-                # Validate gene count table format
-                if not validate_gene_count_format(df):
-                    error_msg = "The format of gene count table is not supported. Please check your file format."
+                    error_msg = f"Wrong format: {filename}. Please upload a CSV, TSV or Excel file."
                     return None, "", error_msg, True
                 
-                # If validation passes, store the data
+                # If validation passes, store the data server side and keep only its key in the browser
                 filename_string = f'The uploaded file is {filename}'
-                return df.to_json(date_format='iso', orient='split'), filename_string, "", False
+                return dataset_store.put(count_matrix), filename_string, "", False
                 
             else:
                 # Return empty data and columns if no file is uploaded
@@ -91,4 +59,20 @@ def upload_functions():
         except Exception as e:
             filename_string = f'An error occurred with the uploaded file "{filenames}". Check the file and make sure that a gene count table is uploaded.'
             error_msg = "The format of gene count table is not supported. Please check your file format."
-            return None, filename_string, error_msg, True
\ No newline at end of file
+            return None, filename_string, error_msg, True
+
+    # Result of a chunked upload (assets/chunked_upload.js), the table is already validated and stored
+    @callback(
+        [Output('gc-filestorage', 'data', allow_duplicate=True),
+         Output('filename-display', 'children', allow_duplicate=True),
+         Output('upload-error-alert', 'children', allow_duplicate=True),
+         Output('upload-error-alert', 'is_open', allow_duplicate=True)],
+        [Input('chunked-upload-result', 'data')],
+        prevent_initial_call=True
+    )
+    def update_chunked_output(result):
+        if not result:
+            raise PreventUpdate
+        if result.get('error'):
+            return None, "", result['error'], True
+        return result['key'], f"The uploaded file is {result['filename']}", "", False